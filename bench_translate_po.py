@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Speed of translate_po.py on a large catalogue, offline.
+
+The catalogue is generated with a fixed seed: entries of random words with
+placeholders, tags and acronyms, some with a context, a plural or several
+lines.  It measures:
+
+  pofile     reading and writing it back, which must give the same bytes
+  protect    protecting and restoring the placeholders of every string,
+             with the single pass tokenizer and with the six re.sub passes
+             and per-token restore it replaced
+  pipeline   the whole run with the copy backend and no memory, which must
+             give every string back unchanged
+"""
+
+import random
+import re
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+
+import pofile
+import translate_po
+
+SEED = 1
+ENTRIES = 20000
+
+WORDS = ('open close file folder the a of to in is with for not save new '
+         'print window network device user password please select').split()
+SPECIAL = [u'%s', u'%d', u'%(name)s', u'${HOME}', u'$PATH', u'<b>', u'</b>',
+           u'USB', u'PUPPY', u'Puppy', u'\\', u'\t', u'"', u'{0}']
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+def make_sentence(rng):
+    words = []
+    for i in range(rng.randint(2, 14)):
+        if rng.random() < 0.15:
+            words.append(rng.choice(SPECIAL))
+        else:
+            words.append(rng.choice(WORDS))
+    return u' '.join(words).capitalize()
+
+def make_catalogue(entries=ENTRIES, seed=SEED):
+    rng = random.Random(seed)
+    out = StringIO()
+    header = pofile.Entry(msgid=u'', comments=[u'#, fuzzy'],
+            msgstr=u'Project-Id-Version: bench\n'
+                   u'Content-Type: text/plain; charset=UTF-8\n')
+    out.write(pofile.format_entry(header))
+    for n in xrange(entries):
+        lines = [make_sentence(rng) for i in range(rng.choice([1, 1, 1, 2, 3]))]
+        entry = pofile.Entry(msgid=u'\n'.join(lines),
+                comments=[u'#: src/file%d.c:%d' % (n % 97, n)])
+        r = rng.random()
+        if r < 0.1:
+            entry.msgctxt = u'menu'
+        elif r < 0.2:
+            entry = pofile.Entry(msgid=entry.msgid, comments=entry.comments,
+                    msgid_plural=make_sentence(rng))
+        if rng.random() < 0.3:
+            entry.add_flag(u'c-format')
+        out.write(pofile.format_entry(entry))
+    return out.getvalue()
+
+def sequential_protect(text):
+    # the implementation the tokenizer replaced, for comparison
+    notrans = []
+    def replace(match):
+        notrans.append(match.group(0))
+        return " 0.%d68065175210" % (len(notrans) - 1)
+    text = re.sub("\${[\w_]+}|\$[\w_]+", replace, text)
+    text = re.sub("\\\\\"|\\\\$|\\\\\\\\n|\\\\t", replace, text)
+    text = re.sub("\\\\", replace, text)
+    text = re.sub("[A-Z]{2,100}", replace, text)
+    text = re.sub("<\w+>|</\w+>", replace, text)
+    text = re.sub("(?i)puppy", replace, text)
+    return text, notrans
+
+def sequential_restore(trans, notrans):
+    for i in range(len(notrans)):
+        trans = re.sub("0 ?.%d68065175210" % i, lambda x: notrans[i], trans)
+    return trans
+
+def bench_protect(protect, restore, texts):
+    start = time.time()
+    for text in texts:
+        protected, notrans = protect(text)
+        restore(protected, notrans)
+    return time.time() - start
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', type='int', dest='entries', default=ENTRIES,
+            help='entries in the catalogue (%d)' % ENTRIES)
+    parser.add_option('-s', type='int', dest='seed', default=SEED,
+            help='seed of the catalogue')
+    parser.add_option('-j', type='int', dest='jobs', default=translate_po.JOBS,
+            help='threads of the pipeline')
+    (options, args) = parser.parse_args()
+
+    data = make_catalogue(options.entries, options.seed)
+    print 'catalogue: %d entries, %.1fMB' % (options.entries,
+                                             len(data) / 1048576.0)
+
+    start = time.time()
+    out = StringIO()
+    pofile.write_entries(out, pofile.read_entries(StringIO(data)))
+    seconds = time.time() - start
+    print 'pofile    %7.3fs %8.1fMB/s  round trip %s' % (seconds,
+            len(data) / 1048576.0 / seconds,
+            out.getvalue() == data and 'identical' or 'DIFFERS')
+
+    texts = set()
+    for entry in pofile.read_entries(StringIO(data)):
+        if translate_po.wants_translation(entry):
+            texts.update(translate_po.entry_texts(entry))
+    texts = sorted(texts)
+    for name, protect, restore in [
+            ('tokenizer', translate_po.protect, translate_po.restore),
+            ('6 passes', sequential_protect, sequential_restore)]:
+        seconds = bench_protect(protect, restore, texts)
+        print 'protect   %7.3fs %8.0f strings/s  %s' % (seconds,
+                len(texts) / seconds, name)
+    lost = [text for text in texts
+            if translate_po.restore(*translate_po.protect(text)) != text]
+    print 'protect   %d of %d strings not restored' % (len(lost), len(texts))
+
+    start = time.time()
+    translations, stats = translate_po.translate_all(texts,
+            translate_po.CopyBackend('en', 'en'), None, 'en|en',
+            options.jobs)
+    translate_po.write_catalogue(NullWriter(),
+            pofile.read_entries(StringIO(data)), translations, 'bench')
+    seconds = time.time() - start
+    changed = len([text for text in texts if translations.get(text) != text])
+    print 'pipeline  %7.3fs %8.0f strings/s  %d batches, %d changed' % (
+            seconds, len(texts) / seconds, stats['batches'], changed)
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,10 @@
 import os
 import sys
 import codecs
-import urllib
-import urllib2
-import simplejson
 
-from urllib2 import urlopen
-from urllib import urlencode
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'examples', 'LangConv'))
+import langconv
 
 chinese_dict = {
     '操作系统': '作业系统',
@@ -66,41 +64,14 @@ chinese_dict = {
     '光标': '游标',
 }
 
-def get_splits(text, length=4500):
-    '''
-    Translate Api has a limit on length of text(4500 characters) that can be translated at once
-    '''
-    return (text[index:index+length] for index in xrange(0,len(text),length))
-
-# The google translate API can be found here:
-# http://code.google.com/apis/ajaxlanguage/documentation/#Examples
-def translate(text):
-    from_lang = "zh"
-    to_lang = "zh-TW"
-    langpair = '%s|%s' % (from_lang, to_lang)
-
-    # OK, dirty hack, but works. ^_^
-    text = 'OMG!'.join(text.split('\n'))
-
-    base_url = 'http://ajax.googleapis.com/ajax/services/language/translate?'
-    params = {'v': 1.0,
-            'ie': 'UTF8',
-            'q': text,
-            'langpair': langpair}
-
-    new_text = ''
-    for splite in get_splits(text):
-        params['q'] = splite
-        data = urllib.urlencode(params)
-        resp = simplejson.load(urllib.urlopen('%s' % (base_url), data=data))
-
-        try:
-            new_text += resp['responseData']['translatedText']
-        except:
-            pass
-
-    # recover the word
-    return '\n'.join(new_text.split('OMG!'))
+# the vocabulary is written in simplified Chinese; merged over the zh-tw
+# profile, with the replacements converted like the rest of the text, it is
+# applied in the same single pass that converts the file
+langconv.registery('zh-tw-vocabulary',
+                   dict((k.decode('utf-8'),
+                         langconv.convert_text(v.decode('utf-8'), 'zh-tw'))
+                        for k, v in chinese_dict.items()),
+                   'zh-tw')
 
 if len(sys.argv) != 2:
     print 'Please follow by a file name'
@@ -108,10 +79,8 @@ if len(sys.argv) != 2:
 else:
     orignal_data = open(sys.argv[1]).read()
 
-    for k, v in chinese_dict.items():
-        orignal_data = orignal_data.replace(k, v)
-
-    new_data = translate(orignal_data)
+    new_data = langconv.convert_text(orignal_data.decode('utf-8'),
+                                     'zh-tw-vocabulary')
 
     new_path = sys.argv[1] + '.new'
     new_file = codecs.open(new_path, 'w', 'utf-8')
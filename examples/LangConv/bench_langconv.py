@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Conversion speed of the LangConv engines.
+
+The corpus is the text of zh_wiki.py itself, which holds every word of both
+tables in both scripts.  The fsm and trie engines convert it line by line,
+the bulk engine converts it as one buffer, the stream engine in pieces of
+4KB and the parallel engine in chunks spread over a process pool, in both
+directions; the outputs of the engines are compared line by line.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+
+import langconv
+
+def by_line(converter_class):
+    def convert(encoding, lines):
+        c = converter_class(encoding)
+        return [c.convert(line) for line in lines]
+    return convert
+
+def bulk(encoding, lines):
+    return langconv.convert_text(u'\n'.join(lines), encoding).split(u'\n')
+
+def stream(encoding, lines):
+    text = u'\n'.join(lines)
+    pieces = [text[i:i + 4096] for i in xrange(0, len(text), 4096)]
+    return u''.join(langconv.iter_convert(pieces, encoding)).split(u'\n')
+
+def parallel(encoding, lines):
+    file_out = StringIO()
+    langconv.convert_parallel(StringIO(u'\n'.join(lines).encode('utf8')),
+            file_out, encoding, chunk_size=1 << 16)
+    return file_out.getvalue().decode('utf8').split(u'\n')
+
+ENGINES = [('fsm', by_line(langconv.Converter)),
+        ('trie', by_line(langconv.TrieConverter)),
+        ('bulk', bulk),
+        ('stream', stream),
+        ('parallel', parallel)]
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'zh_wiki.py')
+
+def load_corpus(repeat=1):
+    lines = open(CORPUS).read().decode('utf8').splitlines()
+    return lines * repeat
+
+def bench_convert(convert, encoding, lines):
+    start = time.time()
+    output = convert(encoding, lines)
+    return time.time() - start, output
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-r', type='int', dest='repeat', default=1,
+            help='convert the corpus this many times')
+    parser.add_option('-e', type='string', dest='engines',
+            default=','.join([name for name, _ in ENGINES]),
+            help='comma separated engines to run')
+    (options, args) = parser.parse_args()
+    engines = [(name, convert) for name, convert in ENGINES
+            if name in options.engines.split(',')]
+
+    lines = load_corpus(options.repeat)
+    chars = sum([len(line) for line in lines])
+    print 'corpus: %d lines, %d chars' % (len(lines), chars)
+    for encoding in ('zh-hant', 'zh-hans'):
+        outputs = []
+        for name, convert in engines:
+            seconds, output = bench_convert(convert, encoding, lines)
+            outputs.append((name, output))
+            print '%-8s %-8s %8.3fs %12.0f chars/s' % (encoding, name,
+                    seconds, chars / seconds)
+        base_name, base = outputs[0]
+        for name, output in outputs[1:]:
+            differ = len([1 for a, b in zip(base, output) if a != b])
+            print '%-8s %s vs %s: %d lines differ' % (encoding, name,
+                    base_name, differ)
+            if differ:
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
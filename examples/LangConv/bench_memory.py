@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Memory and lookup speed of ConvertMap.
+
+The size of a map is the sum of sys.getsizeof over every object reachable
+from its table, each object counted once, the keys included.  It is
+compared with the former layout, a dict from every key and prefix to an
+(is_tail, have_child, to_word) tuple, built here the way ConvertMap used to.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+import langconv
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (tuple, list)):
+        for v in obj:
+            size += deep_size(v, seen)
+    return size
+
+def tuple_map(mapping):
+    have_child = {}
+    for key in mapping:
+        for i in range(1, len(key)):
+            have_child[key[:i]] = True
+        have_child.setdefault(key, False)
+    return dict([(key, (key in mapping, have_child[key],
+            mapping.get(key, ''))) for key in have_child])
+
+def bench_lookup(lookup, keys, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        for k in keys:
+            lookup(k)
+    return len(keys) * repeat / (time.time() - start)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-r', type='int', dest='repeat', default=20,
+            help='look every key up this many times')
+    (options, args) = parser.parse_args()
+
+    for encoding in sorted(langconv.TABLES):
+        mapping = langconv.table_mapping(encoding)
+        old = tuple_map(mapping)
+        start = time.time()
+        cm = langconv.ConvertMap(encoding, mapping)
+        build = time.time() - start
+        old_size = deep_size(old)
+        new_size = deep_size((cm._map, cm._targets))
+        print '%-8s %d entries, %d targets, built in %.1fms' % (encoding,
+                len(cm), len(cm._targets), build * 1000)
+        print '%-8s tuples  %8.0fKB' % (encoding, old_size / 1024.0)
+        print '%-8s compact %8.0fKB (%.0f%% less)' % (encoding,
+                new_size / 1024.0, 100.0 * (old_size - new_size) / old_size)
+        # the lookups of the state machine: words, prefixes and misses
+        keys = cm._map.keys() + [k + u'\uffff' for k in cm._map.keys()]
+        for name, lookup in (('getitem', cm.__getitem__),
+                ('entry', cm.entry)):
+            print '%-8s %-7s %8.0f lookups/s' % (encoding, name,
+                    bench_lookup(lookup, keys, options.repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Start-up cost of short LangConv invocations.
+
+Every run is a new interpreter that imports langconv and converts one short
+string, once with the maps built from zh_wiki.py and once with the maps
+loaded from compiled files.  The compiled files are written to a temporary
+directory given to langconv through LANGCONV_TABLES.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import langconv
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = '''
+import langconv
+assert langconv.convert_text(u'\\u5934\\u53d1', %r) == %r
+'''
+
+def bench_startup(encoding, tables_dir, runs):
+    expected = langconv.convert_text(u'头发', encoding)
+    env = dict(os.environ)
+    env['LANGCONV_TABLES'] = tables_dir
+    command = [sys.executable, '-c', SCRIPT % (encoding, expected)]
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call(command, cwd=HERE, env=env)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', type='int', dest='runs', default=20,
+            help='interpreter runs per case')
+    (options, args) = parser.parse_args()
+
+    # the baseline: a bare interpreter
+    start = time.time()
+    for i in range(options.runs):
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+    bare = (time.time() - start) / options.runs
+    print 'python -c pass          %7.1fms' % (bare * 1000)
+
+    source_dir = tempfile.mkdtemp()
+    compiled_dir = tempfile.mkdtemp()
+    try:
+        langconv.TABLES_DIR = compiled_dir
+        for name in sorted(langconv.TABLES):
+            langconv.compile_map(name)
+        for encoding in ('zh-hans', 'zh-hant'):
+            for label, tables_dir in (('source', source_dir),
+                    ('compiled', compiled_dir)):
+                seconds = bench_startup(encoding, tables_dir, options.runs)
+                print '%-8s %-14s %7.1fms (%.1fms over bare python)' % (
+                        encoding, label, seconds * 1000,
+                        (seconds - bare) * 1000)
+    finally:
+        shutil.rmtree(source_dir)
+        shutil.rmtree(compiled_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark and regression suite of the LangConv engines.
+
+The corpus is generated: lines of words of the zh_wiki.py tables in both
+scripts, mixed with punctuation and ASCII, drawn with a fixed seed, so that
+every run and every machine gets the same text without shipping megabytes
+of it.  Every engine of bench_langconv converts it in every direction, each
+in a fresh process, which reports:
+
+  chars/s    conversion speed
+  peak RSS   ru_maxrss of that process
+  build      time to build the map from zh_wiki.py
+  load       time to load the map from a compiled file
+
+The SHA-1 of every output is compared with bench_golden.txt, so an
+optimization cannot change results unnoticed.  After an intended change of
+the output, run with -u to rewrite the golden checksums.
+
+The checksums are kept per engine: the fsm engine chooses the segmentation
+with the fewest words, the others the leftmost longest word, as MediaWiki
+does with these tables, and on rare input (吊好家夥 to zh-hant) the two
+differ.
+"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import bench_langconv
+import langconv
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GOLDEN = os.path.join(HERE, 'bench_golden.txt')
+
+SEED = 1
+CHARS = 2000000
+ENCODINGS = ['zh-hant', 'zh-hans']
+
+PUNCTUATION = u'，。、；：？！「」（）…'
+ASCII = [u' ', u' ', u'Linux', u'2009', u'%s', u'<b>', u'</b>',
+        u'http://example.com/', u'GNOME 2.26']
+
+def make_corpus(chars=CHARS, seed=SEED):
+    import zh_wiki
+    words = set()
+    for table in (zh_wiki.zh2Hant, zh_wiki.zh2Hans):
+        words.update(table)
+        words.update(table.values())
+    words = sorted(words)
+    rng = random.Random(seed)
+    lines = []
+    n = 0
+    while n < chars:
+        parts = []
+        for i in range(rng.randint(5, 40)):
+            r = rng.random()
+            if r < 0.75:
+                parts.append(rng.choice(words))
+            elif r < 0.9:
+                parts.append(rng.choice(PUNCTUATION))
+            else:
+                parts.append(rng.choice(ASCII))
+        line = u''.join(parts)
+        lines.append(line)
+        n += len(line) + 1
+    return u'\n'.join(lines)
+
+def load_golden():
+    golden = {}
+    if os.path.exists(GOLDEN):
+        for line in open(GOLDEN):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                seed, chars, encoding, engine, digest = line.split()
+                golden[(int(seed), int(chars), encoding, engine)] = digest
+    return golden
+
+def save_golden(golden):
+    f = open(GOLDEN, 'w')
+    f.write('# seed chars encoding engine sha1, written by '
+            'bench_suite.py -u\n')
+    for (seed, chars, encoding, engine), digest in sorted(golden.items()):
+        f.write('%d %d %s %s %s\n' % (seed, chars, encoding, engine, digest))
+    f.close()
+
+def worker(engine, encoding, corpus_path):
+    """Run one engine in one direction, print the results as JSON."""
+    convert = dict(bench_langconv.ENGINES)[engine]
+    lines = open(corpus_path, 'rb').read().decode('utf8').split(u'\n')
+    chars = sum([len(line) for line in lines])
+    start = time.time()
+    output = convert(encoding, lines)
+    seconds = time.time() - start
+    digest = sha1(u'\n'.join(output).encode('utf8')).hexdigest()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # after the conversion, so the extra maps do not count in the RSS
+    start = time.time()
+    langconv.build_map(encoding)
+    build = time.time() - start
+    langconv.TABLES_DIR = tempfile.mkdtemp()
+    try:
+        langconv.compile_map(encoding)
+        start = time.time()
+        langconv.load_map(encoding)
+        load = time.time() - start
+    finally:
+        shutil.rmtree(langconv.TABLES_DIR)
+    print json.dumps({'seconds': seconds, 'chars': chars, 'sha1': digest,
+            'maxrss': maxrss, 'build': build, 'load': load})
+
+def run_worker(engine, encoding, corpus_path):
+    # LANGCONV_TABLES: no compiled maps, every process builds its own
+    empty = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['LANGCONV_TABLES'] = empty
+    try:
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                '--worker', engine, encoding, corpus_path],
+                stdout=subprocess.PIPE, cwd=HERE, env=env)
+        output = p.communicate()[0]
+    finally:
+        shutil.rmtree(empty)
+    if p.returncode:
+        raise RuntimeError('%s %s failed' % (engine, encoding))
+    return json.loads(output)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', type='int', dest='chars', default=CHARS,
+            help='corpus size in characters')
+    parser.add_option('-s', type='int', dest='seed', default=SEED,
+            help='seed of the corpus')
+    parser.add_option('-e', type='string', dest='engines',
+            default=','.join([name for name, _ in bench_langconv.ENGINES]),
+            help='comma separated engines to run')
+    parser.add_option('-d', type='string', dest='encodings',
+            default=','.join(ENCODINGS),
+            help='comma separated directions to run')
+    parser.add_option('-u', action='store_true', dest='update',
+            default=False, help='write the checksums to the golden file')
+    parser.add_option('--worker', action='store_true', dest='worker',
+            default=False, help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    if options.worker:
+        worker(*args)
+        return
+
+    corpus = make_corpus(options.chars, options.seed)
+    (fd, corpus_path) = tempfile.mkstemp(suffix='.txt')
+    os.write(fd, corpus.encode('utf8'))
+    os.close(fd)
+    print 'corpus: seed %d, %d chars, %d lines, %.1fMB' % (options.seed,
+            len(corpus), corpus.count(u'\n') + 1,
+            len(corpus.encode('utf8')) / 1048576.0)
+    print '%-8s %-8s %12s %10s %9s %8s  %s' % ('encoding', 'engine',
+            'chars/s', 'peak RSS', 'build', 'load', 'checksum')
+
+    golden = load_golden()
+    failed = 0
+    try:
+        for encoding in options.encodings.split(','):
+            for engine in options.engines.split(','):
+                key = (options.seed, options.chars, encoding, engine)
+                result = run_worker(engine, encoding, corpus_path)
+                if options.update:
+                    golden[key] = result['sha1']
+                if key not in golden:
+                    check = 'no golden'
+                elif golden[key] == result['sha1']:
+                    check = 'ok'
+                else:
+                    check = 'DIFFERS ' + result['sha1']
+                    failed += 1
+                print '%-8s %-8s %12.0f %8.1fMB %7.1fms %6.1fms  %s' % (
+                        encoding, engine,
+                        result['chars'] / result['seconds'],
+                        result['maxrss'] / 1024.0, result['build'] * 1000,
+                        result['load'] * 1000, check)
+    finally:
+        os.remove(corpus_path)
+    if options.update:
+        save_golden(golden)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
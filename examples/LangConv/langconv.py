@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import codecs
+from collections import deque
 from copy import deepcopy
+import marshal
+import mmap
+import multiprocessing
+import os
 import re
+import threading
 
 try:
     import psyco
@@ -10,30 +17,70 @@ try:
 except:
     pass
 
-from zh_wiki import zh2Hant, zh2Hans
-
 # states
 (START, END, FAIL, WAIT_TAIL) = range(4)
 # conditions
 (TAIL, ERROR, MATCHED_SWITCH, UNMATCHED_SWITCH, CONNECTOR) = range(5)
 
-MAPS = {}
+# bytes of input converted at a time by convert_file
+CHUNK_SIZE = 1 << 20
+# default capacity of a ConvertCache and the longest string it keeps
+CACHE_SIZE = 10000
+CACHE_MAX_LENGTH = 256
+
+# spans that convert_text(..., protect=PROTECT) copies through untouched,
+# tried in this order; none of them may match an empty string
+PROTECTED_SPANS = [
+    ('fenced code', u'```.*?```'),
+    ('code', u'`[^`\n]+`'),
+    ('url', u'(?:https?|ftp)://'
+            u'[^\\s<>"\'\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]+'),
+    ('tag', u'<[A-Za-z/!?][^<>]*>'),
+    ('printf', u'%(?:\\([^()\n]*\\))?[-#0 +]*(?:\\d+|\\*)?'
+            u'(?:\\.(?:\\d+|\\*))?[hlL]?[diouxXeEfFgGcrs%]'),
+    ('shell', u'\\$\\{[^{}\n]*\\}|\\$[A-Za-z_]\\w*'),
+    ('format', u'\\{[^{}\\s]*\\}'),
+]
+PROTECT = u'|'.join([pattern for name, pattern in PROTECTED_SPANS])
+
+# built-in maps: name -> dict in zh_wiki.py, or for a regional profile
+# (base dict, regional phrases, dict from the script of the regional
+# phrases to the other script), see compose_profile()
+TABLES = {'zh-hant': 'zh2Hant', 'zh-hans': 'zh2Hans',
+        'zh-tw': ('zh2Hant', 'zh2TW', 'zh2Hans'),
+        'zh-hk': ('zh2Hant', 'zh2HK', 'zh2Hans'),
+        'zh-cn': ('zh2Hans', 'zh2CN', 'zh2Hant'),
+        'zh-sg': ('zh2Hans', 'zh2SG', 'zh2Hant')}
+TABLES_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'zh_wiki.py')
+# where compiled maps are written and looked for
+TABLES_DIR = os.environ.get('LANGCONV_TABLES',
+        os.path.dirname(os.path.abspath(__file__)))
+# bump when the layout of ConvertMap.dump() changes
+COMPILED_VERSION = 2
+
+class Node(object):
+    __slots__ = ('from_word', 'to_word', 'target', 'is_tail', 'have_child',
+            'is_original')
 
-class Node:
     def __init__(self, from_word, to_word=None, is_tail=True,
             have_child=False):
         self.from_word = from_word
         if to_word is None:
             self.to_word = from_word
-            self.data = (is_tail, have_child, from_word)
+            self.target = from_word
             self.is_original = True
         else:
             self.to_word = to_word or from_word
-            self.data = (is_tail, have_child, to_word)
+            self.target = to_word
             self.is_original = False
         self.is_tail = is_tail
         self.have_child = have_child
 
+    @property
+    def data(self):
+        return (self.is_tail, self.have_child, self.target)
+
     def is_original_long_word(self):
         return self.is_original and len(self.from_word)>1
 
@@ -46,15 +93,31 @@ class Node:
 
     __repr__ = __str__
 
+# flag bits of a packed ConvertMap entry, the rest is the target index
+IS_TAIL, HAVE_CHILD = 2, 1
+
 class ConvertMap:
+    """Words and all their prefixes of a mapping.
+
+    Every entry is packed into one int: the flags IS_TAIL and HAVE_CHILD
+    and, above them, the index of the converted word in _targets, where
+    each distinct word is stored once.  Prefixes that are not words
+    themselves all share the small int HAVE_CHILD.
+    """
     def __init__(self, name, mapping=None):
         self.name = name
         self._map = {}
+        self._targets = (u'',)
+        self._trie = None
+        self._scanner = None
+        self.max_key_length = 0
         if mapping:
             self.set_convert_map(mapping)
 
     def set_convert_map(self, mapping):
         convert_map = {}
+        targets = [u'']
+        target_index = {u'': 0}
         have_child = {}
         max_key_length = 0
         for key in sorted(mapping.keys()):
@@ -65,17 +128,69 @@ class ConvertMap:
             have_child[key] = False
             max_key_length = max(max_key_length, len(key))
         for key in sorted(have_child.keys()):
-            convert_map[key] = (key in mapping, have_child[key],
-                    mapping.get(key, ''))
+            code = have_child[key] and HAVE_CHILD or 0
+            if key in mapping:
+                to_word = mapping[key]
+                index = target_index.get(to_word)
+                if index is None:
+                    index = target_index[to_word] = len(targets)
+                    targets.append(to_word)
+                code |= IS_TAIL | index << 2
+            convert_map[key] = code
         self._map = convert_map
+        self._targets = tuple(targets)
+        self._trie = None
+        self._scanner = None
         self.max_key_length = max_key_length
 
+    def get_trie(self):
+        if self._trie is None:
+            self._trie = Trie(self)
+        return self._trie
+
+    def get_scanner(self):
+        if self._scanner is None:
+            self._scanner = Scanner(self)
+        return self._scanner
+
+    def dump(self):
+        """Return the compiled map, trie and scanner tables as plain data
+        that marshal can store."""
+        scanner = self.get_scanner()
+        return {'map': self._map, 'targets': self._targets,
+                'max_key_length': self.max_key_length,
+                'trie': self.get_trie().root, 'table': scanner.table,
+                'starts': scanner.starts}
+
+    def load(self, data):
+        """Restore what dump() returned, without rebuilding anything."""
+        self._map = data['map']
+        self._targets = data['targets']
+        self.max_key_length = data['max_key_length']
+        self._trie = Trie(self, data['trie'])
+        self._scanner = Scanner(self, data['table'], data['starts'])
+
+    def entry(self, k):
+        """Return (is_tail, have_child, to_word) of k, or None."""
+        code = self._map.get(k)
+        if code is None:
+            return None
+        return (bool(code & IS_TAIL), bool(code & HAVE_CHILD),
+                self._targets[code >> 2])
+
+    def iter_entries(self):
+        """Yield (key, is_tail, have_child, to_word) of every entry."""
+        targets = self._targets
+        for key, code in self._map.iteritems():
+            yield (key, bool(code & IS_TAIL), bool(code & HAVE_CHILD),
+                    targets[code >> 2])
+
     def __getitem__(self, k):
-        try:
-            is_tail, have_child, to_word  = self._map[k]
-            return Node(k, to_word, is_tail, have_child)
-        except:
+        code = self._map.get(k)
+        if code is None:
             return Node(k)
+        return Node(k, self._targets[code >> 2], bool(code & IS_TAIL),
+                bool(code & HAVE_CHILD))
 
     def __contains__(self, k):
         return k in self._map
@@ -83,6 +198,249 @@ class ConvertMap:
     def __len__(self):
         return len(self._map)
 
+class Trie:
+    """Character trie over the words of a ConvertMap.
+
+    Every node is a dict from the next character to the child node; a node
+    that ends a word also stores the converted word under the key None.
+    """
+    def __init__(self, convert_map, root=None):
+        if root is not None:
+            self.root = root
+            return
+        self.root = root = {}
+        for key, is_tail, have_child, to_word in convert_map.iter_entries():
+            if not is_tail:
+                continue
+            node = root
+            for char in key:
+                child = node.get(char)
+                if child is None:
+                    child = node[char] = {}
+                node = child
+            node[None] = to_word or key
+
+    def longest_match(self, string, start=0, end=None):
+        """Return (length, to_word) of the longest word at string[start:],
+        or (0, None) if no word starts there."""
+        if end is None:
+            end = len(string)
+        node = self.root
+        length, to_word = 0, None
+        i = start
+        while i < end:
+            node = node.get(string[i])
+            if node is None:
+                break
+            i += 1
+            if None in node:
+                length, to_word = i - start, node[None]
+        return length, to_word
+
+    def is_open_prefix(self, string):
+        """True if some longer word starts with string."""
+        node = self.root
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                return False
+        return len(node) > (None in node)
+
+    def convert(self, string):
+        out = []
+        append = out.append
+        longest_match = self.longest_match
+        i, n = 0, len(string)
+        while i < n:
+            length, to_word = longest_match(string, i, n)
+            if length:
+                append(to_word)
+                i += length
+            else:
+                append(string[i])
+                i += 1
+        return u''.join(out)
+
+class Scanner:
+    """Single pass leftmost-longest converter for whole buffers.
+
+    Most characters cannot start a word longer than one character; runs of
+    those are converted with unicode.translate.  A precompiled character
+    class finds the next character that can start a longer word, and only
+    there the trie is walked for the longest match.
+    """
+    def __init__(self, convert_map, table=None, starts=None):
+        self.trie = convert_map.get_trie()
+        if table is None:
+            table = {}
+            starts = []
+            for key, is_tail, have_child, to_word in \
+                    convert_map.iter_entries():
+                if len(key) != 1:
+                    continue
+                if have_child:
+                    starts.append(key)
+                elif is_tail:
+                    table[ord(key)] = to_word or key
+            starts.sort()
+        self.table = table
+        self.starts = starts
+        if starts:
+            self.start_class = u'[%s]' % u''.join(
+                [re.escape(c) for c in starts])
+            self.start_re = re.compile(self.start_class)
+        else:
+            self.start_class = None
+            self.start_re = None
+        self._protect_res = {}
+
+    def _protect_re(self, protect):
+        # (protected span or start of a longer word, protected span)
+        regexes = self._protect_res.get(protect)
+        if regexes is None:
+            if self.start_class:
+                pattern = u'(%s)|%s' % (protect, self.start_class)
+            else:
+                pattern = u'(%s)' % protect
+            regexes = self._protect_res[protect] = (
+                    re.compile(pattern, re.DOTALL),
+                    re.compile(protect, re.DOTALL))
+        return regexes
+
+    def convert(self, text, protect=None):
+        return self.scan(text, protect=protect)[0]
+
+    def scan(self, text, stop=None, protect=None):
+        """Convert the words of text that start before stop.  Return the
+        converted text and the position where conversion stopped, which
+        is stop or the end of the last word, if that reaches beyond.
+
+        protect is a regular expression of spans to copy through as they
+        are, like PROTECT.  They are found by the same search that finds
+        the words, and no word may reach into one.
+        """
+        table = self.table
+        n = len(text)
+        if stop is None or stop > n:
+            stop = n
+        if protect is not None:
+            search, protect_search = self._protect_re(protect)
+            search = search.search
+            protect_search = protect_search.search
+        elif self.start_re is None:
+            return text[:stop].translate(table), stop
+        else:
+            search = self.start_re.search
+        out = []
+        append = out.append
+        longest_match = self.trie.longest_match
+        span_start = -1
+        pos = 0
+        while pos < stop:
+            m = search(text, pos, stop)
+            if m is None:
+                append(text[pos:stop].translate(table))
+                pos = stop
+                break
+            i = m.start()
+            if i > pos:
+                append(text[pos:i].translate(table))
+            if protect is not None:
+                if m.group(1) is not None:
+                    append(m.group(1))
+                    pos = m.end()
+                    continue
+                length, to_word = longest_match(text, i, n)
+                if length > 1:
+                    # a span may start inside the word and end after it;
+                    # the first span after i is kept until i passes it
+                    if span_start <= i:
+                        span = protect_search(text, i + 1, n)
+                        if span is None:
+                            span_start = n
+                        else:
+                            span_start = span.start()
+                    if span_start < i + length:
+                        length, to_word = longest_match(text, i,
+                                span_start)
+            else:
+                length, to_word = longest_match(text, i, n)
+            if length:
+                append(to_word)
+                pos = i + length
+            else:
+                append(text[i])
+                pos = i + 1
+        return u''.join(out), pos
+
+class StreamConverter:
+    """Incremental converter for text that comes in pieces.
+
+    convert() returns the text that is final as soon as it is final: only
+    the characters that may still be the start of a word longer than what
+    has been seen are held back, never more than max_key_length - 1.
+    """
+    def __init__(self, to_encoding):
+        self.to_encoding = to_encoding
+        cm = MAPS[to_encoding]
+        self.scanner = cm.get_scanner()
+        self.window = max(cm.max_key_length, 1)
+        self.pending = u''
+
+    def convert(self, text):
+        text = self.pending + text
+        # words starting before stop have all their characters in text
+        stop = len(text) - self.window + 1
+        if stop <= 0:
+            self.pending = text
+            return u''
+        converted, pos = self.scanner.scan(text, stop)
+        self.pending = text[pos:]
+        return converted
+
+    def end(self):
+        """Convert what is held back; the stream starts over."""
+        converted = self.scanner.convert(self.pending)
+        self.pending = u''
+        return converted
+
+class ConvertWriter:
+    """File-like object that converts what is written to it and passes it
+    on to file_out, encoded with charset if one is given.
+
+    close() writes the held back characters and flushes file_out but does
+    not close it.
+    """
+    def __init__(self, file_out, to_encoding, charset=None):
+        self.file_out = file_out
+        self.charset = charset
+        self.stream = StreamConverter(to_encoding)
+        self.closed = False
+
+    def _write(self, text):
+        if text:
+            if self.charset:
+                text = text.encode(self.charset)
+            self.file_out.write(text)
+
+    def write(self, text):
+        if self.closed:
+            raise ValueError('I/O operation on closed ConvertWriter')
+        self._write(self.stream.convert(text))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.file_out.flush()
+
+    def close(self):
+        if not self.closed:
+            self._write(self.stream.end())
+            self.closed = True
+            self.flush()
+
 class StatesMachineException(Exception): pass
 
 class StatesMachine:
@@ -168,6 +526,10 @@ class Converter:
         self.start()
 
     def feed(self, char):
+        self._feed(char)
+        return self.get_result()
+
+    def _feed(self, char):
         branches = []
         for fsm in self.machines:
             new = fsm.feed(char, self.map)
@@ -182,17 +544,16 @@ class Converter:
                 all_ok = False
         if all_ok:
             self._clean()
-        return self.get_result()
 
     def _clean(self):
         if len(self.machines):
             self.machines.sort(cmp=lambda x,y: cmp(len(x), len(y)))
-            self.final += self.machines[0].final
+            self.parts.append(self.machines[0].final)
         self.machines = [StatesMachine()]
 
     def start(self):
         self.machines = [StatesMachine()]
-        self.final = u''
+        self.parts = []
 
     def end(self):
         self.machines = [fsm for fsm in self.machines
@@ -202,20 +563,479 @@ class Converter:
     def convert(self, string):
         self.start()
         for char in string:
-            self.feed(char)
+            self._feed(char)
         self.end()
         return self.get_result()
 
     def get_result(self):
-        return self.final
+        result = u''.join(self.parts)
+        self.parts = [result]
+        return result
 
-def registery(name, mapping):
-    global MAPS
-    MAPS[name] = ConvertMap(name, mapping)
+class TrieConverter:
+    """Greedy longest-match converter with the interface of Converter.
 
-registery('zh-hant', zh2Hant)
-registery('zh-hans', zh2Hans)
-del zh2Hant, zh2Hans
+    Instead of forking state machines it walks the trie of the map, so the
+    cost is linear in the input times the longest word.  Output is held
+    back only while the pending characters can still grow into a longer
+    word.  It takes the leftmost longest word where Converter takes the
+    segmentation with the fewest words, so on rare input (u'吊好家夥' to
+    zh-hant) the two give different output.
+    """
+    def __init__(self, to_encoding):
+        self.to_encoding = to_encoding
+        self.map = MAPS[to_encoding]
+        self.trie = self.map.get_trie()
+        self.start()
+
+    def start(self):
+        self.pending = u''
+        self.parts = []
+
+    def _emit(self):
+        # convert the longest word at the start of pending
+        length, to_word = self.trie.longest_match(self.pending)
+        if length:
+            self.parts.append(to_word)
+        else:
+            length = 1
+            self.parts.append(self.pending[0])
+        self.pending = self.pending[length:]
+
+    def feed(self, char):
+        if not char:
+            # an empty feed is a word boundary
+            self.end()
+            return self.get_result()
+        self.pending += char
+        while self.pending and not self.trie.is_open_prefix(self.pending):
+            self._emit()
+        return self.get_result()
+
+    def end(self):
+        while self.pending:
+            self._emit()
+
+    def convert(self, string):
+        self.start()
+        self.parts.append(self.trie.convert(string))
+        return self.get_result()
+
+    def get_result(self):
+        result = u''.join(self.parts)
+        self.parts = [result]
+        return result
+
+def convert_text(text, to_encoding, protect=None):
+    """Convert a whole unicode buffer in one pass, leaving the spans that
+    match protect, if given, as they are."""
+    return MAPS[to_encoding].get_scanner().convert(text, protect)
+
+class ConvertCache:
+    """LRU memoization of conversions, keyed by (encoding, text).
+
+    Meant for the same short strings converted over and over, like menu
+    labels or msgids; strings longer than max_length are converted but not
+    kept.  convert is the function doing the actual work, convert_text by
+    default.  The recently used order is a circular doubly linked list of
+    [prev, next, key, result] links, so a hit costs a dict lookup and a
+    few list stores.
+    """
+    def __init__(self, size=CACHE_SIZE, max_length=CACHE_MAX_LENGTH,
+            convert=None):
+        self.size = size
+        self.max_length = max_length
+        self._convert = convert or convert_text
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self._root = root = []
+            root[:] = [root, root, None, None]
+            self.hits = self.misses = self.uncached = 0
+        finally:
+            self._lock.release()
+
+    def convert(self, text, to_encoding):
+        if len(text) > self.max_length:
+            self.uncached += 1
+            return self._convert(text, to_encoding)
+        key = (to_encoding, text)
+        self._lock.acquire()
+        try:
+            link = self._entries.get(key)
+            if link is not None:
+                # move to the most recently used end
+                link_prev, link_next, _, result = link
+                link_prev[1] = link_next
+                link_next[0] = link_prev
+                root = self._root
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+                self.hits += 1
+                return result
+            self.misses += 1
+        finally:
+            self._lock.release()
+        # convert outside the lock, other threads go on
+        result = self._convert(text, to_encoding)
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                root = self._root
+                last = root[0]
+                link = [last, root, key, result]
+                last[1] = root[0] = self._entries[key] = link
+                if len(self._entries) > self.size:
+                    oldest = root[1]
+                    root[1] = oldest[1]
+                    oldest[1][0] = root
+                    del self._entries[oldest[2]]
+        finally:
+            self._lock.release()
+        return result
+
+    def convert_batch(self, texts, to_encoding):
+        """Convert a list of strings, each distinct string once."""
+        done = {}
+        results = []
+        for text in texts:
+            result = done.get(text)
+            if result is None:
+                result = done[text] = self.convert(text, to_encoding)
+            results.append(result)
+        return results
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': self.size, 'entries': len(self._entries),
+                'hits': self.hits, 'misses': self.misses,
+                'uncached': self.uncached,
+                'hit_rate': lookups and 100.0 * self.hits / lookups or 0.0}
+
+def iter_convert(pieces, to_encoding):
+    """Convert an iterable of unicode strings, yielding converted text as
+    soon as it is final."""
+    stream = StreamConverter(to_encoding)
+    for piece in pieces:
+        converted = stream.convert(piece)
+        if converted:
+            yield converted
+    converted = stream.end()
+    if converted:
+        yield converted
+
+def iter_chunks(file_in, chunk_size=CHUNK_SIZE):
+    """Yield the bytes of file_in in chunks of about chunk_size that end
+    at a newline, so no word is split between two chunks.  Regular files
+    are memory-mapped."""
+    try:
+        data = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # pipes, empty files, file-like objects
+        data = None
+    if data is None:
+        while True:
+            chunk = file_in.read(chunk_size)
+            if not chunk:
+                break
+            if not chunk.endswith('\n'):
+                chunk += file_in.readline()
+            yield chunk
+        return
+    try:
+        pos, size = 0, len(data)
+        while pos < size:
+            end = min(pos + chunk_size, size)
+            if end < size:
+                newline = data.rfind('\n', pos, end)
+                if newline == -1:
+                    newline = data.find('\n', end)
+                if newline == -1:
+                    end = size
+                else:
+                    end = newline + 1
+            yield data[pos:end]
+            pos = end
+    finally:
+        data.close()
+
+def convert_file(file_in, file_out, to_encoding, chunk_size=CHUNK_SIZE,
+        charset='utf8', protect=None):
+    """Convert file_in to file_out chunk by chunk, in constant memory.
+    Protected spans must not cross a newline where a chunk may end."""
+    scanner = MAPS[to_encoding].get_scanner()
+    for chunk in iter_chunks(file_in, chunk_size):
+        file_out.write(scanner.convert(chunk.decode(charset),
+                protect).encode(charset))
+
+def convert_stream(file_in, file_out, to_encoding, charset='utf8',
+        bufsize=65536):
+    """Convert file_in to file_out as the data comes in, so that it can sit
+    in a pipe: whatever read returns is converted and flushed at once."""
+    try:
+        fd = file_in.fileno()
+        read = lambda: os.read(fd, bufsize)
+    except (AttributeError, EnvironmentError):
+        read = lambda: file_in.read(bufsize)
+    decoder = codecs.getincrementaldecoder(charset)()
+    writer = ConvertWriter(file_out, to_encoding, charset)
+    while True:
+        data = read()
+        if not data:
+            break
+        writer.write(decoder.decode(data))
+        writer.flush()
+    writer.write(decoder.decode('', True))
+    writer.close()
+
+def _init_worker(to_encoding):
+    # forked workers inherit the map loaded by the parent, others load it
+    MAPS[to_encoding].get_scanner()
+
+def _convert_chunk(to_encoding, chunk, charset):
+    return convert_text(chunk.decode(charset), to_encoding).encode(charset)
+
+def _convert_path(args):
+    to_encoding, path_in, path_out, charset = args
+    file_in = open(path_in, 'rb')
+    try:
+        file_out = open(path_out, 'wb')
+        try:
+            convert_file(file_in, file_out, to_encoding, charset=charset)
+        finally:
+            file_out.close()
+    finally:
+        file_in.close()
+    return path_out
+
+def _start_pool(to_encoding, processes):
+    # load the map before forking, so all workers share one copy
+    MAPS[to_encoding].get_scanner()
+    return multiprocessing.Pool(processes, _init_worker, (to_encoding,))
+
+def convert_parallel(file_in, file_out, to_encoding, processes=None,
+        chunk_size=CHUNK_SIZE, charset='utf8'):
+    """Like convert_file, but the chunks are converted by a pool of
+    processes (one per CPU by default).  The output keeps the order of the
+    input and at most two chunks per process are in memory."""
+    processes = processes or multiprocessing.cpu_count()
+    pool = _start_pool(to_encoding, processes)
+    try:
+        pending = deque()
+        for chunk in iter_chunks(file_in, chunk_size):
+            pending.append(pool.apply_async(_convert_chunk,
+                    (to_encoding, chunk, charset)))
+            if len(pending) >= 2 * processes:
+                file_out.write(pending.popleft().get())
+        while pending:
+            file_out.write(pending.popleft().get())
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+def convert_tree(dir_in, dir_out, to_encoding, processes=None,
+        charset='utf8'):
+    """Convert every file below dir_in to the same path below dir_out,
+    one file per process at a time.  Return the number of files."""
+    tasks = []
+    for root, dirs, files in os.walk(dir_in):
+        out = os.path.join(dir_out, os.path.relpath(root, dir_in))
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        for name in sorted(files):
+            tasks.append((to_encoding, os.path.join(root, name),
+                    os.path.join(out, name), charset))
+    pool = _start_pool(to_encoding, processes)
+    try:
+        for path_out in pool.imap_unordered(_convert_path, tasks):
+            pass
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return len(tasks)
+
+def registery(name, mapping, base=None):
+    MAPS.register(name, mapping, base)
+
+def compiled_path(name):
+    return os.path.join(TABLES_DIR, '%s.map' % name)
+
+def source_mtime():
+    return int(os.stat(TABLES_SOURCE).st_mtime)
+
+def compose_profile(base, regional, other):
+    """Merge a base character map and a regional phrase table into one
+    mapping that converts in a single pass what converting with base and
+    then with regional would give.
+
+    The converted words of base go through regional too, and every
+    regional phrase is also added under its key in the other script, so it
+    matches input that is not yet converted.  Regional phrases win over the
+    base on equal keys.
+    """
+    regional_scanner = ConvertMap('regional', regional).get_scanner()
+    other_scanner = ConvertMap('other', other).get_scanner()
+    mapping = {}
+    for key, to_word in base.iteritems():
+        mapping[key] = regional_scanner.convert(to_word)
+    for key, to_word in regional.iteritems():
+        mapping[other_scanner.convert(key)] = to_word
+    mapping.update(regional)
+    return mapping
+
+def table_mapping(name):
+    """Return the dict of a built-in map, from zh_wiki.py."""
+    import zh_wiki
+    table = TABLES[name]
+    if isinstance(table, tuple):
+        return compose_profile(*[getattr(zh_wiki, t) for t in table])
+    return getattr(zh_wiki, table)
+
+def build_map(name):
+    """Build a built-in map from the dicts in zh_wiki.py."""
+    return ConvertMap(name, table_mapping(name))
+
+def compile_map(name):
+    """Build a built-in map and write it to compiled_path(name).  The file
+    records the mtime of zh_wiki.py, like a .pyc, so a changed table is
+    not loaded stale."""
+    path = compiled_path(name)
+    data = marshal.dumps((COMPILED_VERSION, source_mtime(),
+            build_map(name).dump()))
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    return path
+
+def load_map(name):
+    """Load a built-in map from its compiled file if that is up to date,
+    otherwise build it from zh_wiki.py."""
+    try:
+        f = open(compiled_path(name), 'rb')
+        try:
+            version, mtime, data = marshal.load(f)
+        finally:
+            f.close()
+        if version == COMPILED_VERSION and mtime == source_mtime():
+            cm = ConvertMap(name)
+            cm.load(data)
+            return cm
+    except (EnvironmentError, EOFError, ValueError, TypeError):
+        pass
+    return build_map(name)
+
+class MapRegistry:
+    """ConvertMaps by name, built or loaded on first lookup.
+
+    The built-in maps of TABLES and the mappings given to register() cost
+    nothing until a converter for them is created.  A map registered with
+    a mapping hides a built-in map of the same name.
+
+    A mapping registered with a base is an overlay: it is merged over the
+    mapping of the base map, itself maybe an overlay, and compiled into
+    one map.  Its phrases then take part in the same longest-match scan as
+    the words of the base, and win over a base word with the same key.
+    """
+    def __init__(self):
+        self._maps = {}
+        # name -> (mapping, base)
+        self._specs = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, mapping, base=None):
+        self._lock.acquire()
+        try:
+            if base is not None and name in self._chain(base):
+                raise ValueError('%s cannot be an overlay of itself' % name)
+            self._drop(name)
+            self._specs[name] = (mapping, base)
+        finally:
+            self._lock.release()
+
+    def unregister(self, name):
+        """Drop a map, and the loaded overlays on it, to free memory.  A
+        built-in map is loaded again on its next lookup."""
+        self._lock.acquire()
+        try:
+            self._drop(name)
+            self._specs.pop(name, None)
+        finally:
+            self._lock.release()
+
+    def _chain(self, name):
+        # name and the names of its bases
+        chain = []
+        while name is not None and name not in chain:
+            chain.append(name)
+            name = self._specs.get(name, (None, None))[1]
+        return chain
+
+    def _drop(self, name):
+        # forget the compiled map of name and of every overlay on it
+        self._maps.pop(name, None)
+        for other, (mapping, base) in self._specs.items():
+            if base == name and other != name:
+                self._drop(other)
+
+    def mapping(self, name):
+        """Return the merged dict the map of name is compiled from."""
+        self._lock.acquire()
+        try:
+            if name in self._specs:
+                mapping, base = self._specs[name]
+                if base is None:
+                    return mapping
+                merged = dict(self.mapping(base))
+                merged.update(mapping)
+                return merged
+            if name in TABLES:
+                return table_mapping(name)
+            raise KeyError(name)
+        finally:
+            self._lock.release()
+
+    def loaded(self):
+        """Names of the maps currently in memory."""
+        return sorted(self._maps)
+
+    def __getitem__(self, name):
+        cm = self._maps.get(name)
+        if cm is not None:
+            return cm
+        self._lock.acquire()
+        try:
+            # another thread may have loaded it meanwhile
+            cm = self._maps.get(name)
+            if cm is None:
+                if name in self._specs:
+                    cm = ConvertMap(name, self.mapping(name))
+                elif name in TABLES:
+                    cm = load_map(name)
+                else:
+                    raise KeyError(name)
+                self._maps[name] = cm
+            return cm
+        finally:
+            self._lock.release()
+
+    def __contains__(self, name):
+        return name in self._specs or name in TABLES
+
+MAPS = MapRegistry()
 
 def run():
     import sys
@@ -227,9 +1047,42 @@ def run():
             help='input file (- for stdin)')
     parser.add_option('-t', type='string', dest='file_out',
             help='output file')
+    parser.add_option('-m', type='choice', dest='engine', default='trie',
+            choices=['trie', 'fsm'],
+            help='conversion engine: trie (default), the leftmost longest '
+                 'word as MediaWiki does, or fsm, the segmentation with the '
+                 'fewest words; the two differ on rare input')
+    parser.add_option('-b', action='store_true', dest='bulk', default=False,
+            help='convert the whole input in one pass instead of by line')
+    parser.add_option('-p', action='store_true', dest='protect',
+            default=False,
+            help='leave placeholders, tags, URLs and code spans as they '
+                 'are, implies -b')
+    parser.add_option('-s', action='store_true', dest='stream',
+            default=False,
+            help='convert and write the input as it arrives, for pipes')
+    parser.add_option('-c', action='store_true', dest='compile',
+            default=False,
+            help='compile the built-in maps (or the one of -e) and exit')
+    parser.add_option('-j', type='int', dest='processes',
+            help='convert in this many processes (0: one per CPU), '
+                 'implies -b; -f and -t may then be directories')
     (options, args) = parser.parse_args()
+    if options.compile:
+        for name in sorted(TABLES):
+            if options.encoding in (None, name):
+                print compile_map(name)
+        return
     if not options.encoding:
         parser.error('encoding must be set')
+    if options.file_in and os.path.isdir(options.file_in):
+        if options.processes is None:
+            options.processes = 0
+        if not options.file_out or options.file_out == '-':
+            parser.error('output directory must be set')
+        convert_tree(options.file_in, options.file_out, options.encoding,
+                options.processes or None)
+        return
     if options.file_in:
         if options.file_in == '-':
             file_in = sys.stdin
@@ -245,7 +1098,21 @@ def run():
     else:
         file_out = sys.stdout
 
-    c = Converter(options.encoding)
+    if options.processes is not None:
+        convert_parallel(file_in, file_out, options.encoding,
+                options.processes or None)
+        return
+    if options.stream:
+        convert_stream(file_in, file_out, options.encoding)
+        return
+    if options.bulk or options.protect:
+        convert_file(file_in, file_out, options.encoding,
+                protect=options.protect and PROTECT or None)
+        return
+    if options.engine == 'fsm':
+        c = Converter(options.encoding)
+    else:
+        c = TrieConverter(options.encoding)
     for line in file_in:
         print >> file_out, c.convert(line.rstrip('\n').decode(
             'utf8')).encode('utf8')
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Conversion daemon: keeps the maps of langconv in memory and converts
+over HTTP, on a TCP port or a Unix socket.
+
+POST /batch
+    JSON {"to": "zh-hant", "texts": ["...", ...], "protect": false}
+    answered with {"results": ["...", ...]}.  Equal strings are converted
+    once, and short strings are memoized across requests.
+POST /convert?to=zh-hant[&protect=1]
+    the body, UTF-8 text of any length, sent with Content-Length or
+    chunked, is converted as it is read and sent back chunked.
+GET /stats
+    JSON with the latency of the requests per path (count, mean, p50,
+    p90, p99 and max in milliseconds over the last requests), the cache
+    hit rate and the loaded maps.
+
+Every response carries its processing time in X-Convert-Time.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import codecs
+import json
+import os
+import threading
+import time
+import urlparse
+from collections import deque
+from optparse import OptionParser
+
+import langconv
+
+DEF_PORT = 8423
+# latencies kept per path for the percentiles
+LATENCY_WINDOW = 1000
+# bytes of a streamed body read at a time
+READ_SIZE = 65536
+
+class LatencyStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.paths = {}
+
+    def record(self, path, seconds):
+        self.lock.acquire()
+        try:
+            stats = self.paths.get(path)
+            if stats is None:
+                stats = self.paths[path] = [0, 0.0, deque(maxlen=self.window)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2].append(seconds)
+        finally:
+            self.lock.release()
+
+    def report(self):
+        self.lock.acquire()
+        try:
+            paths = [(path, count, total, sorted(latencies))
+                     for path, (count, total, latencies)
+                     in self.paths.items()]
+        finally:
+            self.lock.release()
+        report = {}
+        for path, count, total, latencies in paths:
+            def percentile(p):
+                return 1000 * latencies[min(len(latencies) - 1,
+                                            int(len(latencies) * p / 100.0))]
+            report[path] = {'count': count,
+                            'mean_ms': 1000 * total / count,
+                            'p50_ms': percentile(50),
+                            'p90_ms': percentile(90),
+                            'p99_ms': percentile(99),
+                            'max_ms': 1000 * latencies[-1]}
+        return report
+
+class BadRequest(Exception):
+    pass
+
+class ConvertHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'langconvd/0.1'
+
+    def do_GET(self):
+        self.handle_request({'/stats': self.send_stats})
+
+    def do_POST(self):
+        self.handle_request({'/batch': self.convert_batch,
+                             '/convert': self.convert_body})
+
+    def handle_request(self, handlers):
+        self.start = time.time()
+        url = urlparse.urlsplit(self.path)
+        handler = handlers.get(url.path)
+        try:
+            if handler is None:
+                self.send_error(404)
+                return
+            handler(dict(urlparse.parse_qsl(url.query)))
+        except BadRequest, e:
+            # the body may be left unread
+            self.close_connection = 1
+            self.send_json({'error': str(e)}, 400)
+        self.server.latency.record(url.path, time.time() - self.start)
+
+    def elapsed(self):
+        return '%.3fms' % ((time.time() - self.start) * 1000)
+
+    def send_json(self, obj, code=200):
+        data = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Convert-Time', self.elapsed())
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_map(self, to_encoding):
+        if to_encoding not in langconv.MAPS:
+            raise BadRequest('unknown encoding %r' % to_encoding)
+        return langconv.MAPS[to_encoding]
+
+    def iter_body(self):
+        # the request body in pieces, Content-Length or chunked
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in ('\r\n', '\n', ''):
+                        pass
+                    return
+                data = self.rfile.read(size)
+                self.rfile.readline()
+                yield data
+        else:
+            left = int(self.headers.get('Content-Length', 0))
+            while left > 0:
+                data = self.rfile.read(min(left, READ_SIZE))
+                if not data:
+                    return
+                left -= len(data)
+                yield data
+
+    def convert_batch(self, query):
+        try:
+            request = json.loads(''.join(self.iter_body()))
+            to_encoding = request['to']
+            texts = request['texts']
+            if not isinstance(texts, list) or not all(
+                    [isinstance(text, basestring) for text in texts]):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            raise BadRequest('expected {"to": ..., "texts": [...]}')
+        self.get_map(to_encoding)
+        if request.get('protect'):
+            cache = self.server.protect_cache
+        else:
+            cache = self.server.cache
+        self.send_json({'results': cache.convert_batch(texts, to_encoding)})
+
+    def convert_body(self, query):
+        to_encoding = query.get('to')
+        self.get_map(to_encoding)
+        protect = query.get('protect') not in (None, '', '0') and \
+                langconv.PROTECT or None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Trailer', 'X-Convert-Time')
+        self.end_headers()
+        decoder = codecs.getincrementaldecoder('utf8')()
+        if protect is None:
+            # converted as it arrives, with a bounded lookahead
+            stream = langconv.StreamConverter(to_encoding)
+            for data in self.iter_body():
+                self.write_chunk(stream.convert(decoder.decode(data)))
+            self.write_chunk(stream.convert(decoder.decode('', True)))
+            self.write_chunk(stream.end())
+        else:
+            # protected spans have no length bound: convert whole lines
+            pending = u''
+            for data in self.iter_body():
+                text = pending + decoder.decode(data)
+                end = text.rfind(u'\n') + 1
+                pending = text[end:]
+                self.write_chunk(langconv.convert_text(text[:end],
+                        to_encoding, protect))
+            self.write_chunk(langconv.convert_text(pending +
+                    decoder.decode('', True), to_encoding, protect))
+        # the processing time is known only now: send it as a trailer
+        self.wfile.write('0\r\nX-Convert-Time: %s\r\n\r\n' % self.elapsed())
+
+    def write_chunk(self, text):
+        if text:
+            data = text.encode('utf8')
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def send_stats(self, query):
+        cache = self.server.cache.stats()
+        self.send_json({'latency': self.server.latency.report(),
+                        'cache': cache,
+                        'protect_cache': self.server.protect_cache.stats(),
+                        'maps': langconv.MAPS.loaded(),
+                        'uptime': time.time() - self.server.started})
+
+    def address_string(self):
+        # no peer address on a Unix socket
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+class ConvertServerMixIn(SocketServer.ThreadingMixIn):
+    daemon_threads = True
+    verbose = False
+
+    def setup_convert(self, preload=()):
+        self.latency = LatencyStats()
+        self.cache = langconv.ConvertCache()
+        self.protect_cache = langconv.ConvertCache(
+                convert=lambda text, to_encoding: langconv.convert_text(
+                        text, to_encoding, langconv.PROTECT))
+        self.started = time.time()
+        for name in preload:
+            langconv.MAPS[name].get_scanner()
+
+class ConvertServer(ConvertServerMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+class UnixConvertServer(ConvertServerMixIn, SocketServer.UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def make_server(address, preload=(), verbose=False):
+    """address is (host, port) or the path of a Unix socket."""
+    if isinstance(address, tuple):
+        httpd = ConvertServer(address, ConvertHandler)
+    else:
+        httpd = UnixConvertServer(address, ConvertHandler)
+    httpd.verbose = verbose
+    httpd.setup_convert(preload)
+    return httpd
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-a', type='string', dest='host', default='127.0.0.1',
+            help='address to listen on')
+    parser.add_option('-p', type='int', dest='port', default=DEF_PORT,
+            help='port to listen on (%d)' % DEF_PORT)
+    parser.add_option('-u', type='string', dest='unix',
+            help='listen on this Unix socket instead')
+    parser.add_option('-e', type='string', dest='preload',
+            default='zh-hant,zh-hans',
+            help='comma separated maps to load at start')
+    parser.add_option('-v', action='store_true', dest='verbose',
+            default=False, help='log every request')
+    (options, args) = parser.parse_args()
+    preload = [name for name in options.preload.split(',') if name]
+    if options.unix:
+        address = options.unix
+    else:
+        address = (options.host, options.port)
+    httpd = make_server(address, preload, options.verbose)
+    print 'langconvd listening on %s' % (options.unix or
+            '%s:%d' % httpd.server_address)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    if options.unix:
+        os.remove(options.unix)
+
+if __name__ == '__main__':
+    main()
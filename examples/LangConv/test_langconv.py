@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
 from unittest import TestCase
 
+import langconv
 from langconv import *
 
 class ConvertMapTest(TestCase):
@@ -20,6 +25,212 @@ class ConvertMapTest(TestCase):
         self.assertEqual(cm['abc'].data, (True, False, 'cba'))
         self.assertEqual(cm['cb'].data, (True, False, 'bb'))
 
+    def test_compact(self):
+        mapping = {u'a': u'x', u'b': u'x', u'abc': u'y', u'cb': u'y'}
+        cm = ConvertMap('test', mapping)
+        self.assertEqual(sorted(cm._targets), [u'', u'x', u'y'])
+        self.assertEqual(cm._map[u'ab'], cm._map[u'c'])
+        self.assertEqual(cm.entry(u'a'), (True, True, u'x'))
+        self.assertEqual(cm.entry(u'ab'), (False, True, u''))
+        self.assertEqual(cm.entry(u'cb'), (True, False, u'y'))
+        self.assertEqual(cm.entry(u'bc'), None)
+        self.assertEqual(sorted(cm.iter_entries()), sorted(
+                [(k,) + cm.entry(k) for k in cm._map]))
+        node = cm[u'bc']
+        self.assertEqual(node.data, (True, False, u'bc'))
+        self.failUnless(node.is_original)
+        self.assertRaises(AttributeError, setattr, node, 'extra', 1)
+
+class CompiledMapTest(TestCase):
+    def setUp(self):
+        self.tables_dir = langconv.TABLES_DIR
+        langconv.TABLES_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(langconv.TABLES_DIR)
+        langconv.TABLES_DIR = self.tables_dir
+
+    def test_round_trip(self):
+        path = compile_map('zh-hans')
+        self.failUnless(os.path.exists(path))
+        built = build_map('zh-hans')
+        loaded = load_map('zh-hans')
+        self.assertEqual(loaded._map, built._map)
+        self.assertEqual(loaded.max_key_length, built.max_key_length)
+        self.assertEqual(loaded.get_trie().root, built.get_trie().root)
+        self.assertEqual(loaded.get_scanner().table,
+                built.get_scanner().table)
+        text = u'頭髮和發生，說明檔案'
+        self.assertEqual(loaded.get_scanner().convert(text),
+                built.get_scanner().convert(text))
+
+    def test_stale_or_broken_file_is_rebuilt(self):
+        path = compile_map('zh-hans')
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:len(data) // 2])
+        self.assertEqual(len(load_map('zh-hans')), len(build_map('zh-hans')))
+        compile_map('zh-hans')
+        self.failIfEqual(load_map('zh-hans')._trie, None)
+        source_mtime = langconv.source_mtime
+        langconv.source_mtime = lambda: source_mtime() + 1
+        try:
+            # built from zh_wiki.py: the trie is not there yet
+            self.assertEqual(load_map('zh-hans')._trie, None)
+        finally:
+            langconv.source_mtime = source_mtime
+
+class StreamConverterTest(TestCase):
+    text = u'頭髮和發生，說明檔案，翻來覆去，長春鹼和嘌呤鹼' * 3
+
+    def test_pieces(self):
+        expected = convert_text(self.text, 'zh-hans')
+        window = MAPS['zh-hans'].max_key_length
+        for size in range(1, 8):
+            stream = StreamConverter('zh-hans')
+            out = []
+            for i in range(0, len(self.text), size):
+                out.append(stream.convert(self.text[i:i + size]))
+                self.failUnless(len(stream.pending) < window)
+            out.append(stream.end())
+            self.assertEqual(u''.join(out), expected)
+
+    def test_emits_early(self):
+        registery('stream', {u'ab': u'x', u'abcd': u'y', u'e': u'f'})
+        stream = StreamConverter('stream')
+        self.assertEqual(stream.convert(u'e'), u'')
+        self.assertEqual(stream.convert(u'abc'), u'f')
+        self.assertEqual(stream.convert(u'e'), u'x')
+        self.assertEqual(stream.pending, u'ce')
+        self.assertEqual(stream.end(), u'cf')
+
+    def test_iter_convert(self):
+        pieces = [self.text[i:i + 5] for i in range(0, len(self.text), 5)]
+        self.assertEqual(u''.join(iter_convert(pieces, 'zh-hans')),
+                convert_text(self.text, 'zh-hans'))
+
+    def test_writer(self):
+        file_out = StringIO()
+        writer = ConvertWriter(file_out, 'zh-hans', 'utf8')
+        writer.writelines(self.text[i:i + 3]
+                for i in range(0, len(self.text), 3))
+        writer.close()
+        self.assertEqual(file_out.getvalue(),
+                convert_text(self.text, 'zh-hans').encode('utf8'))
+        self.assertRaises(ValueError, writer.write, u'頭')
+
+    def test_convert_stream(self):
+        data = self.text.encode('utf8')
+        file_out = StringIO()
+        # 5 bytes splits the UTF-8 sequences
+        convert_stream(StringIO(data), file_out, 'zh-hans', bufsize=5)
+        self.assertEqual(file_out.getvalue(),
+                convert_text(self.text, 'zh-hans').encode('utf8'))
+
+class ConvertCacheTest(TestCase):
+    def test_lru(self):
+        calls = []
+        def convert(text, to_encoding):
+            calls.append(text)
+            return convert_text(text, to_encoding)
+        cache = ConvertCache(2, convert=convert)
+        self.assertEqual(cache.convert(u'頭髮', 'zh-hans'), u'头发')
+        self.assertEqual(cache.convert(u'頭髮', 'zh-hans'), u'头发')
+        self.assertEqual(cache.convert(u'头发', 'zh-hant'), u'頭髮')
+        # touch 頭髮, so 头发 is the least recently used
+        cache.convert(u'頭髮', 'zh-hans')
+        cache.convert(u'發生', 'zh-hans')
+        cache.convert(u'頭髮', 'zh-hans')
+        cache.convert(u'头发', 'zh-hant')
+        self.assertEqual(calls, [u'頭髮', u'头发', u'發生', u'头发'])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']),
+                (3, 4, 2))
+        self.assertEqual(stats['hit_rate'], 300.0 / 7)
+
+    def test_batch(self):
+        cache = ConvertCache()
+        texts = [u'頭髮', u'發生', u'頭髮', u'', u'頭髮']
+        self.assertEqual(cache.convert_batch(texts, 'zh-hans'),
+                [u'头发', u'发生', u'头发', u'', u'头发'])
+        self.assertEqual(cache.stats()['misses'], 3)
+        self.assertEqual(cache.convert_batch(texts, 'zh-hans')[0], u'头发')
+        self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_long_strings_are_not_kept(self):
+        cache = ConvertCache(max_length=2)
+        cache.convert(u'頭髮和', 'zh-hans')
+        cache.convert(u'頭髮和', 'zh-hans')
+        stats = cache.stats()
+        self.assertEqual((stats['uncached'], stats['entries']), (2, 0))
+        cache.clear()
+        self.assertEqual(cache.stats()['uncached'], 0)
+
+class ProfileTest(TestCase):
+    def test_compose(self):
+        base = {u'a': u'A', u'b': u'B', u'ab': u'AB'}
+        other = {u'A': u'a', u'B': u'b'}
+        regional = {u'B': u'R', u'AB': u'S', u'Ac': u'T'}
+        mapping = compose_profile(base, regional, other)
+        self.assertEqual(mapping, {u'a': u'A', u'b': u'R', u'ab': u'S',
+                u'B': u'R', u'AB': u'S', u'Ac': u'T', u'ac': u'T'})
+
+    def test_regional(self):
+        self.assertEqual(convert_text(u'鼠标和软件', 'zh-tw'), u'滑鼠和軟體')
+        self.assertEqual(convert_text(u'软件', 'zh-hk'), u'軟件')
+        self.assertEqual(convert_text(u'字元', 'zh-cn'), u'字符')
+        self.assertEqual(convert_text(u'零钱', 'zh-sg'), u'散钱')
+        # a regional phrase in the script of the input
+        self.assertEqual(convert_text(u'利比里亚', 'zh-tw'), u'賴比瑞亞')
+
+class MapRegistryTest(TestCase):
+    def test_lazy(self):
+        registery('lazy', {u'a': u'b'})
+        self.failUnless('lazy' in MAPS)
+        self.failIf('lazy' in MAPS.loaded())
+        self.assertEqual(Converter('lazy').convert(u'ab'), u'bb')
+        self.failUnless('lazy' in MAPS.loaded())
+        self.failIf('no-such-map' in MAPS)
+        self.assertRaises(KeyError, Converter, 'no-such-map')
+
+    def test_unregister(self):
+        registery('gone', {u'a': u'b'})
+        cm = MAPS['gone']
+        MAPS.unregister('gone')
+        self.failIf('gone' in MAPS)
+        self.failIf('gone' in MAPS.loaded())
+        self.assertRaises(KeyError, MAPS.__getitem__, 'gone')
+        registery('gone', {u'a': u'c'})
+        self.failIf(MAPS['gone'] is cm)
+        self.assertEqual(convert_text(u'ab', 'gone'), u'cb')
+
+    def test_overlay(self):
+        registery('base', {u'a': u'x', u'b': u'y', u'ab': u'z'})
+        registery('overlay', {u'abc': u'3', u'b': u'2'}, 'base')
+        self.assertEqual(convert_text(u'abcab b', 'overlay'), u'3z 2')
+        self.assertEqual(convert_text(u'abcab b', 'base'), u'zcz y')
+        registery('overlay2', {u'ca': u'4'}, 'overlay')
+        self.assertEqual(convert_text(u'bcab', 'overlay2'), u'242')
+        self.assertEqual(convert_text(u'abca', 'overlay2'), u'3x')
+        # changing the base recompiles the overlays on it
+        registery('base', {u'a': u'w'})
+        self.failIf('overlay2' in MAPS.loaded())
+        self.assertEqual(convert_text(u'abca', 'overlay2'), u'3w')
+        self.assertRaises(ValueError, registery, 'base', {}, 'overlay2')
+
+    def test_overlay_builtin(self):
+        registery('zh-hans-phrases', {u'软件': u'软体', u'軟件包': u'套件'},
+                'zh-hans')
+        self.assertEqual(convert_text(u'软件和軟件包，頭髮', 'zh-hans-phrases'),
+                u'软体和套件，头发')
+
+    def test_unregister_builtin(self):
+        cm = MAPS['zh-hans']
+        MAPS.unregister('zh-hans')
+        self.failIf('zh-hans' in MAPS.loaded())
+        self.failUnless('zh-hans' in MAPS)
+        self.failIf(MAPS['zh-hans'] is cm)
+        self.assertEqual(convert_text(u'頭髮', 'zh-hans'), u'头发')
+
 class ConverterModelTest(TestCase):
     def test_1(self):
         registery('rev', {u'a': u'c', u'c': u'a'})
@@ -138,9 +349,67 @@ class ConverterModelTest(TestCase):
         c.end()
         self.assertEqual(c.get_result(), u'cdc')
 
+class TrieConverterModelTest(TestCase):
+    cases = [
+        ({u'a': u'c', u'c': u'a'}, u'abc'),
+        ({u'b': u'a', u'ab': u'ab'}, u'ab'),
+        ({u'a': u'b', u'ab': u'ba'}, u'abac'),
+        ({u'ab': u'ba'}, u'abac'),
+        ({u'ab': u'ba'}, u'aab'),
+        ({u'abc': u'cba'}, u'abcabb'),
+        ({u'abc': u'cba', u'bc': 'cb'}, u'abca'),
+        ({u'abc': u'cba', u'ab': 'ba'}, u'abcabb'),
+        ({u'bx': u'dx', u'c': u'e', u'cy': u'cy'}, u'abc'),
+        ({u'a': u'd', u'b': u'e', u'ab': u'cd', u'by': u'yy'}, u'abc'),
+    ]
+
+    def test_same_as_states_machine(self):
+        for i, (mapping, string) in enumerate(self.cases):
+            name = 'trie%d' % i
+            registery(name, mapping)
+            self.assertEqual(TrieConverter(name).convert(string),
+                    Converter(name).convert(string))
+
+    def test_leftmost_longest(self):
+        # the state machine takes the fewest words (a, bcd), the trie the
+        # longest word at the left (ab), like MediaWiki
+        registery('trie-longest', {u'a': u'A', u'ab': u'ab', u'bcd': u'BCD'})
+        self.assertEqual(Converter('trie-longest').convert(u'abcd'), u'ABCD')
+        self.assertEqual(TrieConverter('trie-longest').convert(u'abcd'),
+                u'abcd')
+        self.assertEqual(convert_text(u'abcd', 'trie-longest'), u'abcd')
+
+    def test_feed(self):
+        registery('trie-feed', {u'abc': u'cba', u'ab': 'ba'})
+        c = TrieConverter('trie-feed')
+        c.feed(u'a')
+        c.feed(u'b')
+        self.assertEqual(c.get_result(), u'')
+        c.feed(u'c')
+        self.assertEqual(c.get_result(), u'cba')
+        c.feed(u'a')
+        c.feed(u'b')
+        self.assertEqual(c.get_result(), u'cba')
+        c.feed(u'b')
+        self.assertEqual(c.get_result(), u'cbabab')
+        c.feed(u'a')
+        c.end()
+        self.assertEqual(c.get_result(), u'cbababa')
+
+    def test_empty_feed_is_boundary(self):
+        registery('trie-empty', {u'abc': u'cba', u'bc': 'cb'})
+        c = TrieConverter('trie-empty')
+        for char in u'abca':
+            c.feed(char)
+        self.assertEqual(c.get_result(), u'cba')
+        c.feed(u'')
+        self.assertEqual(c.get_result(), u'cbaa')
+
 class ConverterTest(TestCase):
+    converter_class = Converter
+
     def assertConvert(self, name, string, converted):
-        c = Converter(name)
+        c = self.converter_class(name)
         new = c.convert(string)
         assert new == converted, (
                 "convert(%s, '%s') should return '%s' but '%s'" % (
@@ -182,6 +451,94 @@ class ConverterTest(TestCase):
         self.assertST(u'嘌呤鹼', u'嘌呤碱')
         self.assertST(u'嘧啶鹼', u'嘧啶碱')
 
+class TrieConverterTest(ConverterTest):
+    converter_class = TrieConverter
+
+class ProtectTest(TestCase):
+    def assertProtect(self, text, converted, name='zh-hans'):
+        self.assertEqual(convert_text(text, name, PROTECT), converted)
+
+    def test_spans(self):
+        self.assertProtect(u'頭髮 %s %(發)d %5.2f 100%', u'头发 %s %(發)d %5.2f 100%')
+        self.assertProtect(u'${發生} $HOME {0} {發} 頭髮', u'${發生} $HOME {0} {發} 头发')
+        self.assertProtect(u'<a title="頭髮">頭髮</a>', u'<a title="頭髮">头发</a>')
+        self.assertProtect(u'見http://a.org/%E9%A0?q=%s。頭髮',
+                u'见http://a.org/%E9%A0?q=%s。头发')
+        self.assertProtect(u'`頭髮` ```\n頭髮\n``` 頭髮', u'`頭髮` ```\n頭髮\n``` 头发')
+        # not placeholders
+        self.assertProtect(u'a < b 和 {頭 髮}', u'a < b 和 {头 发}')
+
+    def test_word_stops_at_span(self):
+        registery('protect', {u'ab': u'X', u'a': u'y', u'<': u'!'})
+        self.assertEqual(convert_text(u'a<b>ab<', 'protect', PROTECT),
+                u'y<b>X!')
+        registery('protect', {u'a%s': u'X', u'a': u'y'})
+        self.assertEqual(convert_text(u'a%sa%', 'protect'), u'Xy%')
+        self.assertEqual(convert_text(u'a%s', 'protect', PROTECT), u'y%s')
+        # spans that start inside a word and end after it
+        registery('protect', {u'a%': u'X'})
+        self.assertEqual(convert_text(u'a%s', 'protect', PROTECT), u'a%s')
+        registery('protect', {u'ah': u'X', u'a': u'y'})
+        self.assertEqual(convert_text(u'ahttp://x.org/ ah', 'protect',
+                PROTECT), u'yhttp://x.org/ X')
+
+    def test_convert_file(self):
+        file_out = StringIO()
+        convert_file(StringIO(u'頭髮 %s\n<b>頭髮</b>'.encode('utf8')),
+                file_out, 'zh-hans', protect=PROTECT)
+        self.assertEqual(file_out.getvalue().decode('utf8'),
+                u'头发 %s\n<b>头发</b>')
+
+class BulkConvertTest(ConverterTest):
+    def assertConvert(self, name, string, converted):
+        self.assertEqual(convert_text(string, name), converted)
+
+    def test_same_as_trie(self):
+        for i, (mapping, string) in enumerate(TrieConverterModelTest.cases):
+            name = 'bulk%d' % i
+            registery(name, mapping)
+            self.assertEqual(convert_text(string, name),
+                    TrieConverter(name).convert(string))
+
+    def test_convert_file(self):
+        text = u'頭髮和發生\n\n翻來覆去\n說明檔案' * 50
+        expected = convert_text(text, 'zh-hans').encode('utf8')
+        file_in = tempfile.TemporaryFile()
+        file_in.write(text.encode('utf8'))
+        file_in.seek(0)
+        for source in (file_in, StringIO(text.encode('utf8'))):
+            for chunk_size in (1, 7, 1 << 20):
+                source.seek(0)
+                file_out = StringIO()
+                convert_file(source, file_out, 'zh-hans', chunk_size)
+                self.assertEqual(file_out.getvalue(), expected)
+
+    def test_convert_parallel(self):
+        lines = [u'%d 頭髮和發生，說明檔案' % i for i in range(200)]
+        data = u'\n'.join(lines).encode('utf8')
+        file_out = StringIO()
+        convert_parallel(StringIO(data), file_out, 'zh-hans', 2, 64)
+        self.assertEqual(file_out.getvalue(),
+                convert_text(data.decode('utf8'), 'zh-hans').encode('utf8'))
+
+    def test_convert_tree(self):
+        dir_in = tempfile.mkdtemp()
+        dir_out = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(dir_in, 'a', 'b'))
+            paths = ['1.txt', os.path.join('a', '2.txt'),
+                    os.path.join('a', 'b', '3.txt')]
+            for i, path in enumerate(paths):
+                open(os.path.join(dir_in, path), 'wb').write(
+                        (u'頭髮%d\n' % i).encode('utf8'))
+            self.assertEqual(convert_tree(dir_in, dir_out, 'zh-hans', 2), 3)
+            for i, path in enumerate(paths):
+                self.assertEqual(open(os.path.join(dir_out, path)).read(),
+                        (u'头发%d\n' % i).encode('utf8'))
+        finally:
+            shutil.rmtree(dir_in)
+            shutil.rmtree(dir_out)
+
 if '__main__' == __name__:
     import unittest
     unittest.main()
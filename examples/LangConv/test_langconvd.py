@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+from langconvd import *
+
+def start(address):
+    httpd = make_server(address, ['zh-hans'])
+    t = threading.Thread(target=httpd.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return httpd
+
+class ConvertServerTest(TestCase):
+    def setUp(self):
+        self.httpd = start(('127.0.0.1', 0))
+        self.conn = httplib.HTTPConnection(*self.httpd.server_address)
+
+    def tearDown(self):
+        self.conn.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def request(self, method, path, body=None):
+        self.conn.request(method, path, body)
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def test_batch(self):
+        body = json.dumps({'to': 'zh-hans',
+                           'texts': [u'頭髮', u'發生', u'頭髮', u'%s頭髮']})
+        response, data = self.request('POST', '/batch', body)
+        self.assertEqual(response.status, 200)
+        self.failUnless(response.getheader('X-Convert-Time'))
+        self.assertEqual(json.loads(data)['results'],
+                [u'头发', u'发生', u'头发', u'%s头发'])
+        body = json.dumps({'to': 'zh-hans', 'texts': [u'<a title="發">發'],
+                           'protect': True})
+        response, data = self.request('POST', '/batch', body)
+        self.assertEqual(json.loads(data)['results'], [u'<a title="發">发'])
+
+    def test_convert(self):
+        text = u'頭髮和發生\n說明檔案' * 1000
+        response, data = self.request('POST', '/convert?to=zh-hans',
+                text.encode('utf8'))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(data.decode('utf8'),
+                langconv.convert_text(text, 'zh-hans'))
+        response, data = self.request('POST',
+                '/convert?to=zh-hans&protect=1',
+                u'<b title="頭髮">頭髮</b>'.encode('utf8'))
+        self.assertEqual(data.decode('utf8'), u'<b title="頭髮">头发</b>')
+
+    def test_chunked_request(self):
+        sock = socket.create_connection(self.httpd.server_address)
+        data = u'頭髮'.encode('utf8')
+        # the first chunk ends within a character
+        sock.sendall('POST /convert?to=zh-hans HTTP/1.1\r\n'
+                     'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n'
+                     '4\r\n%s\r\n2\r\n%s\r\n0\r\n\r\n' % (data[:4], data[4:]))
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        self.assertEqual(response.read().decode('utf8'), u'头发')
+        sock.close()
+
+    def test_errors_and_stats(self):
+        response, data = self.request('POST', '/batch',
+                json.dumps({'to': 'no-such-map', 'texts': []}))
+        self.assertEqual(response.status, 400)
+        self.conn.close()
+        response, data = self.request('POST', '/batch', '{"to": "zh-hans"}')
+        self.assertEqual(response.status, 400)
+        self.conn.close()
+        response, data = self.request('GET', '/nowhere')
+        self.assertEqual(response.status, 404)
+        self.conn.close()
+        response, data = self.request('GET', '/stats')
+        stats = json.loads(data)
+        self.assertEqual(stats['latency']['/batch']['count'], 2)
+        self.failUnless('zh-hans' in stats['maps'])
+        self.failUnless('hit_rate' in stats['cache'])
+
+class UnixConvertServerTest(TestCase):
+    def test_batch(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'langconvd.sock')
+        httpd = start(path)
+        try:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(path)
+            body = json.dumps({'to': 'zh-hans', 'texts': [u'頭髮']})
+            sock.sendall('POST /batch HTTP/1.1\r\nContent-Length: %d\r\n'
+                         'Connection: close\r\n\r\n%s' % (len(body), body))
+            response = httplib.HTTPResponse(sock)
+            response.begin()
+            self.assertEqual(json.loads(response.read())['results'],
+                    [u'头发'])
+            sock.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            shutil.rmtree(tmp)
+
+if '__main__' == __name__:
+    import unittest
+    unittest.main()
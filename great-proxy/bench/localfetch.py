@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: localfetch.py                                                     #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# A stand-in for fetchserver/fetch.py that runs without App Engine.
+#
+# It speaks the same protocol as MainHandler.post: the local proxy POSTs
+# the form fields method, path, headers, encodeResponse and postdata, and
+# gets back the origin's response as a raw HTTP message in the body, with
+# text bodies zlib compressed for encodeResponse=compress.  Origins are
+# fetched with httplib, without retries, caching or access logging.  Like
+# fetch.py it reports its timing spans in the X-GAppProxy-Trace header.
+
+import BaseHTTPServer, SocketServer, httplib, urlparse, cgi, StringIO, \
+       base64, zlib, time, sys
+
+class FetchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    Software = 'GAppProxy-local/0.0.1'
+    # hop to hop header should not be forwarded
+    HtohHdrs= ['connection', 'keep-alive', 'proxy-authenticate',
+               'proxy-authorization', 'te', 'trailers',
+               'transfer-encoding', 'upgrade']
+    FetchTimeout = 30
+    # request tracing, shared with the local proxy
+    TraceHeader = 'X-GAppProxy-Trace'
+
+    def traceSpan(self, name):
+        now = time.time()
+        self.spans.append('%s=%.1f' % (name, (now - self.lastMark) * 1000))
+        self.lastMark = now
+
+    def reply(self, data):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        if self.spans:
+            self.send_header(self.TraceHeader, ','.join(self.spans))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def myError(self, status):
+        self.reply('HTTP/1.1 %d %s\r\nServer: %s\r\n\r\n' % (status,
+                   self.responses.get(status, ('',))[0], self.Software))
+
+    def do_POST(self):
+        self.spans = []
+        self.lastMark = time.time()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            form = cgi.parse_qs(self.rfile.read(length), keep_blank_values=True)
+            get = lambda name: form.get(name, [''])[0]
+            origMethod = get('method')
+            origPath = get('path')
+            origHeaders = get('headers')
+            encodeResponse = get('encodeResponse')
+            origPostData = get('postdata')
+
+            # check method
+            if origMethod not in ('GET', 'HEAD', 'POST'):
+                self.myError(403)
+                return
+            # check path
+            (scm, netloc, path, params, query, _) = urlparse.urlparse(origPath)
+            if scm.lower() not in ('http', 'https') or not netloc:
+                self.myError(403)
+                return
+            newPath = urlparse.urlunparse(('', '', path or '/', params,
+                                           query, ''))
+
+            # make new headers
+            newHeaders = {}
+            contentLength = 0
+            for line in StringIO.StringIO(origHeaders):
+                line = line.strip()
+                if line == '':
+                    break
+                (name, _, value) = line.partition(':')
+                name = name.strip()
+                value = value.strip()
+                if name.lower() in self.HtohHdrs:
+                    continue
+                newHeaders[name] = value
+                if name.lower() == 'content-length':
+                    contentLength = int(value)
+            newHeaders['Connection'] = 'close'
+            if contentLength != len(origPostData):
+                self.myError(403)
+                return
+        except Exception:
+            self.myError(403)
+            return
+
+        self.traceSpan('parse')
+        # fetch
+        try:
+            if scm.lower() == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.FetchTimeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.FetchTimeout)
+            conn.request(origMethod, newPath, origPostData or None, newHeaders)
+            resp = conn.getresponse()
+            content = resp.read()
+            conn.close()
+        except Exception:
+            self.myError(500)
+            return
+        self.traceSpan('fetch')
+
+        # forward
+        out = ['HTTP/1.1 %d %s\r\n' % (resp.status, resp.reason)]
+        textContent = True
+        for (name, value) in resp.getheaders():
+            if name.lower() in self.HtohHdrs:
+                continue
+            out.append('%s: %s\r\n' % (name, value))
+            if name.lower() == 'content-type' and \
+               value.lower().find('text') == -1:
+                textContent = False
+        out.append('\r\n')
+        if encodeResponse == 'base64':
+            out.append(base64.b64encode(content))
+        elif encodeResponse == 'compress' and textContent:
+            out.append(zlib.compress(content))
+        else:
+            out.append(content)
+        self.traceSpan('encode')
+        self.reply(''.join(out))
+
+    def do_GET(self):
+        self.spans = []
+        self.reply('GAppProxy local fetch server is working.\n')
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def serve(port):
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), FetchHandler)
+    # tell whoever started us where we listen
+    print httpd.server_address[1]
+    sys.stdout.flush()
+    httpd.serve_forever()
+
+if __name__ == '__main__':
+    serve(len(sys.argv) > 1 and int(sys.argv[1]) or 0)
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: origin.py                                                         #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# Synthetic origin server for the benchmarks.
+#
+#   GET /<size>?type=<content-type>
+#
+# answers with <size> bytes (suffixes k and m allowed) of the given type.
+# Text types get compressible prose, anything else random bytes.
+
+import BaseHTTPServer, SocketServer, urlparse, os, sys
+
+Prose = 'GAppProxy is an open source HTTP proxy written in Python, ' \
+        'running on the Google App Engine platform. '
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+    payloads = {}
+
+    def payload(self, size, text):
+        key = (size, text)
+        data = self.payloads.get(key)
+        if data is None:
+            if text:
+                data = (Prose * (size / len(Prose) + 1))[:size]
+            else:
+                data = os.urandom(size)
+            self.payloads[key] = data
+        return data
+
+    def do_GET(self):
+        (_, _, path, _, query, _) = urlparse.urlparse(self.path)
+        try:
+            size = parseSize(path.strip('/') or '0')
+        except ValueError:
+            self.send_error(404)
+            return
+        ctype = urlparse.parse_qs(query).get('type', ['text/html'])[0]
+        data = self.payload(size, ctype.startswith('text'))
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        # echo the body back
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def parseSize(s):
+    s = s.lower()
+    if s.endswith('k'):
+        return int(s[:-1]) * 1024
+    if s.endswith('m'):
+        return int(s[:-1]) * 1024 * 1024
+    return int(s)
+
+def serve(host, port):
+    httpd = ThreadingHTTPServer((host, port), OriginHandler)
+    # tell whoever started us where we listen
+    print httpd.server_address[1]
+    sys.stdout.flush()
+    httpd.serve_forever()
+
+if __name__ == '__main__':
+    # host [port]
+    serve(len(sys.argv) > 1 and sys.argv[1] or '127.0.0.1',
+          len(sys.argv) > 2 and int(sys.argv[2]) or 0)
@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: proxybench.py                                                     #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# End-to-end benchmark of the local proxy, without App Engine.
+#
+# Starts three processes, the synthetic origin (origin.py), the stand-in
+# fetch server (localfetch.py) and the local proxy, then drives the proxy
+# with concurrent clients asking for a mix of payload sizes and content
+# types:
+#
+#   client -> LocalProxyHandler -> localfetch.py -> origin.py
+#
+# and reports throughput, latency percentiles and the CPU time every hop
+# spent (read from /proc, so the per-hop numbers need Linux).
+#
+# The proxy answers requests for 127.0.0.1 and localhost itself, so the
+# origin listens on another loopback address (127.0.0.2 by default, which
+# works out of the box on Linux; see -o).
+
+import socket, subprocess, threading, time, os, sys
+from optparse import OptionParser
+
+BenchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BenchDir, '..', 'localproxy'))
+
+def serveProxy(fetchServer):
+    # the proxy process: talk to the fetch server directly, not through
+    # GOOGLE_PROXY as an unconfigured proxy would
+    import proxy, urllib2
+    class QuietProxyHandler(proxy.LocalProxyHandler):
+        def log_message(self, format, *args):
+            pass
+    conf = proxy.ProxyConf()
+    conf.fetchServer = fetchServer
+    conf.opener = urllib2.build_opener(urllib2.ProxyHandler({}),
+                                       proxy.TracedHTTPHandler)
+    proxy.settings = conf
+    httpd = proxy.ThreadingHTTPServer(('127.0.0.1', 0), QuietProxyHandler)
+    httpd.daemon_threads = True
+    httpd.request_queue_size = 128
+    print httpd.server_address[1]
+    sys.stdout.flush()
+    httpd.serve_forever()
+
+def spawn(args):
+    # start a server process, returns (process, port)
+    devnull = open(os.devnull, 'w')
+    p = subprocess.Popen([sys.executable] + args, stdout=subprocess.PIPE,
+                         stderr=devnull)
+    port = int(p.stdout.readline())
+    return (p, port)
+
+def cpuTime(pid):
+    # user + system seconds of a process, None if unknown
+    try:
+        fp = open('/proc/%d/stat' % pid)
+        fields = fp.read().rpartition(')')[2].split()
+        fp.close()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / \
+           float(os.sysconf('SC_CLK_TCK'))
+
+def parseSize(s):
+    s = s.lower()
+    if s.endswith('k'):
+        return int(s[:-1]) * 1024
+    if s.endswith('m'):
+        return int(s[:-1]) * 1024 * 1024
+    return int(s)
+
+def fetch(proxyPort, url):
+    # one request through the proxy, returns the number of body bytes
+    sock = socket.create_connection(('127.0.0.1', proxyPort))
+    sock.sendall('GET %s HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n' % url)
+    data = []
+    while True:
+        d = sock.recv(65536)
+        if d == '':
+            break
+        data.append(d)
+    sock.close()
+    data = ''.join(data)
+    (head, _, body) = data.partition('\r\n\r\n')
+    if head.split(' ', 2)[1:2] != ['200']:
+        raise IOError('bad response: %r' % head[:80])
+    return len(body)
+
+def getStats(proxyPort):
+    # the proxy's aggregated trace spans
+    sock = socket.create_connection(('127.0.0.1', proxyPort))
+    sock.sendall('GET /_stats HTTP/1.0\r\n\r\n')
+    data = []
+    while True:
+        d = sock.recv(65536)
+        if d == '':
+            break
+        data.append(d)
+    sock.close()
+    return ''.join(data).partition('\r\n\r\n')[2]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run(options):
+    (origin, originPort) = spawn([os.path.join(BenchDir, 'origin.py'),
+                                  options.origin])
+    (fetcher, fetchPort) = spawn([os.path.join(BenchDir, 'localfetch.py')])
+    (proxy, proxyPort) = spawn([os.path.abspath(__file__), '--serve-proxy',
+                                'http://127.0.0.1:%d/fetch.py' % fetchPort])
+    hops = [('localproxy', proxy), ('fetchserver', fetcher),
+            ('origin', origin)]
+    try:
+        kinds = []
+        for ctype in options.types.split(','):
+            for size in options.sizes.split(','):
+                kinds.append((ctype, size, parseSize(size)))
+        lock = threading.Lock()
+        results = {}
+        for kind in kinds:
+            results[kind] = []
+        errors = []
+        counter = [0]
+
+        def client(n):
+            while True:
+                lock.acquire()
+                i = counter[0]
+                counter[0] += 1
+                lock.release()
+                if i >= options.requests:
+                    return
+                kind = kinds[i % len(kinds)]
+                url = 'http://%s:%d/%d?type=%s' % (options.origin, originPort,
+                                                   kind[2], kind[0])
+                start = time.time()
+                try:
+                    size = fetch(proxyPort, url)
+                    if size != kind[2]:
+                        raise IOError('got %d bytes instead of %d' % (size,
+                                                                      kind[2]))
+                    error = None
+                except Exception, e:
+                    error = str(e)
+                elapsed = time.time() - start
+                lock.acquire()
+                if error is None:
+                    results[kind].append(elapsed)
+                else:
+                    errors.append(error)
+                lock.release()
+
+        cpuBefore = [cpuTime(p.pid) for (_, p) in hops]
+        clientBefore = os.times()
+        start = time.time()
+        threads = [threading.Thread(target=client, args=(n,))
+                   for n in range(options.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        clientAfter = os.times()
+        cpuAfter = [cpuTime(p.pid) for (_, p) in hops]
+        spans = getStats(proxyPort)
+    finally:
+        for (_, p) in hops:
+            p.terminate()
+            p.wait()
+
+    done = sum([len(v) for v in results.values()])
+    print 'requests    : %d ok, %d failed, concurrency %d' % (
+            done, len(errors), options.concurrency)
+    if errors:
+        print 'first error : %s' % errors[0]
+    print 'elapsed     : %.2fs' % elapsed
+    print 'throughput  : %.1f req/s, %.2f MB/s' % (done / elapsed,
+            sum([len(results[k]) * k[2] for k in kinds]) / elapsed / 1048576)
+    print
+    print '%-32s %6s %8s %8s %8s %8s' % ('type/size', 'count', 'p50 ms',
+                                        'p90 ms', 'p99 ms', 'max ms')
+    for kind in kinds:
+        lat = sorted(results[kind])
+        print '%-32s %6d %8.1f %8.1f %8.1f %8.1f' % (
+                '%s %s' % (kind[0], kind[1]), len(lat),
+                percentile(lat, 50) * 1000, percentile(lat, 90) * 1000,
+                percentile(lat, 99) * 1000, (lat and lat[-1] or 0) * 1000)
+    print
+    print '%-12s %10s %12s' % ('hop', 'cpu s', 'cpu ms/req')
+    clientCpu = (clientAfter[0] - clientBefore[0]) + \
+                (clientAfter[1] - clientBefore[1])
+    rows = [('client', clientCpu)]
+    for ((name, _), before, after) in zip(hops, cpuBefore, cpuAfter):
+        if before is None or after is None:
+            rows.append((name, None))
+        else:
+            rows.append((name, after - before))
+    for (name, cpu) in rows:
+        if cpu is None:
+            print '%-12s %10s %12s' % (name, 'n/a', 'n/a')
+        else:
+            print '%-12s %10.2f %12.2f' % (name, cpu,
+                                           cpu * 1000 / max(done, 1))
+    print
+    print 'proxy spans (ms, from /_stats):'
+    print spans,
+    return not errors
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--serve-proxy':
+        serveProxy(sys.argv[2])
+        return
+    parser = OptionParser()
+    parser.add_option('-c', type='int', dest='concurrency', default=8,
+            help='concurrent clients')
+    parser.add_option('-n', type='int', dest='requests', default=400,
+            help='total number of requests')
+    parser.add_option('-s', type='string', dest='sizes', default='1k,32k,256k',
+            help='comma separated payload sizes (k and m suffixes allowed)')
+    parser.add_option('-t', type='string', dest='types',
+            default='text/html,application/octet-stream',
+            help='comma separated content types')
+    parser.add_option('-o', type='string', dest='origin', default='127.0.0.2',
+            help='loopback address for the origin server')
+    (options, args) = parser.parse_args()
+    if not run(options):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: reload.py                                                         #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# Hammers a local proxy with requests while its configuration is rewritten
+# and reloaded over and over, and counts the requests that failed.
+#
+# The clients take turns at three kinds of request:
+#
+#   loopback  a 127.0.0.1 URL, which the proxy fetches itself
+#   tunnel    a pass-through CONNECT tunnel (the tunnelled host is in
+#             direct_hosts of every configuration written)
+#   fetch     a URL on another loopback address (127.0.0.2 by default,
+#             see -o), which goes through the fetch server
+#
+# Two stand-in fetch servers (localfetch.py) run in this process and every
+# configuration written names the other one, so each reload swaps the
+# fetch server and the opener that requests in flight use.  Nothing leaves
+# the machine.
+
+import BaseHTTPServer, threading, socket, tempfile, time, os, sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'localproxy'))
+import proxy, localfetch, urllib2
+
+Body = 'x' * 1024
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(Body)))
+        self.end_headers()
+        self.wfile.write(Body)
+
+    def log_message(self, format, *args):
+        pass
+
+class QuietProxyHandler(proxy.LocalProxyHandler):
+    def log_message(self, format, *args):
+        pass
+
+class CountingFetchHandler(localfetch.FetchHandler):
+    def do_POST(self):
+        self.server.lock.acquire()
+        self.server.fetches += 1
+        self.server.lock.release()
+        localfetch.FetchHandler.do_POST(self)
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+def buildDirectOpener(conf):
+    # every configuration loaded talks to the fetch server directly, not
+    # through GOOGLE_PROXY as an unconfigured proxy would; the rest of the
+    # reload is the proxy's own
+    conf.opener = urllib2.build_opener(urllib2.ProxyHandler({}),
+                                       proxy.TracedHTTPHandler)
+
+def startServer(handler, host='127.0.0.1'):
+    httpd = proxy.ThreadingHTTPServer((host, 0), handler)
+    httpd.daemon_threads = True
+    t = threading.Thread(target=httpd.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return httpd
+
+def recvAll(sock):
+    data = []
+    while True:
+        d = sock.recv(65536)
+        if d == '':
+            break
+        data.append(d)
+    return ''.join(data)
+
+def viaLoopback(proxyAddr, originPort):
+    sock = socket.create_connection(proxyAddr)
+    sock.sendall('GET http://127.0.0.1:%d/ HTTP/1.0\r\n\r\n' % originPort)
+    data = recvAll(sock)
+    sock.close()
+    return data.endswith(Body)
+
+def viaFetchServer(proxyAddr, originAddr):
+    sock = socket.create_connection(proxyAddr)
+    sock.sendall('GET http://%s:%d/ HTTP/1.0\r\n\r\n' % originAddr)
+    data = recvAll(sock)
+    sock.close()
+    return data.endswith(Body)
+
+def viaTunnel(proxyAddr, originPort):
+    sock = socket.create_connection(proxyAddr)
+    sock.sendall('CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' % originPort)
+    fp = sock.makefile('rb', 0)
+    if fp.readline().split()[1] != '200':
+        sock.close()
+        return False
+    while fp.readline() not in ('\r\n', ''):
+        pass
+    sock.sendall('GET / HTTP/1.0\r\n\r\n')
+    data = recvAll(sock)
+    sock.close()
+    return data.endswith(Body)
+
+def writeConf(path, n, fetchPorts):
+    fp = open(path, 'w')
+    fp.write('# written by reload.py, generation %d\n' % n)
+    fp.write('fetch_server = http://127.0.0.1:%d/fetch.py\n' %
+             fetchPorts[n % len(fetchPorts)])
+    fp.write('direct_hosts = host-%d.invalid, 127.0.0.1\n' % n)
+    fp.close()
+    # make sure the watcher sees a new mtime even within one second
+    os.utime(path, (n, n))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-c', type='int', dest='clients', default=16,
+            help='concurrent clients')
+    parser.add_option('-d', type='float', dest='duration', default=5.0,
+            help='seconds to run')
+    parser.add_option('-r', type='float', dest='interval', default=0.05,
+            help='seconds between configuration changes')
+    parser.add_option('-o', type='string', dest='origin', default='127.0.0.2',
+            help='loopback address of the origin for fetch server requests')
+    (options, args) = parser.parse_args()
+
+    proxy.ProxyConf.buildOpener = buildDirectOpener
+    fetchServers = [startServer(CountingFetchHandler) for i in range(2)]
+    for f in fetchServers:
+        f.lock = threading.Lock()
+        f.fetches = 0
+    fetchPorts = [f.server_address[1] for f in fetchServers]
+
+    (fd, confFile) = tempfile.mkstemp(suffix='.conf')
+    os.close(fd)
+    commFile = confFile + '.tmp'
+    writeConf(confFile, 1, fetchPorts)
+    proxy.settings = proxy.loadConf(confFile)
+
+    # the tunnel and loopback requests go to 127.0.0.1, the fetch server
+    # ones to an origin the proxy does not answer itself
+    origin = startServer(OriginHandler)
+    originPort = origin.server_address[1]
+    fetchOrigin = startServer(OriginHandler, options.origin)
+    fetchOriginAddr = fetchOrigin.server_address
+    httpd = startServer(QuietProxyHandler)
+    proxyAddr = httpd.server_address
+    watcher = proxy.ConfWatcher(confFile, commFile, options.interval / 2,
+                                verbose=False)
+    watcher.start()
+
+    lock = threading.Lock()
+    kinds = [('loopback', viaLoopback, originPort),
+             ('tunnel', viaTunnel, originPort),
+             ('fetch', viaFetchServer, fetchOriginAddr)]
+    results = dict([(name, [0, 0]) for (name, _, _) in kinds])
+    latencies = []
+    end = time.time() + options.duration
+
+    def client(n):
+        (name, request, target) = kinds[n % len(kinds)]
+        while time.time() < end:
+            start = time.time()
+            try:
+                ok = request(proxyAddr, target)
+            except Exception:
+                ok = False
+            elapsed = time.time() - start
+            lock.acquire()
+            if ok:
+                results[name][0] += 1
+                latencies.append(elapsed)
+            else:
+                results[name][1] += 1
+            lock.release()
+
+    # the proxy prints a line for every CONNECT
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        clients = [threading.Thread(target=client, args=(n,))
+                   for n in range(options.clients)]
+        for t in clients:
+            t.start()
+        n = 1
+        while time.time() < end:
+            time.sleep(options.interval)
+            n += 1
+            writeConf(confFile, n, fetchPorts)
+        for t in clients:
+            t.join()
+    finally:
+        sys.stdout = stdout
+
+    # the watcher thread runs on, keep it off the removed file
+    watcher.check = lambda: False
+    os.remove(confFile)
+    total = sum([ok + failed for (ok, failed) in results.values()])
+    failed = sum([failed for (ok, failed) in results.values()])
+    print 'clients          : %d' % options.clients
+    print 'duration         : %.1fs' % options.duration
+    print 'config reloads   : %d' % watcher.reloads
+    print 'requests         : %d (%.0f/s)' % (total, total / options.duration)
+    for (name, _, _) in kinds:
+        print '  %-14s : %d ok, %d failed' % (name, results[name][0],
+                                              results[name][1])
+    print 'fetch servers    : %s requests' % ' / '.join(
+            [str(f.fetches) for f in fetchServers])
+    print 'failed requests  : %d' % failed
+    print 'latency p50/p99  : %.1fms / %.1fms' % (
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+    if failed or not all([f.fetches for f in fetchServers]):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,38 @@
 #                                                                           #
 #############################################################################
 
+import time, random, threading, pickle, logging
 from google.appengine.ext import db
+from google.appengine.api import memcache
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
+
+# every counter is split over NUM_SHARDS entities, so that concurrent
+# flushes for a popular destination rarely touch the same entity
+NUM_SHARDS = 20
+# accesses are counted in memory and handed to a queued task at most this
+# often, the task writes them to the datastore
+FLUSH_INTERVAL = 10
+# counters written by one flush task, keeps the payload well below 100KB
+FLUSH_TASK_NAMES = 500
+FLUSH_URL = '/admin.py?obj=accesslog&cmd=flush'
+# the admin pages show the TOP_N entries of a periodically built snapshot
+TOP_N = 50
+# entities removed per datastore call when clearing the log
+DELETE_BATCH = 500
+# counter entities read per datastore query while building a snapshot
+SCAN_BATCH = 500
+# a snapshot task hands the scan over to a new one after this many seconds
+SCAN_TIMEOUT = 20
+# a snapshot build is started again if none finished within this time
+SCAN_LOCK_TIME = 1800
+SNAPSHOT_URL = '/admin.py?obj=accesslog&cmd=snapshot_step'
+# a flush task remembers the counters it wrote for this long, a retry of
+# the task skips them
+WRITTEN_NAMESPACE = 'accesslog_written'
+WRITTEN_TIME = 86400
 
 class AccessDestination(db.Model):
     desti = db.StringProperty(required=True)
@@ -35,59 +66,262 @@ class AccessFrom(db.Model):
     fro = db.StringProperty(required=True)
     counter = db.IntegerProperty(required=True)
 
-def incDestiCounter(desti):
-    rec = db.get(db.Key.from_path('AccessDestination', 'D:%s' % desti))
+class AccessSnapshot(db.Model):
+    # pickled list of (name, counter), key name is the snapshot name
+    top = db.BlobProperty(required=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+# pending counts of this instance, not yet in the datastore
+pendingLock = threading.Lock()
+pendingDesti = {}
+pendingFro = {}
+lastFlush = time.time()
+
+def incDestiCounter(desti, count=1):
+    keyName = 'D:%s:%d' % (desti, random.randrange(NUM_SHARDS))
+    rec = AccessDestination.get_by_key_name(keyName)
     if not rec:
-        rec = AccessDestination(desti=desti, counter=1, key_name='D:%s' % desti)
+        rec = AccessDestination(desti=desti, counter=count, key_name=keyName)
     else:
-        rec.counter += 1
+        rec.counter += count
     rec.put()
 
-def incFroCounter(fro):
-    rec = db.get(db.Key.from_path('AccessFrom', 'F:%s' % fro))
+def incFroCounter(fro, count=1):
+    keyName = 'F:%s:%d' % (fro, random.randrange(NUM_SHARDS))
+    rec = AccessFrom.get_by_key_name(keyName)
     if not rec:
-        rec = AccessFrom(fro=fro, counter=1, key_name='F:%s' % fro)
+        rec = AccessFrom(fro=fro, counter=count, key_name=keyName)
     else:
-        rec.counter += 1
+        rec.counter += count
     rec.put()
 
-def logAccess(desti, fro):
+COUNTERS = {'desti': incDestiCounter, 'fro': incFroCounter}
+
+def queueCounts(kind, counts):
+    # returns the counts which could not be queued
+    items = counts.items()
+    failed = {}
+    for i in range(0, len(items), FLUSH_TASK_NAMES):
+        part = dict(items[i:i + FLUSH_TASK_NAMES])
+        try:
+            taskqueue.add(url=FLUSH_URL, method='POST',
+                          payload=pickle.dumps((kind, part),
+                                               pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            failed.update(part)
+    return failed
+
+def markWritten(taskName, names):
+    # the counters of the task taskName that a retry of it must skip
+    if not taskName or not names:
+        return
     try:
-        db.run_in_transaction(incDestiCounter, desti)
-        db.run_in_transaction(incFroCounter, fro)
-        return True
+        memcache.set_multi(dict([(name, 1) for name in names]),
+                           time=WRITTEN_TIME, key_prefix=taskName + ':',
+                           namespace=WRITTEN_NAMESPACE)
     except Exception:
+        pass
+
+def writeCounts(payload, taskName=None):
+    # run by the flush task: one transaction per counter, off the fetch
+    # path; the counters that fail go to a new task, so a retry of this one
+    # never counts the others twice.  Returns False when they could not be
+    # queued either: the task must then fail and be retried, and it skips
+    # the counters it already wrote or queued
+    (kind, counts) = pickle.loads(payload)
+    incCounter = COUNTERS[kind]
+    written = {}
+    if taskName:
+        try:
+            written = memcache.get_multi(counts.keys(),
+                                         key_prefix=taskName + ':',
+                                         namespace=WRITTEN_NAMESPACE)
+        except Exception:
+            written = {}
+    failed = {}
+    for (name, count) in counts.items():
+        if name in written:
+            continue
+        try:
+            db.run_in_transaction(incCounter, name, count)
+        except Exception:
+            failed[name] = count
+            continue
+        markWritten(taskName, [name])
+    if not failed:
+        return True
+    lost = queueCounts(kind, failed)
+    markWritten(taskName, [name for name in failed if name not in lost])
+    if lost:
+        logging.error('accesslog: %d %s counters neither written nor queued, '
+                      'the flush task is retried: %r' % (len(lost), kind,
+                                                         lost))
+        return False
+    return True
+
+def flush():
+    global pendingDesti, pendingFro, lastFlush
+    pendingLock.acquire()
+    try:
+        desti, pendingDesti = pendingDesti, {}
+        fro, pendingFro = pendingFro, {}
+        lastFlush = time.time()
+    finally:
+        pendingLock.release()
+    failedDesti = queueCounts('desti', desti)
+    failedFro = queueCounts('fro', fro)
+    if failedDesti or failedFro:
+        # keep them for the next flush
+        pendingLock.acquire()
+        try:
+            for (name, count) in failedDesti.items():
+                pendingDesti[name] = pendingDesti.get(name, 0) + count
+            for (name, count) in failedFro.items():
+                pendingFro[name] = pendingFro.get(name, 0) + count
+        finally:
+            pendingLock.release()
         return False
+    return True
+
+def logAccess(desti, fro):
+    pendingLock.acquire()
+    try:
+        pendingDesti[desti] = pendingDesti.get(desti, 0) + 1
+        pendingFro[fro] = pendingFro.get(fro, 0) + 1
+        due = time.time() - lastFlush >= FLUSH_INTERVAL
+    finally:
+        pendingLock.release()
+    if due:
+        # there is no background thread, the request hitting the
+        # interval queues the counts, a task writes them
+        try:
+            return flush()
+        except Exception:
+            return False
+    return True
+
+SNAPSHOTS = {'desti': (AccessDestination, 'desti'),
+             'fro': (AccessFrom, 'fro')}
+
+def addTop(top, item):
+    top.append(item)
+    if len(top) >= 2 * TOP_N:
+        top.sort(key=lambda t: t[1], reverse=True)
+        del top[TOP_N:]
+
+def scanTop(name, state, deadline):
+    # the counters are read in name order, so the shards of a name are
+    # next to each other: only the top list so far and the name being
+    # summed are carried from one batch, and one task, to the next.
+    # Returns the state to go on from, or None and the top list.
+    (model, nameProp) = SNAPSHOTS[name]
+    (cursor, top, carry) = state
+    while time.time() < deadline:
+        q = model.all().order(nameProp)
+        if cursor:
+            q.with_cursor(cursor)
+        recs = q.fetch(SCAN_BATCH)
+        for r in recs:
+            n = getattr(r, nameProp)
+            if carry is not None and carry[0] == n:
+                carry = (n, carry[1] + r.counter)
+            else:
+                if carry is not None:
+                    addTop(top, carry)
+                carry = (n, r.counter)
+        if len(recs) < SCAN_BATCH:
+            if carry is not None:
+                addTop(top, carry)
+            top.sort(key=lambda t: t[1], reverse=True)
+            return (None, top[:TOP_N])
+        cursor = q.cursor()
+    return ((cursor, top, carry), None)
+
+def queueSnapshot(name, state=(None, [], None)):
+    taskqueue.add(url=SNAPSHOT_URL, method='POST',
+                  payload=pickle.dumps((name, state),
+                                       pickle.HIGHEST_PROTOCOL))
+
+def startSnapshot(name):
+    # at most one build of a snapshot at a time
+    if memcache.add('snapshot-building:%s' % name, 1, time=SCAN_LOCK_TIME):
+        queueSnapshot(name)
+
+def buildSnapshotStep(payload):
+    # run by the snapshot tasks, each scans for SCAN_TIMEOUT seconds
+    (name, state) = pickle.loads(payload)
+    (state, top) = scanTop(name, state, time.time() + SCAN_TIMEOUT)
+    if state is None:
+        saveSnapshot(name, top)
+        memcache.delete('snapshot-building:%s' % name)
+    else:
+        queueSnapshot(name, state)
+
+def saveSnapshot(name, top):
+    data = pickle.dumps(top, pickle.HIGHEST_PROTOCOL)
+    AccessSnapshot(key_name=name, top=db.Blob(data)).put()
+    memcache.set('snapshot:%s' % name, top)
+
+def loadSnapshot(name):
+    top = memcache.get('snapshot:%s' % name)
+    if top is not None:
+        return top
+    rec = AccessSnapshot.get_by_key_name(name)
+    if rec is None:
+        return None
+    top = pickle.loads(rec.top)
+    memcache.set('snapshot:%s' % name, top)
+    return top
+
+def buildSnapshots():
+    # run periodically by cron, see cron.yaml; the scans run in tasks
+    flush()
+    for name in SNAPSHOTS:
+        startSnapshot(name)
+
+def listSnapshot(name, count):
+    top = loadSnapshot(name)
+    if top is None:
+        # no snapshot yet: it is built in the background, never here
+        startSnapshot(name)
+        return []
+    return top[:count]
 
 def listPopDesti(count):
-    ls = []
-    q = db.GqlQuery("select * from AccessDestination order by counter desc")
-    results = q.fetch(count)
-    for r in results:
-        ls.append((r.desti, r.counter))
-    return ls
+    return listSnapshot('desti', count)
 
 def listFreqFro(count):
-    ls = []
-    q = db.GqlQuery("select * from AccessFrom order by counter desc")
-    results = q.fetch(count)
-    for r in results:
-        ls.append((r.fro, r.counter))
-    return ls
-
-def clearDesti():
-    recs = AccessDestination.all()
-    for r in recs:
-        r.delete()
-
-def clearFro():
-    recs = AccessFrom.all()
-    for r in recs:
-        r.delete()
-
-def clearAll():
-    clearDesti()
-    clearFro()
+    return listSnapshot('fro', count)
+
+def clearModel(model, deadline):
+    # delete by keys in batches; returns False if the deadline was hit first
+    while time.time() < deadline:
+        keys = model.all(keys_only=True).fetch(DELETE_BATCH)
+        if not keys:
+            return True
+        db.delete(keys)
+    return False
+
+def clearDesti(deadline):
+    return clearModel(AccessDestination, deadline)
+
+def clearFro(deadline):
+    return clearModel(AccessFrom, deadline)
+
+def clearAll(timeout=20):
+    # returns False when there is still something left to delete
+    global pendingDesti, pendingFro
+    pendingLock.acquire()
+    try:
+        pendingDesti = {}
+        pendingFro = {}
+    finally:
+        pendingLock.release()
+    deadline = time.time() + timeout
+    done = clearDesti(deadline) and clearFro(deadline)
+    saveSnapshot('desti', [])
+    saveSnapshot('fro', [])
+    return done
 
 if __name__ == '__main__':
     print hash('www.appspot.com')
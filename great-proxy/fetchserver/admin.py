@@ -28,7 +28,12 @@
 import wsgiref.handlers
 from google.appengine.ext import webapp
 from google.appengine.api import users
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
 import accesslog
+import fetchstats
 
 class MainHandler(webapp.RequestHandler):
     def listPopDesti(self, count):
@@ -81,10 +86,87 @@ class MainHandler(webapp.RequestHandler):
 </html>
 ''')
 
+    def listFetchStats(self):
+        # format
+        self.response.headers['Content-Type'] = 'text/html'
+        self.response.out.write( \
+'''<html>
+    <head>
+        <meta http-equiv="content-type" content="text/html; charset=utf-8"/>
+        <title>GAppProxy 抓取统计</title>
+    </head>
+    <body>
+        <table width="800" border="1" align="center">
+            <tr><th colspan="2">GAppProxy 抓取统计（重试、超时与缓存）</th></tr>
+            <tr><th>项目</th><th>次数</th></tr>
+''')
+        counters = fetchstats.getCounters(fetchstats.FETCH_COUNTERS +
+                                          fetchstats.CACHE_COUNTERS)
+        for (name, value) in counters:
+            self.response.out.write( \
+'''            <tr><td>%s</td><td>%d</td></tr>
+''' % (name, value))
+        counters = dict(counters)
+        self.response.out.write( \
+'''            <tr><td>cache_hit_rate</td><td>%.1f%%</td></tr>
+''' % fetchstats.hitRate(counters['cache_hits'], counters['cache_misses']))
+        self.response.out.write( \
+'''        </table>
+    </body>
+</html>
+''')
+
+    def clearAccessLog(self):
+        if not accesslog.clearAll():
+            # too much for one request, go on in a queued task
+            taskqueue.add(url='/admin.py', method='GET',
+                          params={'obj': 'accesslog', 'cmd': 'clear'})
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('Clear in progress!')
+            return
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('Clear OK!')
+
+    def isInternal(self):
+        # App Engine strips these headers from outside requests
+        return self.request.headers.get('X-AppEngine-Cron') == 'true' \
+               or 'X-AppEngine-QueueName' in self.request.headers
+
+    def post(self):
+        # queued tasks only, see accesslog.flush and accesslog.queueSnapshot
+        obj = self.request.get('obj')
+        cmd = self.request.get('cmd')
+        self.response.headers['Content-Type'] = 'text/plain'
+        if not self.isInternal():
+            self.response.out.write('Forbidden!')
+        elif obj.lower() == 'accesslog' and cmd.lower() == 'flush':
+            if accesslog.writeCounts(self.request.body,
+                    self.request.headers.get('X-AppEngine-TaskName')):
+                self.response.out.write('Flush OK!')
+            else:
+                # the task queue retries the task
+                self.error(500)
+                self.response.out.write('Flush failed!')
+        elif obj.lower() == 'accesslog' and cmd.lower() == 'snapshot_step':
+            accesslog.buildSnapshotStep(self.request.body)
+            self.response.out.write('Snapshot OK!')
+        else:
+            self.response.out.write('Wrong cmd!')
+
     def get(self):
         user = users.get_current_user()
         obj = self.request.get('obj')
         cmd = self.request.get('cmd')
+        # cron jobs and queued tasks
+        if self.isInternal() and obj.lower() == 'accesslog':
+            if cmd.lower() == 'snapshot':
+                accesslog.buildSnapshots()
+                self.response.headers['Content-Type'] = 'text/plain'
+                self.response.out.write('Snapshot started!')
+                return
+            elif cmd.lower() == 'clear':
+                self.clearAccessLog()
+                return
         # check
         if user:
             if user.email() == 'dugang@188.com':
@@ -93,15 +175,30 @@ class MainHandler(webapp.RequestHandler):
                     # for AccessLog
                     if cmd.lower() == 'clear':
                         # clear log
-                        accesslog.clearAll()
+                        self.clearAccessLog()
+                    elif cmd.lower() == 'snapshot':
+                        # rebuild the top lists now
+                        accesslog.buildSnapshots()
                         self.response.headers['Content-Type'] = 'text/plain'
-                        self.response.out.write('Clear OK!')
+                        self.response.out.write('Snapshot started!')
                     elif cmd.lower() == 'list_pop_desti':
                         # list the most popular destinations
-                        self.listPopDesti(50)
+                        self.listPopDesti(accesslog.TOP_N)
                     elif cmd.lower() == 'list_freq_fro':
                         # list the most frequent user
-                        self.listFreqFro(50)
+                        self.listFreqFro(accesslog.TOP_N)
+                    else:
+                        self.response.headers['Content-Type'] = 'text/plain'
+                        self.response.out.write('Wrong cmd!')
+                elif obj.lower() == 'fetch':
+                    # for fetch statistics
+                    if cmd.lower() == 'stats':
+                        self.listFetchStats()
+                    elif cmd.lower() == 'clear':
+                        fetchstats.clearCounters(fetchstats.FETCH_COUNTERS +
+                                                 fetchstats.CACHE_COUNTERS)
+                        self.response.headers['Content-Type'] = 'text/plain'
+                        self.response.out.write('Clear OK!')
                     else:
                         self.response.headers['Content-Type'] = 'text/plain'
                         self.response.out.write('Wrong cmd!')
@@ -120,9 +217,7 @@ class MainHandler(webapp.RequestHandler):
                 if False:
                 #if magic == '':
                     # clear log
-                    accesslog.clearAll()
-                    self.response.headers['Content-Type'] = 'text/plain'
-                    self.response.out.write('Clear OK!')
+                    self.clearAccessLog()
                 else:
                     self.response.headers['Content-Type'] = 'text/plain'
                     self.response.out.write('Forbidden!')
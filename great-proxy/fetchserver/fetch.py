@@ -25,10 +25,12 @@
 #                                                                           #
 #############################################################################
 
-import wsgiref.handlers, urlparse, StringIO, logging, base64, zlib
+import wsgiref.handlers, urlparse, StringIO, logging, base64, zlib, time, \
+       random
 from google.appengine.ext import webapp
 from google.appengine.api import urlfetch
 from accesslog import logAccess
+import fetchstats, respcache
 
 
 class MainHandler(webapp.RequestHandler):
@@ -37,6 +39,19 @@ class MainHandler(webapp.RequestHandler):
     HtohHdrs= ['connection', 'keep-alive', 'proxy-authenticate',
                'proxy-authorization', 'te', 'trailers',
                'transfer-encoding', 'upgrade']
+    # fetch policy, all times in seconds
+    MaxAttempts = 3
+    # deadline of a urlfetch RPC; one that ran out is tried again with
+    # all of the time left, as the origin is slow rather than down
+    AttemptDeadline = 10
+    # stay well below the 30s request deadline
+    TotalDeadline = 25
+    # exponential backoff between attempts, with full jitter
+    BackoffBase = 0.25
+    BackoffMax = 2.0
+    # request tracing, shared with the local proxy
+    RequestIdHeader = 'X-GAppProxy-Request-Id'
+    TraceHeader = 'X-GAppProxy-Trace'
 
     def myError(self, status):
         self.response.out.write('HTTP/1.1 %d %s\r\n' % (status, \
@@ -44,7 +59,78 @@ class MainHandler(webapp.RequestHandler):
         self.response.out.write('Server: %s\r\n' % self.Software)
         self.response.out.write('\r\n')
 
+    def traceSpan(self, name):
+        # the span 'name' ends now and started where the last one ended
+        now = time.time()
+        self.spans.append('%s=%.1f' % (name, (now - self.lastMark) * 1000))
+        self.lastMark = now
+
+    def traceDone(self):
+        spans = ','.join(self.spans)
+        self.response.headers[self.TraceHeader] = spans
+        logging.debug('trace %s %s' % (self.request.headers.get(
+                      self.RequestIdHeader, '-'), spans))
+
+    def startFetch(self, url, payload, method, headers, deadline):
+        rpc = urlfetch.create_rpc(deadline=deadline)
+        urlfetch.make_fetch_call(rpc, url, payload, method, headers,
+                                 False, False)
+        return rpc
+
+    def fetch(self, url, payload, method, headers, stats=None):
+        if stats is None:
+            stats = {}
+        stats['requests'] = 1
+        start = time.time()
+        resp = None
+        timedOut = False
+        try:
+            for attempt in range(self.MaxAttempts):
+                remaining = self.TotalDeadline - (time.time() - start)
+                if remaining <= 0:
+                    break
+                if attempt > 0:
+                    stats['retries'] = stats.get('retries', 0) + 1
+                    backoff = min(self.BackoffMax,
+                                  self.BackoffBase * (2 ** (attempt - 1)))
+                    time.sleep(min(random.uniform(0, backoff), remaining))
+                    remaining = self.TotalDeadline - (time.time() - start)
+                    if remaining <= 0:
+                        break
+                # urlfetch RPCs can't be waited on with a timeout, and on
+                # this runtime there is nothing to run a second one beside
+                # the first: the deadlines are tiered instead of hedged
+                if timedOut:
+                    deadline = remaining
+                    stats['extended'] = stats.get('extended', 0) + 1
+                else:
+                    deadline = min(self.AttemptDeadline, remaining)
+                stats['attempts'] = stats.get('attempts', 0) + 1
+                rpc = self.startFetch(url, payload, method, headers, deadline)
+                try:
+                    resp = rpc.get_result()
+                except urlfetch.InvalidURLError:
+                    # retrying won't help
+                    return None
+                except urlfetch.DeadlineExceededError:
+                    stats['deadline_exceeded'] = \
+                        stats.get('deadline_exceeded', 0) + 1
+                    timedOut = True
+                    continue
+                except Exception:
+                    timedOut = False
+                    continue
+                if resp is not None:
+                    return resp
+            return None
+        finally:
+            if resp is None:
+                stats['failures'] = 1
+            fetchstats.addCounters(stats)
+
     def post(self):
+        self.spans = []
+        self.lastMark = time.time()
         try:
             # get post data
             origMethod = self.request.get('method')
@@ -111,22 +197,36 @@ class MainHandler(webapp.RequestHandler):
             self.myError(403)
             return
 
-        # fetch, try 3 times
-        for _ in range(3):
-            try:
-                resp = urlfetch.fetch(newPath, origPostData, method, newHeaders, False, False)
-                break
-            except Exception:
-                continue
-        else:
+        self.traceSpan('parse')
+        # cached?
+        cacheable = respcache.requestCacheable(origMethod, newHeaders)
+        stats = {}
+        if cacheable:
+            cached = respcache.lookup(newPath, encodeResponse, newHeaders)
+            self.traceSpan('cache')
+            if cached is not None:
+                fetchstats.addCounters({'cache_hits': 1})
+                self.response.headers['Content-Type'] = \
+                    'application/octet-stream'
+                self.response.out.write(cached[0])
+                self.response.out.write(cached[1])
+                logAccess(netloc, self.request.remote_addr)
+                self.traceDone()
+                return
+            stats['cache_misses'] = 1
+
+        # fetch, with retries and tiered deadlines
+        resp = self.fetch(newPath, origPostData, method, newHeaders, stats)
+        self.traceSpan('fetch')
+        if resp is None:
             self.myError(500)
             return
 
         # forward
         self.response.headers['Content-Type'] = 'application/octet-stream'
         # status line
-        self.response.out.write('HTTP/1.1 %d %s\r\n' % (resp.status_code, \
-                                self.response.http_status_message(resp.status_code)))
+        head = ['HTTP/1.1 %d %s\r\n' % (resp.status_code, \
+                self.response.http_status_message(resp.status_code))]
         # headers
         # default Content-Type is text
         textContent = True
@@ -140,30 +240,41 @@ class MainHandler(webapp.RequestHandler):
             #    scs = resp.headers[header].split(',')
             #    for sc in scs:
             #        logging.info('N %s: %s' % (header, sc.strip()))
-            #        self.response.out.write('%s: %s\r\n' % (header, sc.strip()))
+            #        head.append('%s: %s\r\n' % (header, sc.strip()))
             #    continue
             # other
-            self.response.out.write('%s: %s\r\n' % (header, resp.headers[header]))
+            head.append('%s: %s\r\n' % (header, resp.headers[header]))
             # check Content-Type
             if header.lower() == 'content-type':
                 if resp.headers[header].lower().find('text') == -1:
                     # not text
                     textContent = False
-        self.response.out.write('\r\n')
+        head.append('\r\n')
+        head = ''.join(head)
         # need encode?
         if encodeResponse == 'base64':
-            self.response.out.write(base64.b64encode(resp.content))
+            body = base64.b64encode(resp.content)
         elif encodeResponse == 'compress':
             # only compress when Content-Type is text/xxx
             if textContent:
-                self.response.out.write(zlib.compress(resp.content))
+                body = zlib.compress(resp.content)
             else:
-                self.response.out.write(resp.content)
+                body = resp.content
         else:
-            self.response.out.write(resp.content)
+            body = resp.content
+        self.traceSpan('encode')
+        self.response.out.write(head)
+        self.response.out.write(body)
+
+        # keep it for the next user
+        if cacheable and respcache.store(newPath, encodeResponse, newHeaders,
+                                         resp.status_code, resp.headers,
+                                         head, body):
+            fetchstats.addCounters({'cache_stores': 1})
 
         # log
-        #logAccess(netloc, self.request.remote_addr)
+        logAccess(netloc, self.request.remote_addr)
+        self.traceDone()
 
     def get(self):
         self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: fetchstats.py                                                     #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# Fetch statistics live in memcache: they are cheap to update from every
+# instance and it does not matter if they get evicted now and then.
+
+from google.appengine.api import memcache
+
+NAMESPACE = 'fetchstats'
+
+# counters of the fetch retry loop
+FETCH_COUNTERS = ['requests', 'attempts', 'retries', 'extended',
+                  'deadline_exceeded', 'failures']
+# counters of the response cache
+CACHE_COUNTERS = ['cache_hits', 'cache_misses', 'cache_stores']
+
+def hitRate(hits, misses):
+    if hits + misses == 0:
+        return 0.0
+    return 100.0 * hits / (hits + misses)
+
+def addCounters(deltas):
+    # one memcache round trip for all counters of a request
+    deltas = dict([(k, v) for (k, v) in deltas.items() if v])
+    if not deltas:
+        return
+    try:
+        memcache.offset_multi(deltas, namespace=NAMESPACE, initial_value=0)
+    except Exception:
+        # statistics must never break the fetch
+        pass
+
+def getCounters(names):
+    values = memcache.get_multi(names, namespace=NAMESPACE)
+    return [(name, values.get(name, 0)) for name in names]
+
+def clearCounters(names):
+    memcache.delete_multi(names, namespace=NAMESPACE)
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: respcache.py                                                      #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# Shared cache of forwarded GET responses, kept in memcache.
+#
+# An entry holds the response exactly as it is written to the local proxy
+# (status line, headers and the already encoded body), so a hit needs
+# neither the fetch nor the compression.  For every URL a small index entry
+# remembers the request headers named by the origin's Vary header; the
+# entry itself is keyed by the URL and the values of those headers.
+
+import time, rfc822
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from google.appengine.api import memcache
+
+NAMESPACE = 'respcache'
+# memcache refuses values over 1MB
+MAX_ENTRY_SIZE = 512 * 1024
+# responses cacheable by default (RFC 2616, 13.4)
+CACHEABLE_STATUS = [200, 203, 300, 301, 410]
+
+def parseCacheControl(value):
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        (name, _, arg) = part.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"')
+    return directives
+
+def requestCacheable(method, headers):
+    if method != 'GET':
+        return False
+    for (name, value) in headers.items():
+        name = name.lower()
+        if name == 'authorization':
+            return False
+        if name == 'cache-control':
+            cc = parseCacheControl(value)
+            if 'no-cache' in cc or 'no-store' in cc:
+                return False
+        if name == 'pragma' and value.lower().find('no-cache') != -1:
+            return False
+    return True
+
+def freshness(status, respHeaders):
+    # seconds the response may be served from the cache, 0 if not at all
+    if status not in CACHEABLE_STATUS:
+        return 0
+    if respHeaders.get('Set-Cookie') or respHeaders.get('Vary', '') == '*':
+        return 0
+    cc = parseCacheControl(respHeaders.get('Cache-Control'))
+    if 'no-store' in cc or 'no-cache' in cc or 'private' in cc:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if name in cc:
+            try:
+                return max(int(cc[name]), 0)
+            except ValueError:
+                return 0
+    expires = respHeaders.get('Expires')
+    if expires:
+        expires = rfc822.parsedate_tz(expires)
+        date = rfc822.parsedate_tz(respHeaders.get('Date', ''))
+        if expires is None:
+            return 0
+        if date is None:
+            now = time.time()
+        else:
+            now = rfc822.mktime_tz(date)
+        return max(int(rfc822.mktime_tz(expires) - now), 0)
+    return 0
+
+def varyHeaders(respHeaders):
+    names = [h.strip().lower() for h in respHeaders.get('Vary', '').split(',')]
+    names = [h for h in names if h]
+    names.sort()
+    return names
+
+def indexKey(url):
+    return 'vary:' + sha1(url).hexdigest()
+
+def entryKey(url, encoding, vary, reqHeaders):
+    lower = dict([(k.lower(), v) for (k, v) in reqHeaders.items()])
+    parts = [encoding, url]
+    for name in vary:
+        parts.append('%s: %s' % (name, lower.get(name, '')))
+    return 'resp:' + sha1('\n'.join(parts)).hexdigest()
+
+def lookup(url, encoding, reqHeaders):
+    # returns (head, body) or None
+    vary = memcache.get(indexKey(url), namespace=NAMESPACE)
+    if vary is None:
+        return None
+    return memcache.get(entryKey(url, encoding, vary, reqHeaders),
+                        namespace=NAMESPACE)
+
+def store(url, encoding, reqHeaders, status, respHeaders, head, body):
+    ttl = freshness(status, respHeaders)
+    if ttl <= 0 or len(head) + len(body) > MAX_ENTRY_SIZE:
+        return False
+    vary = varyHeaders(respHeaders)
+    try:
+        memcache.set_multi({indexKey(url): vary,
+                            entryKey(url, encoding, vary, reqHeaders):
+                                (head, body)},
+                           time=ttl, namespace=NAMESPACE)
+    except Exception:
+        return False
+    return True
@@ -32,6 +32,10 @@ DEF_FETCH_SERVER = 'http://great-proxy.appspot.com'
 DEF_LISTEN_PORT = 8000
 DEF_CONF_FILE = './proxy.conf'
 DEF_COMM_FILE = './.proxy.conf.tmp'
+# seconds a resolved host name is reused
+DEF_DNS_TTL = 300
+# seconds between checks for a changed configuration
+DEF_RELOAD_INTERVAL = 2
 
 class GAppProxyError(Exception):
     def __init__(self, reason):
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: dnscache.py                                                       #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# A process wide cache in front of socket.getaddrinfo, which is what
+# httplib/urllib2 and socket.create_connection resolve names with.
+#
+# The resolver library does not tell us the TTL of the records, so entries
+# live for a fixed time; failed lookups are remembered for a shorter one.
+
+import socket, threading, time
+
+class DNSCache:
+    def __init__(self, ttl, negativeTtl=5, maxEntries=1024):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.resolve = socket.getaddrinfo
+
+    def getaddrinfo(self, *args):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(args)
+        finally:
+            self.lock.release()
+        if entry is not None and entry[0] > now:
+            if isinstance(entry[1], socket.gaierror):
+                raise entry[1]
+            return entry[1]
+        # resolve outside the lock, lookups for other names go on
+        try:
+            result = self.resolve(*args)
+            entry = (now + self.ttl, result)
+        except socket.gaierror, e:
+            result = None
+            entry = (now + self.negativeTtl, e)
+        self.lock.acquire()
+        try:
+            if len(self.entries) >= self.maxEntries:
+                self.expire(now)
+            self.entries[args] = entry
+        finally:
+            self.lock.release()
+        if result is None:
+            raise entry[1]
+        return result
+
+    def expire(self, now):
+        # called with the lock held
+        for (key, entry) in self.entries.items():
+            if entry[0] <= now:
+                del self.entries[key]
+        if len(self.entries) >= self.maxEntries:
+            self.entries.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+def install(ttl):
+    cache = DNSCache(ttl)
+    socket.getaddrinfo = cache.getaddrinfo
+    return cache
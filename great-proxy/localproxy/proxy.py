@@ -26,22 +26,171 @@
 #############################################################################
 
 import BaseHTTPServer, SocketServer, urllib, urllib2, urlparse, zlib, \
-       socket, os, common, sys
+       socket, select, base64, threading, time, httplib, os, common, \
+       dnscache, proxytrace, sys, StringIO
 try:
     import ssl
     SSLEnable = True
 except:
     SSLEnable = False
 
+class TracedHTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        trace = proxytrace.current()
+        if trace is not None:
+            trace.mark('connect')
+
+class TracedHTTPHandler(urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(TracedHTTPConnection, req)
+
+if hasattr(httplib, 'HTTPSConnection'):
+    class TracedHTTPSConnection(httplib.HTTPSConnection):
+        def connect(self):
+            httplib.HTTPSConnection.connect(self)
+            trace = proxytrace.current()
+            if trace is not None:
+                trace.mark('connect')
+
+    class TracedHTTPSHandler(urllib2.HTTPSHandler):
+        def https_open(self, req):
+            return self.do_open(TracedHTTPSConnection, req)
+else:
+    TracedHTTPSHandler = urllib2.BaseHandler
+
+class ProxyConf:
+    def __init__(self):
+        self.localProxy = common.DEF_LOCAL_PROXY
+        self.fetchServer = common.DEF_FETCH_SERVER
+        # hosts whose CONNECT tunnels are relayed as is
+        self.directHosts = []
+        # opener for the fetch server, shared by the handler threads
+        self.opener = None
+        # JSON-lines request trace log, '' for none
+        self.traceLog = ''
+
+    def isDirectHost(self, host):
+        host = host.lower()
+        for d in self.directHosts:
+            if host == d or host.endswith('.' + d):
+                return True
+        return False
+
+    def buildOpener(self):
+        if self.localProxy != '':
+            proxy_handler = urllib2.ProxyHandler({'http': self.localProxy, \
+                                                  'https': self.localProxy})
+        else:
+            proxy_handler = urllib2.ProxyHandler({'http': common.GOOGLE_PROXY, \
+                                                  'https': common.GOOGLE_PROXY})
+        self.opener = urllib2.build_opener(proxy_handler, TracedHTTPHandler,
+                                           TracedHTTPSHandler)
+
 # global varibles
-localProxy = common.DEF_LOCAL_PROXY
-fetchServer = common.DEF_FETCH_SERVER
+# replaced as a whole on reload; a request keeps the one it started with
+settings = ProxyConf()
+settings.buildOpener()
+# proxy-less opener for requests to this machine
+directOpener = urllib2.build_opener(urllib2.ProxyHandler({}))
 
 class LocalProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     PostDataLimit = 0x100000
+    # host of the intercepted HTTPS tunnel this handler serves, if any
+    httpsHost = None
+    TunnelBufSize = 0x10000
+    # idle seconds before a pass-through tunnel is closed
+    TunnelTimeout = 300
+
+    def openTunnel(self, host, port, conf):
+        # direct connection, or CONNECT through the upstream proxy
+        if conf.localProxy == '':
+            return socket.create_connection((host, port))
+        (auth, _, proxyAddr) = conf.localProxy.rpartition('@')
+        (proxyHost, _, proxyPort) = proxyAddr.partition(':')
+        sock = socket.create_connection((proxyHost, int(proxyPort or 80)))
+        request = 'CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n' % (host, port,
+                                                                  host, port)
+        if auth != '':
+            request += 'Proxy-Authorization: Basic %s\r\n' % \
+                       base64.b64encode(urllib.unquote(auth))
+        sock.sendall(request + '\r\n')
+        # unbuffered, don't eat the first bytes of the tunnel
+        fp = sock.makefile('rb', 0)
+        status = fp.readline().split()
+        while True:
+            line = fp.readline()
+            if line == '' or line == '\r\n' or line == '\n':
+                break
+        if len(status) < 2 or status[1] != '200':
+            sock.close()
+            raise socket.error('upstream proxy refused CONNECT %s:%d' % (host,
+                                                                         port))
+        return sock
+
+    def relay(self, sock):
+        # bytes the client sent right after the CONNECT headers may already
+        # sit in the buffer of rfile, select() won't see them
+        buffered = self.rfile._rbuf
+        if not isinstance(buffered, str):
+            buffered = buffered.getvalue()
+            self.rfile._rbuf = StringIO.StringIO()
+        else:
+            self.rfile._rbuf = ''
+        if buffered:
+            sock.sendall(buffered)
+        # shuttle bytes both ways until one side closes
+        socks = [self.connection, sock]
+        while True:
+            (readable, _, broken) = select.select(socks, [], socks,
+                                                  self.TunnelTimeout)
+            if broken or not readable:
+                # error or idle
+                return
+            for s in readable:
+                data = s.recv(self.TunnelBufSize)
+                if data == '':
+                    # EOF
+                    return
+                if s is sock:
+                    self.connection.sendall(data)
+                else:
+                    sock.sendall(data)
+
+    def doTunnel(self, host, port, conf):
+        try:
+            sock = self.openTunnel(host, port, conf)
+        except (socket.error, ValueError):
+            self.wfile.write('HTTP/1.1 502 Bad Gateway\r\n')
+            self.wfile.write('\r\n')
+            self.connection.close()
+            return
+        self.wfile.write('HTTP/1.1 200 Connection established\r\n')
+        self.wfile.write('\r\n')
+        self.wfile.flush()
+        try:
+            self.relay(sock)
+        except socket.error:
+            pass
+        # clean
+        sock.close()
+        self.close_connection = 1
 
     def do_CONNECT(self):
         print 'connected'
+        conf = settings
+        # pass-through tunnel?
+        (host, _, port) = self.path.partition(':')
+        if conf.isDirectHost(host):
+            try:
+                port = int(port or 443)
+            except ValueError:
+                self.send_error(400)
+                self.connection.close()
+                return
+            self.doTunnel(host, port, conf)
+            return
+
         if not SSLEnable:
             # Not Implemented
             print 'HTTPS is not enabled: HTTPS needs Python 2.6 or later.'
@@ -67,80 +216,68 @@ class LocalProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                                 certfile='./LocalProxyServer.cert', 
                                 keyfile='./LocalProxyServer.key')
 
-        # rewrite request line, url to abs
-        firstLine = ''
-        while True:
-            chr = sslSock.read(1)
-            # EOF?
-            if chr == '':
-                # bad request
-                sslSock.close()
-                self.connection.close()
-                return
-            # newline(\r\n)?
-            if chr == '\r':
-                chr = sslSock.read(1)
-                if chr == '\n':
-                    # got
-                    break
-                else:
-                    # bad request
-                    sslSock.close()
-                    self.connection.close()
-                    return
-            # newline(\n)?
-            if chr == '\n':
-                # got
-                break
-            firstLine += chr
+        # serve the tunnelled request right here, instead of sending it back
+        # to our own listening port over a second TCP connection
+        try:
+            TunnelledHandler(sslSock, self.client_address, self.server,
+                             httpsHost)
+        except (socket.error, ssl.SSLError):
+            pass
 
-        # get path
-        (method, path, ver) = firstLine.split()
-        if path.startswith('/'):
-            path = 'https://%s' % httpsHost + path
+        # clean
+        try:
+            sslSock.shutdown(socket.SHUT_WR)
+        except (socket.error, ssl.SSLError):
+            pass
+        sslSock.close()
+        self.connection.close()
 
-        # connect to local proxy server
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('127.0.0.1', common.DEF_LISTEN_PORT))
-        sock.send('%s %s %s\r\n' % (method, path, ver))
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # tunnelled requests start now, others when they were accepted
+        if self.httpsHost is None:
+            start = getattr(proxytrace.local, 'acceptTime', None)
+        else:
+            start = None
+        self.trace = proxytrace.Trace(start)
+        self.trace.mark('accept')
 
-        # forward https request
-        sslSock.settimeout(1)
-        while True:
-            try:
-                data = sslSock.read(8192)
-            except ssl.SSLError, e:
-                if str(e).lower().find('timed out') == -1:
-                    # error
-                    sslSock.close()
-                    self.connection.close()
-                    sock.close()
-                    return
-                # timeout
-                break
-            if data != '':
-                sock.send(data)
-            else:
-                # EOF
-                break
-        sslSock.setblocking(True)
+    def finish(self):
+        # only requests that got as far as a request line are recorded
+        if self.trace is not None and getattr(self, 'command', None):
+            self.trace.info['method'] = self.command
+            self.trace.finish()
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
 
-        # simply forward response
-        while True:
-            data = sock.recv(8192)
-            if data != '':
-                sslSock.write(data)
-            else:
-                # EOF
-                break
+    def parse_request(self):
+        if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+            return False
+        # rewrite request line, url to abs
+        if self.httpsHost is not None and self.path.startswith('/'):
+            self.path = 'https://%s' % self.httpsHost + self.path
+        self.trace.mark('parse')
+        return True
+
+    def sendStats(self):
+        # aggregated spans, in milliseconds
+        self.trace = None
+        lines = ['%-20s %8s %9s %9s %9s %9s %9s' % ('span', 'count', 'mean',
+                                                   'p50', 'p95', 'p99', 'max')]
+        for row in proxytrace.tracer.report():
+            lines.append('%-20s %8d %9.1f %9.1f %9.1f %9.1f %9.1f' % row)
+        data = '\n'.join(lines) + '\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
 
-        # clean
-        sock.close()
-        sslSock.shutdown(socket.SHUT_WR)
-        sslSock.close()
-        self.connection.close()
-    
     def do_METHOD(self):
+        conf = settings
+        # the proxy's own statistics
+        if self.path == '/_stats':
+            self.sendStats()
+            return
         # check http method and post data
         method = self.command
         if method == 'GET' or method == 'HEAD':
@@ -177,7 +314,7 @@ class LocalProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         # if the request is local, then directly open and write.
         if netloc.startswith('127.0.0.1') or netloc.startswith('localhost'):
-            self.wfile.write(urllib2.urlopen(self.path).read())
+            self.wfile.write(directOpener.open(self.path).read())
             return
 
         if (scm.lower() != 'http' and scm.lower() != 'https') or not netloc:
@@ -197,26 +334,24 @@ class LocalProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # accept-encoding: identity, *;q=0
         # connection: close
         #request = urllib2.Request('http://localhost:8080/fetch.py')
-        request = urllib2.Request(fetchServer)
+        request = urllib2.Request(conf.fetchServer)
         request.add_header('Accept-Encoding', 'identity, *;q=0')
         request.add_header('Connection', 'close')
-        # create new opener
-        if localProxy != '':
-            proxy_handler = urllib2.ProxyHandler({'http': localProxy, \
-                                                  'https': localProxy})
-        else:
-            proxy_handler = urllib2.ProxyHandler({'http': common.GOOGLE_PROXY, \
-                                                  'https': common.GOOGLE_PROXY})
-        opener = urllib2.build_opener(proxy_handler)
-        # set the opener as the default opener
-        urllib2.install_opener(opener)
-        resp = urllib2.urlopen(request, params)
+        request.add_header(proxytrace.REQUEST_ID_HEADER, self.trace.id)
+        self.trace.info['url'] = path
+        self.trace.mark('prepare')
+        resp = conf.opener.open(request, params)
+        self.trace.mark('ttfb')
+        remote = resp.info().getheader(proxytrace.TRACE_HEADER)
+        if remote:
+            self.trace.addRemote(remote)
 
         # parse resp
         textContent = True
         # for status line
         line = resp.readline()
         status = int(line.split()[1])
+        self.trace.info['status'] = status
         self.send_response(status)
         # for headers
         while True:
@@ -237,43 +372,56 @@ class LocalProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     textContent = False
         self.end_headers()
         # for page
-        if textContent:
-            dat = resp.read()
-            if len(dat) > 0:
-                self.wfile.write(zlib.decompress(dat))
-        else:
-            self.wfile.write(resp.read())
+        dat = resp.read()
+        self.trace.mark('transfer')
+        if textContent and len(dat) > 0:
+            dat = zlib.decompress(dat)
+            self.trace.mark('decompress')
+        self.wfile.write(dat)
+        self.trace.mark('write')
         self.connection.close()
     
     do_GET = do_METHOD
     do_HEAD = do_METHOD
     do_POST = do_METHOD
 
+class TunnelledHandler(LocalProxyHandler):
+    def __init__(self, request, client_address, server, httpsHost):
+        self.httpsHost = httpsHost
+        LocalProxyHandler.__init__(self, request, client_address, server)
+
 class ThreadingHTTPServer(SocketServer.ThreadingMixIn, 
                           BaseHTTPServer.HTTPServer): 
-    pass
+    def process_request(self, request, client_address):
+        # like ThreadingMixIn, but hand the accept time to the new thread
+        t = threading.Thread(target=self.process_request_thread,
+                             args=(request, client_address, time.time()))
+        t.daemon = self.daemon_threads
+        t.start()
 
-def getAvailableFetchServer():
+    def process_request_thread(self, request, client_address,
+                               acceptTime=None):
+        proxytrace.local.acceptTime = acceptTime
+        SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                                                           client_address)
+
+def getAvailableFetchServer(localProxy):
     request = urllib2.Request(common.LOAD_BALANCE)
     if localProxy != '':
         proxy_handler = urllib2.ProxyHandler({'http': localProxy})
     else:
         proxy_handler = urllib2.ProxyHandler({'http': common.GOOGLE_PROXY})
     opener = urllib2.build_opener(proxy_handler)
-    # set the opener as the default opener
-    urllib2.install_opener(opener)
-    resp = urllib2.urlopen(request)
+    resp = opener.open(request)
     return resp.read().strip()
 
-def parseConf(confFile):
-    global localProxy, fetchServer
-
+def parseConf(confFile, conf):
     # read config file
     try:
         fp = open(confFile, 'r')
     except IOError:
         # use default parameters
-        return
+        return conf
     # parse user defined parameters
     while True:
         line = fp.readline()
@@ -293,9 +441,87 @@ def parseConf(confFile):
             name = name.strip().lower()
             value = value.strip()
             if name == 'local_proxy':
-                localProxy = value
+                conf.localProxy = value
             elif name == 'fetch_server':
-                fetchServer = value
+                conf.fetchServer = value
+            elif name == 'trace_log':
+                conf.traceLog = value
+            elif name == 'direct_hosts':
+                conf.directHosts = [h.strip().lower().lstrip('.')
+                                    for h in value.split(',')
+                                    if h.strip() != '']
+    fp.close()
+    return conf
+
+def loadConf(confFile):
+    # a complete new configuration, ready to be swapped in
+    conf = parseConf(confFile, ProxyConf())
+    if conf.fetchServer == '':
+        conf.fetchServer = getAvailableFetchServer(conf.localProxy)
+    if conf.fetchServer == '':
+        raise common.GAppProxyError('Invalid response from load balance server.')
+    conf.buildOpener()
+    return conf
+
+def printConf(conf):
+    print 'Local Proxy  : %s' % conf.localProxy
+    print 'Fetch Server : %s' % conf.fetchServer
+    if conf.directHosts:
+        print 'Direct Hosts : %s' % ', '.join(conf.directHosts)
+    if conf.traceLog:
+        print 'Trace Log    : %s' % conf.traceLog
+
+def applyConf(conf):
+    global settings
+    proxytrace.tracer.setLog(conf.traceLog)
+    # one assignment, new requests see all of the new settings
+    settings = conf
+
+class ConfWatcher(threading.Thread):
+    # reloads the configuration while the server keeps running, either when
+    # the config file changes or when the GUI drops new parameters into the
+    # communication file ('Apply')
+    def __init__(self, confFile, commFile, interval, verbose=True):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.confFile = confFile
+        self.commFile = commFile
+        self.interval = interval
+        self.verbose = verbose
+        self.mtime = self.getMtime()
+        self.reloads = 0
+
+    def getMtime(self):
+        try:
+            return os.stat(self.confFile).st_mtime
+        except OSError:
+            return None
+
+    def check(self):
+        if os.path.exists(self.commFile):
+            conf = loadConf(self.commFile)
+            os.remove(self.commFile)
+        else:
+            mtime = self.getMtime()
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            conf = loadConf(self.confFile)
+        applyConf(conf)
+        self.reloads += 1
+        if self.verbose:
+            print 'Configuration reloaded'
+            printConf(conf)
+        return True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception, e:
+                # keep the old settings
+                print 'Reloading configuration failed: %s' % e
 
 if __name__ == '__main__':
     print '--------------------------------------------'
@@ -306,32 +532,12 @@ if __name__ == '__main__':
         print 'HTTP Enabled : YES'
         print 'HTTPS Enabled: NO'
 
-    parseConf(common.DEF_CONF_FILE)
-    if fetchServer == '':
-        fetchServer = getAvailableFetchServer()
-    if fetchServer == '':
-        raise common.GAppProxyError('Invalid response from load balance server.')
-    print 'Local Proxy  : %s' % localProxy
-    print 'Fetch Server : %s' % fetchServer
+    dnscache.install(common.DEF_DNS_TTL)
+    applyConf(loadConf(common.DEF_CONF_FILE))
+    printConf(settings)
     print '--------------------------------------------'
+    ConfWatcher(common.DEF_CONF_FILE, common.DEF_COMM_FILE,
+                common.DEF_RELOAD_INTERVAL).start()
     httpd = ThreadingHTTPServer(('', common.DEF_LISTEN_PORT), 
                                 LocalProxyHandler)
     httpd.serve_forever()
-
-    # for 'Apply' in GUI
-    #while True:
-    #    # parameters changed?
-    #    if os.path.exists(common.DEF_COMM_FILE):
-    #        # renew
-    #        localProxy = common.DEF_LOCAL_PROXY
-    #        fetchServer = common.DEF_FETCH_SERVER
-    #        parseConf(common.DEF_COMM_FILE)
-    #        os.remove(common.DEF_COMM_FILE)
-    #        if fetchServer == '':
-    #            fetchServer = getAvailableFetchServer()
-    #        if fetchServer == '':
-    #            raise common.GAppProxyError('Invalid response from load balance server.')
-    #        print 'Local Proxy  : %s' % localProxy
-    #        print 'Fetch Server : %s' % fetchServer
-    #    # do handle
-    #    httpd.handle_request()
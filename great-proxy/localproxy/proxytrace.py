@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+# coding=utf-8
+#############################################################################
+#                                                                           #
+#   File: proxytrace.py                                                     #
+#                                                                           #
+#   Copyright (C) 2008 Du XiaoGang <dugang@188.com>                         #
+#                                                                           #
+#   Home: http://gappproxy.googlecode.com                                   #
+#                                                                           #
+#   This file is part of GAppProxy.                                         #
+#                                                                           #
+#   GAppProxy is free software: you can redistribute it and/or modify       #
+#   it under the terms of the GNU General Public License as                 #
+#   published by the Free Software Foundation, either version 3 of the      #
+#   License, or (at your option) any later version.                         #
+#                                                                           #
+#   GAppProxy is distributed in the hope that it will be useful,            #
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           #
+#   GNU General Public License for more details.                            #
+#                                                                           #
+#   You should have received a copy of the GNU General Public License       #
+#   along with GAppProxy.  If not, see <http://www.gnu.org/licenses/>.      #
+#                                                                           #
+#############################################################################
+
+# Per-request timing spans of the local proxy.
+#
+# A Trace is created when a request is accepted and collects the phases it
+# goes through (accept, parse, connect, ttfb, transfer, decompress, write),
+# plus the phases the fetch server reports back in its X-GAppProxy-Trace
+# response header.  Finished traces are appended to a JSON-lines log, if
+# one is configured, and aggregated per span for the /_stats page.
+
+import threading, time, uuid
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# sent to the fetch server, which echoes it in its logs
+REQUEST_ID_HEADER = 'X-GAppProxy-Request-Id'
+# spans of the fetch server, 'name=ms,name=ms'
+TRACE_HEADER = 'X-GAppProxy-Trace'
+
+local = threading.local()
+
+def current():
+    # the trace of the request this thread is serving, or None
+    return getattr(local, 'trace', None)
+
+class Trace:
+    def __init__(self, start=None):
+        self.id = uuid.uuid4().hex
+        self.start = start or time.time()
+        self.last = self.start
+        self.spans = []
+        self.info = {}
+        local.trace = self
+
+    def mark(self, name):
+        # the span 'name' ends now and started where the last one ended
+        now = time.time()
+        self.spans.append((name, (now - self.last) * 1000))
+        self.last = now
+
+    def addRemote(self, header):
+        # spans measured by the fetch server
+        for item in header.split(','):
+            (name, _, ms) = item.partition('=')
+            try:
+                self.spans.append(('fetch.' + name.strip(), float(ms)))
+            except ValueError:
+                pass
+
+    def finish(self):
+        if current() is self:
+            local.trace = None
+        self.spans.append(('total', (time.time() - self.start) * 1000))
+        tracer.record(self)
+
+    def toDict(self):
+        d = {'id': self.id, 'start': self.start,
+             'spans': dict(self.spans)}
+        d.update(self.info)
+        return d
+
+class SpanStats:
+    # count/sum/max plus the most recent values for percentiles
+    Window = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = []
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.recent.append(ms)
+        if len(self.recent) > self.Window:
+            del self.recent[:len(self.recent) - self.Window]
+
+    def percentile(self, p):
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.logFile = None
+        self.logPath = ''
+        self.stats = {}
+        # first seen order, for a stable stats page
+        self.order = []
+
+    def setLog(self, path):
+        self.lock.acquire()
+        try:
+            if path == self.logPath:
+                return
+            if self.logFile is not None:
+                self.logFile.close()
+                self.logFile = None
+            self.logPath = path
+            if path != '':
+                self.logFile = open(path, 'a')
+        finally:
+            self.lock.release()
+
+    def record(self, trace):
+        line = None
+        if self.logFile is not None:
+            line = json.dumps(trace.toDict()) + '\n'
+        self.lock.acquire()
+        try:
+            for (name, ms) in trace.spans:
+                s = self.stats.get(name)
+                if s is None:
+                    s = self.stats[name] = SpanStats()
+                    self.order.append(name)
+                s.add(ms)
+            if line is not None and self.logFile is not None:
+                self.logFile.write(line)
+                self.logFile.flush()
+        finally:
+            self.lock.release()
+
+    def report(self):
+        # one line per span: name, count, mean, p50, p95, p99, max (ms)
+        self.lock.acquire()
+        try:
+            rows = []
+            for name in self.order:
+                s = self.stats[name]
+                rows.append((name, s.count, s.total / s.count,
+                             s.percentile(50), s.percentile(95),
+                             s.percentile(99), s.max))
+            return rows
+        finally:
+            self.lock.release()
+
+tracer = Tracer()
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Streaming reader and writer of gettext PO and POT files.
+
+read_entries() yields the entries of a file one at a time, so a catalogue
+of any size is processed in constant memory.  Every entry remembers the
+lines it was read from: an entry written back unmodified gives the very
+same bytes, and a modified one keeps the original lines of the parts that
+did not change.
+
+An entry has:
+  comments      the comment lines, '#', '#.', '#:', '#,' and '#|' kinds,
+                as read (flags and add_flag work on the '#,' lines)
+  msgctxt       the context, None when there is none
+  msgid         the source text
+  msgid_plural  the plural source text, None for a singular entry
+  msgstr        the translation of a singular entry, None for a plural one
+  msgstr_plural the translations of a plural entry, {index: text}
+  obsolete      True for the '#~' entries
+
+The strings are unicode and unescaped.  A trailing group of comments with
+no message after it comes as an entry whose msgid is None.
+"""
+
+import codecs
+import re
+
+# the keyword of a message line, its index and the quoted string
+FIELD_RE = re.compile(r'(msgctxt|msgid_plural|msgid|msgstr)(?:\[(\d+)\])?'
+                      r'\s*(".*)$')
+CHARSET_RE = re.compile(r'charset=([-\w.]+)')
+ESCAPE_RE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))')
+UNESCAPE = {'n': '\n', 't': '\t', 'r': '\r', 'a': '\a', 'b': '\b',
+            'f': '\f', 'v': '\v'}
+ESCAPE = dict((v, '\\' + k) for k, v in UNESCAPE.items())
+ESCAPE.update({'\\': '\\\\', '"': '\\"'})
+NEEDS_ESCAPE_RE = re.compile(r'[\\"\n\t\r\a\b\f\v]')
+LINE_RE = re.compile(u'[^\\n]*\\n|[^\\n]+$')
+
+class POError(ValueError):
+    def __init__(self, message, lineno=None):
+        if lineno is not None:
+            message = 'line %d: %s' % (lineno, message)
+        ValueError.__init__(self, message)
+        self.lineno = lineno
+
+def unescape(text):
+    def replace(match):
+        octal, hexa, char = match.groups()
+        if octal:
+            return unichr(int(octal, 8))
+        if hexa:
+            return unichr(int(hexa, 16))
+        return UNESCAPE.get(char, char)
+    if u'\\' not in text:
+        return text
+    return ESCAPE_RE.sub(replace, text)
+
+def escape(text):
+    return NEEDS_ESCAPE_RE.sub(lambda m: ESCAPE[m.group(0)], text)
+
+def get_charset(header):
+    """The charset declared by a header msgstr, utf-8 if there is none or
+    it is unknown, as in a fresh .pot file."""
+    match = CHARSET_RE.search(header or '')
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+class Entry(object):
+    def __init__(self, msgid=u'', msgstr=u'', msgctxt=None,
+                 msgid_plural=None, msgstr_plural=None, comments=None,
+                 obsolete=False):
+        self.comments = list(comments or [])
+        self.msgctxt = msgctxt
+        self.msgid = msgid
+        self.msgid_plural = msgid_plural
+        if msgid_plural is not None:
+            self.msgstr = None
+            self.msgstr_plural = dict(msgstr_plural or {0: u'', 1: u''})
+        else:
+            self.msgstr = msgstr
+            self.msgstr_plural = {}
+        self.obsolete = obsolete
+        self.charset = 'utf-8'
+        # filled in by the reader
+        self.prefix = []
+        self.trailer = []
+        self.newline = '\n'
+        self.raw = None
+        self.raw_comments = None
+        self.raw_fields = {}
+        self.original = None
+
+    def __repr__(self):
+        return '<Entry msgctxt=%r msgid=%r>' % (self.msgctxt, self.msgid)
+
+    def fields(self):
+        """The messages in file order, as (keyword, value)."""
+        fields = []
+        if self.msgctxt is not None:
+            fields.append(('msgctxt', self.msgctxt))
+        if self.msgid is not None:
+            fields.append(('msgid', self.msgid))
+        if self.msgid_plural is not None:
+            fields.append(('msgid_plural', self.msgid_plural))
+            for index in sorted(self.msgstr_plural):
+                fields.append(('msgstr[%d]' % index,
+                               self.msgstr_plural[index]))
+        elif self.msgstr is not None:
+            fields.append(('msgstr', self.msgstr))
+        return fields
+
+    def state(self):
+        return (tuple(self.comments), self.fields(), self.obsolete)
+
+    def modified(self):
+        return self.original is None or self.state() != self.original
+
+    def set_charset(self, charset):
+        """Write the entry in charset from now on; in another charset than
+        the one it was read in, none of its lines can be reused."""
+        if codecs.lookup(charset).name != codecs.lookup(self.charset).name:
+            self.original = None
+        self.charset = charset
+
+    def is_header(self):
+        return self.msgid == u'' and self.msgctxt is None
+
+    @property
+    def flags(self):
+        flags = []
+        for line in self.comments:
+            if line.startswith(u'#,'):
+                flags.extend([flag.strip() for flag in line[2:].split(u',')
+                              if flag.strip()])
+        return flags
+
+    def add_flag(self, flag):
+        if flag in self.flags:
+            return
+        for i, line in enumerate(self.comments):
+            if line.startswith(u'#,'):
+                self.comments[i] = line.rstrip() + u', ' + flag
+                return
+        # flags go after the other comments, before the previous messages
+        i = len(self.comments)
+        while i > 0 and self.comments[i - 1].startswith(u'#|'):
+            i -= 1
+        self.comments.insert(i, u'#, ' + flag)
+
+    def translated(self):
+        if self.msgid_plural is not None:
+            return bool(self.msgstr_plural) and \
+                    all(self.msgstr_plural.values())
+        return bool(self.msgstr)
+
+class _EntryReader:
+    """Collects the lines of one entry."""
+
+    def __init__(self, charset):
+        self.charset = charset
+        self.raw = []
+        self.prefix = []
+        self.comments = []
+        self.fields = []
+        self.field = None
+        self.obsolete = False
+        self.has_msgstr = False
+
+    def empty(self):
+        return not self.comments and not self.fields
+
+    def add_blank(self, line):
+        if self.empty():
+            self.prefix.append(line)
+        self.raw.append(line)
+
+    def add_comment(self, line, text):
+        self.raw.append(line)
+        self.comments.append((line, text))
+        self.field = None
+
+    def add_field(self, line, keyword, index, quoted, obsolete, lineno):
+        self.raw.append(line)
+        self.obsolete = obsolete
+        if keyword == 'msgstr':
+            self.has_msgstr = True
+        if index is not None:
+            keyword = '%s[%d]' % (keyword, int(index))
+        # the parts of a string are joined once, at the end of the entry
+        self.field = [keyword, [line], [self.quoted(quoted, lineno)]]
+        self.fields.append(self.field)
+
+    def add_string(self, line, quoted, lineno):
+        if self.field is None:
+            raise POError('string outside of a message', lineno)
+        self.raw.append(line)
+        self.field[1].append(line)
+        self.field[2].append(self.quoted(quoted, lineno))
+
+    def quoted(self, quoted, lineno):
+        quoted = quoted.rstrip()
+        if len(quoted) < 2 or not quoted.endswith('"'):
+            raise POError('unterminated string', lineno)
+        return quoted[1:-1]
+
+    def finish(self, trailer):
+        entry = Entry(msgid=None, msgstr=None)
+        values = {}
+        for keyword, lines, parts in self.fields:
+            values[keyword] = ''.join(parts)
+        if self.charset is None:
+            # the first entry: the header tells the charset of the file
+            if values.get('msgid') == '' and 'msgctxt' not in values:
+                self.charset = get_charset(values.get('msgstr'))
+            else:
+                self.charset = 'utf-8'
+        charset = self.charset
+
+        entry.charset = charset
+        entry.obsolete = self.obsolete
+        entry.comments = [text.decode(charset)
+                          for line, text in self.comments]
+        for keyword, lines, parts in self.fields:
+            value = unescape(values[keyword].decode(charset))
+            entry.raw_fields[keyword] = lines
+            if keyword.startswith('msgstr['):
+                entry.msgstr_plural[int(keyword[7:-1])] = value
+            else:
+                setattr(entry, keyword, value)
+        entry.raw = self.raw + trailer
+        entry.raw_comments = [line for line, text in self.comments]
+        entry.prefix = self.prefix
+        entry.trailer = trailer
+        if entry.raw and entry.raw[0].endswith('\r\n'):
+            entry.newline = '\r\n'
+        entry.original = entry.state()
+        return entry
+
+def read_entries(f, charset=None):
+    """The entries of the PO file f, one at a time.  The charset is taken
+    from the header when it is not given."""
+    current = _EntryReader(charset)
+    blanks = []
+    lineno = 0
+    for line in f:
+        lineno += 1
+        stripped = line.strip()
+        if not stripped:
+            blanks.append(line)
+            continue
+
+        obsolete = stripped.startswith('#~') and \
+                not stripped.startswith('#~|')
+        if obsolete:
+            body = stripped[2:].lstrip()
+        else:
+            body = stripped
+        match = None
+        if body[:1] == '#':
+            kind = 'comment'
+        elif body[:1] == '"':
+            kind = 'string'
+        else:
+            match = FIELD_RE.match(body)
+            if match is not None:
+                kind = 'field'
+            elif obsolete:
+                kind = 'comment'
+            else:
+                raise POError('unexpected %r' % stripped, lineno)
+
+        # a comment or a new message after a msgstr starts the next entry
+        if current.has_msgstr and (kind == 'comment' or (kind == 'field' and
+                match.group(1) in ('msgctxt', 'msgid'))):
+            yield current.finish(blanks)
+            current = _EntryReader(current.charset)
+            blanks = []
+        for blank in blanks:
+            current.add_blank(blank)
+        blanks = []
+
+        if kind == 'comment':
+            current.add_comment(line, line.rstrip('\r\n'))
+        elif kind == 'field':
+            current.add_field(line, match.group(1), match.group(2),
+                              match.group(3), obsolete, lineno)
+        else:
+            current.add_string(line, body, lineno)
+    if current.raw or blanks:
+        yield current.finish(blanks)
+
+def format_string(keyword, text, prefix='', newline='\n'):
+    """The lines of a message, split after every newline of the text as
+    msgmerge does."""
+    lines = LINE_RE.findall(text)
+    if len(lines) <= 1:
+        return [u'%s%s "%s"%s' % (prefix, keyword, escape(text), newline)]
+    return [u'%s%s ""%s' % (prefix, keyword, newline)] + \
+           [u'%s"%s"%s' % (prefix, escape(line), newline) for line in lines]
+
+def format_entry(entry):
+    """The bytes of an entry: its original lines when it is unmodified."""
+    if not entry.modified():
+        return ''.join(entry.raw)
+    charset = entry.charset
+    newline = entry.newline
+    lines = list(entry.prefix)
+    original = entry.original
+    if original is not None and tuple(entry.comments) == original[0]:
+        lines.extend(entry.raw_comments)
+    else:
+        lines.extend([(comment + newline).encode(charset)
+                      for comment in entry.comments])
+    if original is not None:
+        original_fields = dict(original[1])
+    else:
+        original_fields = {}
+    prefix = entry.obsolete and u'#~ ' or u''
+    for keyword, value in entry.fields():
+        if keyword in entry.raw_fields and \
+                original_fields.get(keyword) == value and \
+                entry.obsolete == original[2]:
+            lines.extend(entry.raw_fields[keyword])
+        else:
+            lines.extend([line.encode(charset) for line in
+                          format_string(keyword, value, prefix, newline)])
+    if entry.raw is None:
+        # a new entry is followed by an empty line
+        lines.append(newline)
+    else:
+        lines.extend(entry.trailer)
+    return ''.join(lines)
+
+def write_entries(f, entries):
+    for entry in entries:
+        f.write(format_entry(entry))
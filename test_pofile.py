@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from StringIO import StringIO
+from unittest import TestCase
+
+import pofile
+from pofile import Entry, POError
+
+HEADER = ('msgid ""\n'
+          'msgstr ""\n'
+          '"Project-Id-Version: test\\n"\n'
+          '"Content-Type: text/plain; charset=%s\\n"\n'
+          '\n')
+
+CATALOGUE = HEADER % 'UTF-8' + '''# translator comment
+#. extracted comment
+#: src/main.c:10 src/main.c:20
+#, c-format, fuzzy
+#| msgid "Old %s"
+msgid "Open %s"
+msgstr "Ouvrir %s"
+
+msgctxt "menu"
+msgid "File"
+msgstr ""
+
+msgid ""
+"first line\\n"
+"second \\"line\\""
+msgstr ""
+
+msgid "one file"
+msgid_plural "%d files"
+msgstr[0] ""
+msgstr[1] ""
+
+#~ msgid "gone"
+#~ msgstr "parti"
+
+#~| msgid "older"
+#~ msgid "gone too"
+#~ msgstr ""
+
+# a trailing comment
+'''
+
+def read(data, charset=None):
+    return list(pofile.read_entries(StringIO(data), charset))
+
+def write(entries):
+    out = StringIO()
+    pofile.write_entries(out, entries)
+    return out.getvalue()
+
+class EscapeTest(TestCase):
+    def test_unescape(self):
+        self.assertEqual(pofile.unescape(u'a\\nb\\tc\\"d\\\\e'),
+                         u'a\nb\tc"d\\e')
+        self.assertEqual(pofile.unescape(u'\\101\\x42\\q'), u'ABq')
+        self.assertEqual(pofile.unescape(u'plain'), u'plain')
+
+    def test_escape(self):
+        text = u'a\nb\tc"d\\e\r'
+        self.assertEqual(pofile.escape(text), u'a\\nb\\tc\\"d\\\\e\\r')
+        self.assertEqual(pofile.unescape(pofile.escape(text)), text)
+
+    def test_charset(self):
+        self.assertEqual(pofile.get_charset(u'charset=ISO-8859-1\n'),
+                         'iso8859-1')
+        self.assertEqual(pofile.get_charset(u'charset=CHARSET\n'), 'utf-8')
+        self.assertEqual(pofile.get_charset(None), 'utf-8')
+
+class ReadTest(TestCase):
+    def test_entries(self):
+        entries = read(CATALOGUE)
+        self.assertEqual(len(entries), 8)
+        header, entry, ctxt, multi, plural, gone, gone_too, trailing = entries
+
+        self.failUnless(header.is_header())
+        self.assertEqual(header.charset, 'utf-8')
+        self.failUnless(u'Project-Id-Version: test\n' in header.msgstr)
+
+        self.assertEqual(entry.msgid, u'Open %s')
+        self.assertEqual(entry.msgstr, u'Ouvrir %s')
+        self.assertEqual(entry.flags, [u'c-format', u'fuzzy'])
+        self.assertEqual(entry.comments[-1], u'#| msgid "Old %s"')
+        self.failUnless(entry.translated())
+
+        self.assertEqual(ctxt.msgctxt, u'menu')
+        self.failIf(ctxt.is_header())
+        self.failIf(ctxt.translated())
+
+        self.assertEqual(multi.msgid, u'first line\nsecond "line"')
+
+        self.assertEqual(plural.msgid_plural, u'%d files')
+        self.assertEqual(plural.msgstr, None)
+        self.assertEqual(plural.msgstr_plural, {0: u'', 1: u''})
+
+        self.failUnless(gone.obsolete)
+        self.assertEqual(gone.msgstr, u'parti')
+        self.failUnless(gone_too.obsolete)
+        self.assertEqual(gone_too.comments, [u'#~| msgid "older"'])
+        self.assertEqual(gone_too.msgid, u'gone too')
+
+        self.assertEqual(trailing.msgid, None)
+        self.assertEqual(trailing.comments, [u'# a trailing comment'])
+        self.failIf(any(entry.modified() for entry in entries))
+
+    def test_charset(self):
+        data = HEADER % 'ISO-8859-1' + 'msgid "caf\xe9"\nmsgstr "th\xe9"\n'
+        header, entry = read(data)
+        self.assertEqual(entry.charset, 'iso8859-1')
+        self.assertEqual(entry.msgid, u'caf\xe9')
+        self.assertEqual(entry.msgstr, u'th\xe9')
+        # a given charset wins over the header
+        header, entry = read(HEADER % 'UTF-8' + 'msgid "caf\xe9"\n'
+                             'msgstr ""\n', 'latin-1')
+        self.assertEqual(entry.msgid, u'caf\xe9')
+
+    def test_errors(self):
+        self.assertRaises(POError, read, 'msgid "a"\nmsgstr "b"\nbogus\n')
+        self.assertRaises(POError, read, '"no message"\n')
+        self.assertRaises(POError, read, 'msgid "unterminated\n')
+        try:
+            read('msgid "a"\nmsgstr "b"\n\nbogus\n')
+        except POError, e:
+            self.assertEqual(e.lineno, 4)
+            self.failUnless(isinstance(e, ValueError))
+        else:
+            self.fail('no POError')
+
+class WriteTest(TestCase):
+    def test_round_trip(self):
+        self.assertEqual(write(read(CATALOGUE)), CATALOGUE)
+
+    def test_round_trip_crlf(self):
+        data = CATALOGUE.replace('\n', '\r\n')
+        entries = read(data)
+        self.assertEqual(entries[1].newline, '\r\n')
+        self.assertEqual(entries[1].msgid, u'Open %s')
+        self.assertEqual(write(entries), data)
+
+    def test_round_trip_charset(self):
+        data = HEADER % 'ISO-8859-1' + '#. caf\xe9\nmsgid "caf\xe9"\n' \
+               'msgstr ""\n'
+        self.assertEqual(write(read(data)), data)
+
+    def test_modified(self):
+        entries = read(CATALOGUE)
+        ctxt = entries[2]
+        ctxt.msgstr = u'Fichier'
+        ctxt.add_flag(u'fuzzy')
+        self.failUnless(ctxt.modified())
+        self.assertEqual(pofile.format_entry(ctxt),
+                         '#, fuzzy\n'
+                         'msgctxt "menu"\n'
+                         'msgid "File"\n'
+                         'msgstr "Fichier"\n'
+                         '\n')
+        # the rest of the file is untouched
+        self.assertEqual(write(entries), CATALOGUE.replace(
+                'msgctxt "menu"\nmsgid "File"\nmsgstr ""\n',
+                '#, fuzzy\nmsgctxt "menu"\nmsgid "File"\n'
+                'msgstr "Fichier"\n'))
+
+    def test_modified_keeps_lines(self):
+        # the lines of the parts that did not change are kept as they were
+        data = 'msgid ""\n"split " "here"\nmsgstr ""\n'
+        entry, = read(data)
+        entry.msgstr = u'l\xe0'
+        self.assertEqual(pofile.format_entry(entry),
+                         'msgid ""\n"split " "here"\nmsgstr "l\xc3\xa0"\n')
+
+    def test_modified_crlf(self):
+        entries = read(CATALOGUE.replace('\n', '\r\n'))
+        entries[4].msgstr_plural = {0: u'un fichier', 1: u'%d fichiers'}
+        self.assertEqual(pofile.format_entry(entries[4]),
+                         'msgid "one file"\r\n'
+                         'msgid_plural "%d files"\r\n'
+                         'msgstr[0] "un fichier"\r\n'
+                         'msgstr[1] "%d fichiers"\r\n'
+                         '\r\n')
+
+    def test_set_charset(self):
+        data = HEADER % 'ISO-8859-1' + '#. caf\xe9\nmsgid "caf\xe9"\n' \
+               'msgstr ""\n\n'
+        header, entry = read(data)
+        entry.set_charset('latin-1')
+        self.failIf(entry.modified())
+        entry.set_charset('utf-8')
+        self.assertEqual(pofile.format_entry(entry),
+                         '#. caf\xc3\xa9\nmsgid "caf\xc3\xa9"\nmsgstr ""\n\n')
+
+    def test_new_entry(self):
+        entry = Entry(msgid=u'line one\nline two', msgctxt=u'ctx',
+                      comments=[u'#: a.c:1'])
+        entry.add_flag(u'c-format')
+        entry.add_flag(u'c-format')
+        self.assertEqual(pofile.format_entry(entry),
+                         '#: a.c:1\n'
+                         '#, c-format\n'
+                         'msgctxt "ctx"\n'
+                         'msgid ""\n'
+                         '"line one\\n"\n'
+                         '"line two"\n'
+                         'msgstr ""\n'
+                         '\n')
+
+    def test_add_flag(self):
+        entry = Entry(msgid=u'a', comments=[u'#: a.c:1', u'#| msgid "b"'])
+        entry.add_flag(u'fuzzy')
+        self.assertEqual(entry.comments,
+                         [u'#: a.c:1', u'#, fuzzy', u'#| msgid "b"'])
+        entry.add_flag(u'c-format')
+        self.assertEqual(entry.comments[1], u'#, fuzzy, c-format')
+        self.assertEqual(entry.flags, [u'fuzzy', u'c-format'])
+
+    def test_obsolete(self):
+        entry = Entry(msgid=u'gone', msgstr=u'parti', obsolete=True)
+        self.assertEqual(pofile.format_entry(entry),
+                         '#~ msgid "gone"\n#~ msgstr "parti"\n\n')
+
+if '__main__' == __name__:
+    import unittest
+    unittest.main()
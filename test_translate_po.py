@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+import pofile
+from translate_po import *
+
+class UpperBackend:
+    cacheable = True
+
+    def __init__(self):
+        self.seen = []
+
+    def translate(self, texts):
+        self.seen.extend(texts)
+        return [text.upper() for text in texts]
+
+class BrokenBackend:
+    cacheable = True
+
+    def translate(self, texts):
+        if u'bad' in texts:
+            return {}[u'bad']
+        return list(texts)
+
+class GarbleBackend:
+    """Widens the braces of the sentinels as the Google API may."""
+    cacheable = False
+
+    def translate(self, texts):
+        return [text.replace(u'{', u'\uff5b ').replace(u'}', u' \uff5d')
+                for text in texts]
+
+class ProtectTest(TestCase):
+    def test_protect(self):
+        text = u'Save %s to ${HOME} as <b>USB</b> with\tPuppy\\n %(n)d%%'
+        protected, notrans = protect(text)
+        self.assertEqual(protected,
+                         u'Save {0} to {1} as {2}{3}{4} with{5}{6}{7} {8}{9}')
+        self.assertEqual(notrans, [u'%s', u'${HOME}', u'<b>', u'USB',
+                                   u'</b>', u'\t', u'Puppy', u'\\n',
+                                   u'%(n)d', u'%%'])
+        self.assertEqual(restore(protected, notrans), text)
+
+    def test_newlines(self):
+        # the backends get one string per line: none may hold a newline,
+        # nor the mark translate() sends newlines as
+        text = u'two\nlines OMG! no'
+        protected, notrans = protect(text)
+        self.assertEqual(protected, u'two{0}lines {1} no')
+        self.assertEqual(restore(protected, notrans), text)
+
+        class LineBackend:
+            def translate(self, texts):
+                lines = NEWLINE_MARK.join(texts).split(NEWLINE_MARK)
+                return [line.upper() for line in lines]
+        self.assertEqual(translate_fixed([text, u'one'], LineBackend()),
+                         [u'TWO\nLINES OMG! NO', u'ONE'])
+
+    def test_nothing(self):
+        self.assertEqual(protect(u'plain words'), (u'plain words', []))
+        self.assertEqual(restore(u'mots {0}', []), u'mots {0}')
+
+    def test_own_sentinels(self):
+        # a text holding a sentinel gets it protected like a placeholder
+        text = u'{0} and %s { 1 }'
+        protected, notrans = protect(text)
+        self.assertEqual(notrans, [u'{0}', u'%s', u'{ 1 }'])
+        self.assertEqual(restore(protected, notrans), text)
+
+    def test_tolerant(self):
+        notrans = [u'%s', u'USB']
+        self.assertEqual(restore(u'\uff5b 1 \uff5d \u548c { 0}', notrans),
+                         u'USB \u548c %s')
+        self.assertEqual(restore(u'{1} {1} {0} {7}', notrans),
+                         u'USB USB %s {7}')
+
+    def test_lost(self):
+        self.assertEqual(restore(u'{0} only', [u'%s', u'%d']), None)
+        self.assertEqual(restore(u'none', [u'%s']), None)
+
+    def test_translate_fixed(self):
+        texts = [u'Copy %s to USB', u'no placeholder']
+        self.assertEqual(translate_fixed(texts, GarbleBackend()), texts)
+
+        class LosingBackend:
+            def translate(self, texts):
+                return [u'lost' for text in texts]
+        self.assertEqual(translate_fixed(texts, LosingBackend()),
+                         [None, u'lost'])
+
+class EntityTest(TestCase):
+    def test_decode(self):
+        self.assertEqual(decode_entities(u'&lt;b&gt; &amp; &quot;x&quot;'),
+                         u'<b> & "x"')
+        self.assertEqual(decode_entities(u'&#233;&#xE9;&nbsp;'),
+                         u'\xe9\xe9\xa0')
+        # one pass: a decoded ampersand starts no new reference
+        self.assertEqual(decode_entities(u'&amp;lt;'), u'&lt;')
+
+    def test_unknown(self):
+        for text in [u'&bogus;', u'&#99999999;', u'&amp', u'a & b']:
+            self.assertEqual(decode_entities(text), text)
+
+class MemoryTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'memory.db')
+        self.memory = TranslationMemory(self.path)
+
+    def tearDown(self):
+        self.memory.close()
+        shutil.rmtree(self.dir)
+
+    def test_lookup(self):
+        self.memory.store([(u'File', u'Fichier'), (u'Edit', u'\xc9dition')],
+                          'en|fr')
+        self.memory.store([(u'File', u'Datei')], 'en|de')
+        self.assertEqual(self.memory.lookup([u'File', u'Edit', u'View'],
+                                            'en|fr'),
+                         {u'File': u'Fichier', u'Edit': u'\xc9dition'})
+        self.assertEqual(self.memory.lookup([u'File'], 'en|de'),
+                         {u'File': u'Datei'})
+        self.assertEqual(self.memory.lookup([], 'en|de'), {})
+
+        self.memory.store([(u'File', u'Fichier!')], 'en|fr')
+        self.memory.close()
+        self.memory = TranslationMemory(self.path)
+        self.assertEqual(self.memory.lookup([u'File'], 'en|fr'),
+                         {u'File': u'Fichier!'})
+
+    def test_many(self):
+        texts = [u'text %d' % i for i in range(1200)]
+        self.memory.store([(text, text) for text in texts], 'en|en')
+        self.assertEqual(len(self.memory.lookup(texts, 'en|en')), 1200)
+
+    def test_translate_all(self):
+        backend = UpperBackend()
+        translations, stats = translate_all([u'b', u'a', u'b'], backend,
+                self.memory, 'en|fr', jobs=2, batch_size=1)
+        self.assertEqual(translations, {u'a': u'A', u'b': u'B'})
+        self.assertEqual(stats, {'unique': 2, 'memory': 0, 'batches': 2,
+                                 'failed': 0})
+
+        # only the new strings go to the backend
+        backend = UpperBackend()
+        translations, stats = translate_all([u'a', u'b', u'c'], backend,
+                self.memory, 'en|fr')
+        self.assertEqual(backend.seen, [u'c'])
+        self.assertEqual(translations, {u'a': u'A', u'b': u'B', u'c': u'C'})
+        self.assertEqual(stats['memory'], 2)
+
+    def test_not_cacheable(self):
+        translate_all([u'a'], CopyBackend('en', 'fr'), self.memory, 'en|fr')
+        translate_all([u'这'], LangConvBackend('zh-CN', 'zh-TW'),
+                      self.memory, 'zh-CN|zh-TW')
+        self.assertEqual(self.memory.lookup([u'a'], 'en|fr'), {})
+        self.assertEqual(self.memory.lookup([u'这'], 'zh-CN|zh-TW'), {})
+
+class TranslateAllTest(TestCase):
+    def test_batches(self):
+        texts = [u'%03d' % i for i in range(50)]
+        translations, stats = translate_all(texts, CopyBackend('en', 'en'),
+                None, 'en|en', jobs=3, batch_size=4)
+        self.assertEqual(translations, dict((text, text) for text in texts))
+        self.assertEqual(stats['batches'], 13)
+        self.assertEqual(list(make_batches(texts, 4))[-1], texts[48:])
+        # the strings are joined by the four characters of the newline mark
+        self.assertEqual([len(batch) for batch in
+                          make_batches([u'x' * 10] * 3, max_chars=24)],
+                         [2, 1])
+        self.assertEqual([len(batch) for batch in
+                          make_batches([u'x' * 10] * 3, max_chars=23)],
+                         [1, 1, 1])
+
+    def test_batch_size_protected(self):
+        # the strings are sent protected: eleven %s as {0}..{10}
+        texts = [u'%s' * 11, u'%s %s']
+        self.assertEqual(len(protect(texts[0])[0]), 34)
+        self.assertEqual([len(batch) for batch in
+                          make_batches(texts, max_chars=34 + 4 + 7)], [2])
+        self.assertEqual([len(batch) for batch in
+                          make_batches(texts, max_chars=34 + 4 + 6)], [1, 1])
+
+    def test_failed_batch(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            translations, stats = translate_all([u'good', u'bad'],
+                    BrokenBackend(), None, 'en|en', batch_size=1)
+        finally:
+            errors = sys.stderr.getvalue()
+            sys.stderr = stderr
+        self.assertEqual(translations, {u'good': u'good'})
+        self.assertEqual(stats['failed'], 1)
+        self.failUnless('batch of 1 failed' in errors)
+
+    def test_langconv(self):
+        translations, stats = translate_all([u'这是'],
+                LangConvBackend('zh-CN', 'zh-TW'), None, 'zh-CN|zh-TW')
+        self.assertEqual(translations, {u'这是': u'這是'})
+        self.assertRaises(BackendError, LangConvBackend, 'zh-CN', 'fr')
+
+class CatalogueTest(TestCase):
+    def write(self, data, translations):
+        out = StringIO()
+        write_catalogue(out, pofile.read_entries(StringIO(data)),
+                        translations, 'test')
+        return out.getvalue()
+
+    def test_texts(self):
+        entry = pofile.Entry(msgid=u'one\n\ntwo\n', msgid_plural=u'many')
+        self.failUnless(wants_translation(entry))
+        self.assertEqual(entry_texts(entry), [u'one', u'two', u'many'])
+        self.assertEqual(translate_text(u'one\n\ntwo\n',
+                                        {u'one': u'un', u'two': u'deux'}),
+                         u'un\n\ndeux\n')
+
+    def test_write(self):
+        data = ('msgid ""\nmsgstr ""\n'
+                '"Content-Type: text/plain; charset=UTF-8\\n"\n\n'
+                '#: a.c:1\nmsgid "File"\nmsgstr ""\n\n'
+                'msgid "Done"\nmsgstr "Fait"\n\n'
+                'msgid "one"\nmsgid_plural "many"\n'
+                'msgstr[0] ""\nmsgstr[1] ""\n')
+        result = self.write(data, {u'File': u'Fichier', u'one': u'un',
+                                   u'many': u'plusieurs'})
+        entries = list(pofile.read_entries(StringIO(result)))
+        self.assertEqual(len(entries), 4)
+        self.failUnless(u'Project-Id-Version: test\n' in entries[0].msgstr)
+        self.assertEqual(entries[1].msgstr, u'Fichier')
+        self.assertEqual(entries[1].flags, [u'fuzzy'])
+        self.assertEqual(entries[2].msgstr, u'Fait')
+        self.assertEqual(entries[3].msgstr_plural,
+                         {0: u'un', 1: u'plusieurs'})
+        self.failUnless('msgid "Done"\nmsgstr "Fait"\n\n'
+                        '#, fuzzy\nmsgid "one"\n' in result)
+
+    def test_charset(self):
+        data = ('msgid ""\nmsgstr ""\n'
+                '"Content-Type: text/plain; charset=ISO-8859-1\\n"\n\n'
+                'msgid "caf\xe9"\nmsgstr "caf\xe9"\n\n'
+                '#. th\xe9\nmsgid "th\xe9"\nmsgstr ""\n')
+        result = self.write(data, {u'th\xe9': u'tea'})
+        self.failUnless('charset=utf-8' in result)
+        self.failUnless(result.endswith('msgid "caf\xc3\xa9"\n'
+                                        'msgstr "caf\xc3\xa9"\n\n'
+                                        '#. th\xc3\xa9\n#, fuzzy\n'
+                                        'msgid "th\xc3\xa9"\n'
+                                        'msgstr "tea"\n'))
+
+if '__main__' == __name__:
+    import unittest
+    unittest.main()
@@ -1,39 +1,87 @@
-#!/usr/bin/python  
-# -*- coding: utf-8 -*-  
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
 # url: http://www.minilinux.net/node/27
-  
-import sys  
-reload(sys)
-sys.setdefaultencoding('utf8')
-import httplib  
-import urllib  
-import urllib2  
-import traceback  
-import simplejson
-import re  
-import random  
-import time  
-  
-  
-proxies = [  
-     "proxy1:port",  
-     "proxy2:port",  
-     None,  
-    ]  
-
-def get_splits(text, length=4500):
+
+"""Machine translation of a .pot file into a .po file.
+
+The catalogue is streamed by pofile, entry by entry, twice: once to collect
+the untranslated strings, once to write them translated.  The strings are
+deduplicated line by line.  Every string already in the translation memory,
+a SQLite file keyed by the source text and the language pair, is taken from
+there; only the others go to the backend, in batches run by a bounded pool
+of threads, and the results are added to the memory as they come back.
+Running it again on a slightly changed .pot translates only the new
+strings.
+
+Backends:
+  google    the Google AJAX translation API
+  langconv  Chinese script conversion by examples/LangConv, offline
+  copy      the source text unchanged, for a dry run
+
+Only the google results go to the translation memory: the memory is keyed
+by the language pair alone, and a later run must not take a script
+conversion or a copy for a translation.
+"""
+
+import htmlentitydefs
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import pofile
+
+MEMORY = os.path.expanduser('~/.translate_po.db')
+# the Google API takes at most 4500 characters at once
+MAX_CHARS = 4500
+BATCH_SIZE = 20
+# translate() sends every newline as this mark
+NEWLINE_MARK = u'OMG!'
+JOBS = 4
+
+class BackendError(Exception):
+    pass
+
+def get_splits(text, length=MAX_CHARS):
     '''
     Translate Api has a limit on length of text(4500 characters) that can be translated at once
     '''
     return (text[index:index+length] for index in xrange(0,len(text),length))
-  
-def translate(text):
-    from_lang = "en"
-    to_lang = "zh-CN"
+
+ENTITY_RE = re.compile(r'&(?:#(\d+)|#[xX]([0-9a-fA-F]+)|(\w+));')
+
+def decode_entities(text):
+    """Decode the HTML character references of text in one pass; an
+    unknown name or a code point out of range is left as it is."""
+    def replace(match):
+        decimal, hexa, name = match.groups()
+        if name is not None:
+            code = htmlentitydefs.name2codepoint.get(name)
+        elif decimal is not None:
+            code = int(decimal)
+        else:
+            code = int(hexa, 16)
+        if code is None or code > sys.maxunicode:
+            return match.group(0)
+        return unichr(code)
+    return ENTITY_RE.sub(replace, text)
+
+def translate(text, from_lang='en', to_lang='zh-CN'):
     langpair = '%s|%s' % (from_lang, to_lang)
 
     # OK, dirty hack, but works. ^_^
-    text = 'OMG!'.join(text.split('\n'))
+    text = NEWLINE_MARK.join(text.split('\n'))
 
     base_url = 'http://ajax.googleapis.com/ajax/services/language/translate?'
     params = {'v': 1.0,
@@ -43,112 +91,359 @@ def translate(text):
 
     new_text = ''
     for splite in get_splits(text):
-        params['q'] = splite
+        params['q'] = splite.encode('utf8')
         data = urllib.urlencode(params)
-        resp = simplejson.load(urllib.urlopen('%s' % (base_url), data=data))
+        resp = json.load(urllib.urlopen('%s' % (base_url), data=data))
 
         try:
             translated = resp['responseData']['translatedText']
-            translated = translated.replace('％', '%')
-            translated = re.sub("&#(\d+);", lambda s: chr(int(s.group(1))),   translated)
-            translated = re.sub("&([a-z]+);", lambda s: {"lt":"<", "gt":">", "amp":"&"}[s.group(1)], translated)
-            new_text += translated
-        except:
-            pass
+        except (KeyError, TypeError):
+            raise BackendError(resp.get('responseDetails') or 'no translation')
+        translated = translated.replace(u'％', u'%')
+        translated = decode_entities(translated)
+        new_text += translated
 
     # recover the word
-    return '\n'.join(new_text.split('OMG!'))
-  
-def translate_fixed(text):  
-#    signature = random.randrange(1E20, 1E21)  
-    notrans = []  
-    def replace(match):  
-        notrans.append(match.group(0))  
-        return " 0.%d68065175210" % (len(notrans) - 1)  
-    text = re.sub("\${[\w_]+}|\$[\w_]+", replace, text)  
-    text = re.sub("\\\\\"|\\\\$|\\\\\\\\n|\\\\t", replace, text)  
-    text = re.sub("\\\\", replace, text)  
-    text = re.sub("[A-Z]{2,100}", replace, text)  
-    text = re.sub("<\w+>|</\w+>", replace, text)  
-    text = re.sub("puppy(?i)", replace, text)  
-  
-    trans = translate(text)  
-  
-    for i in range(len(notrans)):  
-#        print "re.sub",  
-#        print "%dx" % (signature + i), notrans[i], trans  
-        trans = re.sub("0 ?.%d68065175210" % i, lambda x: notrans[i], trans)  
-  
-    return trans  
-  
-  
-random.seed()  
-  
-if len(sys.argv) != 2:  
-    print "Usage: " + sys.argv[0] + " filename.pot"  
-    sys.exit(1)  
-  
-if sys.argv[1] == "-":  
-    f = sys.stdin  
-else:  
-    f = open(sys.argv[1])  
-  
-  
-print """# ä¸­æPuppy Linuxå¼åèä¹å®¶. 
-# This file is distributed under GPL. 
-#"""  
-  
-print """#, fuzzy 
-msgid "" 
-msgstr "" 
-"Project-Id-Version: %(program)s\\n" 
-"Report-Msgid-Bugs-To: %(reportbug)s\\n" 
-"POT-Creation-Date: %(date)s\\n" 
-"PO-Revision-Date: YEAR-MO-DA HO:MI+ZONE\\n" 
-"Last-Translator: Google Translate\\n" 
-"Language-Team: Chinese\\n" 
-"MIME-Version: 1.0\\n" 
-"Content-Type: text/plain; charset=utf-8\\n" 
-"Content-Transfer-Encoding: 8bit\\n" 
-""" % {"program": sys.argv[1],  
-       "reportbug": "laborer@126.com",  
-       "date": time.strftime("%Y-%m-%d %H:%M%z")}  
-  
-  
-for line in f:  
-    if not line.rstrip():  
-        break;  
-  
-trans = []  
-buf = ""  
-skip = False  
-for line in f:  
-    line = line.rstrip()  
-    if skip:  
-        skip = line;  
-        continue  
-  
-    if line.startswith("#,"):  
-        print line + ", fuzzy"  
-    elif line.startswith("#"):  
-        print line  
-    elif line.startswith("msgid "):  
-        print "msgid",  
-        line = line[6:]  
-    elif line.startswith("msgstr "):  
-        print "msgstr",  
-        if buf:  
-            trans.append(translate_fixed(buf))  
-            buf = ""  
-        for s in trans:  
-            print "\"%s\"" % s  
-        print  
-        trans = []  
-        skip = True  
-  
-    if line.startswith("\""):  
-        print line  
-        buf += line[1:-1]  
-        if buf.endswith("\\n"):  
-            trans.append(translate_fixed(buf[:-2])+"\\n")  
-            buf = ""  
+    return '\n'.join(new_text.split(NEWLINE_MARK))
+
+class GoogleBackend:
+    cacheable = True
+
+    def __init__(self, from_lang, to_lang):
+        self.from_lang = from_lang
+        self.to_lang = to_lang
+
+    def translate(self, texts):
+        # a batch is sent as one request, a string per line: protect()
+        # leaves no newline nor newline mark inside a string
+        result = translate(u'\n'.join(texts), self.from_lang, self.to_lang)
+        result = result.split(u'\n')
+        if len(result) != len(texts):
+            # the lines got mixed up: one request per string
+            result = [translate(text, self.from_lang, self.to_lang)
+                      for text in texts]
+        return result
+
+class LangConvBackend:
+    # script conversion is no translation, and cheap to redo
+    cacheable = False
+
+    def __init__(self, from_lang, to_lang):
+        sys.path.insert(0, os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                'examples', 'LangConv'))
+        import langconv
+        self.langconv = langconv
+        self.to_encoding = to_lang.lower().replace('_', '-')
+        if self.to_encoding not in langconv.MAPS:
+            raise BackendError('langconv cannot convert to %s' % to_lang)
+
+    def translate(self, texts):
+        return [self.langconv.convert_text(text, self.to_encoding)
+                for text in texts]
+
+class CopyBackend:
+    cacheable = False
+
+    def __init__(self, from_lang, to_lang):
+        pass
+
+    def translate(self, texts):
+        return list(texts)
+
+BACKENDS = {'google': GoogleBackend,
+            'langconv': LangConvBackend,
+            'copy': CopyBackend}
+
+class TranslationMemory:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS memory ('
+                        'source TEXT NOT NULL, langpair TEXT NOT NULL, '
+                        'target TEXT NOT NULL, '
+                        'PRIMARY KEY (source, langpair))')
+
+    def lookup(self, texts, langpair):
+        """The translations of texts that are in the memory, as a dict."""
+        found = {}
+        texts = list(texts)
+        # one query per few hundred strings, under the SQLite variable limit
+        for i in xrange(0, len(texts), 500):
+            part = texts[i:i + 500]
+            cursor = self.db.execute('SELECT source, target FROM memory '
+                    'WHERE langpair = ? AND source IN (%s)' %
+                    ','.join('?' * len(part)), [langpair] + part)
+            found.update(cursor)
+        return found
+
+    def store(self, translations, langpair):
+        self.db.executemany('INSERT OR REPLACE INTO memory VALUES (?, ?, ?)',
+                [(source, langpair, target)
+                 for source, target in translations])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+# what the backend must not translate, one alternative per kind, the first
+# that matches wins.  The last one matches the sentinels themselves: a text
+# holding one of its own gets it protected like any placeholder, so after
+# translation every sentinel found is one of ours.
+PLACEHOLDER_RE = re.compile(ur"""
+    \$\{\w+\}|\$\w+                                  # shell variables
+  | %(?:\(\w+\))?[-+\#0]*\d*(?:\.\d+)?[hlL]?[diouxXeEfFgGcrs%]  # printf
+  | \\.?|\t|\n                                       # escapes, whitespace
+  | OMG!                                             # newline mark
+  | [A-Z]{2,100}                                     # acronyms
+  | </?\w+>                                          # tags
+  | [Pp][Uu][Pp][Pp][Yy]                             # the product
+  | [{\uff5b]\s*\d+\s*[}\uff5d]                      # sentinels
+""", re.VERBOSE | re.UNICODE)
+# the backend may widen the braces or put spaces around the number
+SENTINEL_RE = re.compile(ur'[{\uff5b]\s*(\d+)\s*[}\uff5d]', re.UNICODE)
+SENTINEL = u'{%d}'
+
+def protect(text):
+    """Replace what must not be translated by numbered sentinels, returns
+    the text and the replaced strings."""
+    notrans = []
+    def replace(match):
+        notrans.append(match.group(0))
+        return SENTINEL % (len(notrans) - 1)
+    return PLACEHOLDER_RE.sub(replace, text), notrans
+
+def restore(trans, notrans):
+    """Put the replaced strings back, None if the backend lost one."""
+    if not notrans:
+        return trans
+    restored = set()
+    def replace(match):
+        i = int(match.group(1))
+        if i >= len(notrans):
+            return match.group(0)
+        restored.add(i)
+        return notrans[i]
+    trans = SENTINEL_RE.sub(replace, trans)
+    if len(restored) != len(notrans):
+        return None
+    return trans
+
+def translate_fixed(texts, backend):
+    """Translate a batch of strings, keeping the placeholders; None for a
+    string whose placeholders did not survive."""
+    protected = [protect(text) for text in texts]
+    trans = backend.translate([text for text, notrans in protected])
+    return [restore(t, notrans) for t, (text, notrans) in zip(trans, protected)]
+
+def make_batches(texts, batch_size=BATCH_SIZE, max_chars=MAX_CHARS):
+    """Group texts into batches of at most batch_size strings, which sent
+    protected and joined by the newline mark stay within max_chars."""
+    batch = []
+    chars = 0
+    for text in texts:
+        size = len(protect(text)[0])
+        if batch and (len(batch) >= batch_size or
+                      chars + len(NEWLINE_MARK) + size > max_chars):
+            yield batch
+            batch = []
+        if batch:
+            chars += len(NEWLINE_MARK) + size
+        else:
+            chars = size
+        batch.append(text)
+    if batch:
+        yield batch
+
+def _translate_batch(backend, batch):
+    # whatever goes wrong fails this batch only, not the run
+    try:
+        return batch, translate_fixed(batch, backend), None
+    except Exception, e:
+        return batch, None, e
+
+def translate_all(texts, backend, memory, langpair, jobs=JOBS,
+                  batch_size=BATCH_SIZE):
+    """Translate the distinct strings of texts: a dict of the source strings
+    to their translations, and counts of what was done."""
+    texts = sorted(set(texts))
+    if memory is not None:
+        translations = memory.lookup(texts, langpair)
+    else:
+        translations = {}
+    missing = [text for text in texts if text not in translations]
+    stats = {'unique': len(texts), 'memory': len(translations),
+             'batches': 0, 'failed': 0}
+
+    pool = ThreadPool(jobs)
+    try:
+        pending = deque()
+        def collect():
+            batch, result, error = pending.popleft().get()
+            stats['batches'] += 1
+            if error is not None:
+                print >> sys.stderr, 'batch of %d failed: %s' % (len(batch),
+                                                                 error)
+                stats['failed'] += len(batch)
+                return
+            done = [(source, target) for source, target in zip(batch, result)
+                    if target is not None]
+            stats['failed'] += len(batch) - len(done)
+            translations.update(done)
+            if memory is not None and backend.cacheable:
+                memory.store(done, langpair)
+        # at most two batches per thread are waiting
+        for batch in make_batches(missing, batch_size):
+            pending.append(pool.apply_async(_translate_batch,
+                                             (backend, batch)))
+            if len(pending) >= 2 * jobs:
+                collect()
+        while pending:
+            collect()
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return translations, stats
+
+def split_lines(text):
+    """The lines of text, each with its newline."""
+    return re.findall(u'[^\n]*\n|[^\n]+$', text)
+
+def strip_newline(line):
+    if line.endswith(u'\n'):
+        return line[:-1]
+    return line
+
+def wants_translation(entry):
+    return entry.msgid and not entry.obsolete and not entry.translated()
+
+def entry_texts(entry):
+    """The strings of an entry to translate: its source texts line by line,
+    as the backends handle one line at a time."""
+    texts = []
+    for source in (entry.msgid, entry.msgid_plural):
+        if source:
+            texts.extend([strip_newline(line) for line in split_lines(source)])
+    return [text for text in texts if text]
+
+def translate_text(text, translations):
+    result = []
+    for line in split_lines(text):
+        source = strip_newline(line)
+        result.append(translations.get(source, source) + line[len(source):])
+    return u''.join(result)
+
+def translate_entry(entry, translations):
+    if entry.msgid_plural is not None:
+        for index in entry.msgstr_plural:
+            source = index == 0 and entry.msgid or entry.msgid_plural
+            entry.msgstr_plural[index] = translate_text(source, translations)
+    else:
+        entry.msgstr = translate_text(entry.msgid, translations)
+    entry.add_flag(u'fuzzy')
+
+HEADER_COMMENTS = [u'# 中文Puppy Linux开发者之家.',
+                   u'# This file is distributed under GPL.',
+                   u'#',
+                   u'#, fuzzy']
+
+HEADER = u"""Project-Id-Version: %(program)s
+Report-Msgid-Bugs-To: %(reportbug)s
+POT-Creation-Date: %(date)s
+PO-Revision-Date: YEAR-MO-DA HO:MI+ZONE
+Last-Translator: Google Translate
+Language-Team: Chinese
+MIME-Version: 1.0
+Content-Type: text/plain; charset=utf-8
+Content-Transfer-Encoding: 8bit
+"""
+
+def make_header(program):
+    return pofile.Entry(msgid=u'', comments=HEADER_COMMENTS,
+            msgstr=HEADER % {"program": program.decode('utf8', 'replace'),
+                             "reportbug": "laborer@126.com",
+                             "date": time.strftime("%Y-%m-%d %H:%M%z")})
+
+def write_catalogue(out, entries, translations, program):
+    """Write the entries, translated, after a new header; entries that
+    need no translation are written as they were read, re-encoded when the
+    .pot is not in UTF-8."""
+    header = make_header(program)
+    for entry in entries:
+        if header is not None:
+            out.write(pofile.format_entry(header))
+            if entry.is_header():
+                header = None
+                continue
+            header = None
+        if wants_translation(entry):
+            translate_entry(entry, translations)
+        # the file is written in UTF-8, as the new header says, whatever
+        # the charset of the .pot
+        entry.set_charset('utf-8')
+        out.write(pofile.format_entry(entry))
+
+def main():
+    parser = OptionParser(usage='%prog [options] filename.pot')
+    parser.add_option('-f', type='string', dest='from_lang', default='en',
+            help='language of the .pot file (en)')
+    parser.add_option('-t', type='string', dest='to_lang', default='zh-CN',
+            help='language to translate to (zh-CN)')
+    parser.add_option('-B', type='choice', dest='backend', default='google',
+            choices=sorted(BACKENDS.keys()),
+            help='translation backend: %s (google)' %
+                 ', '.join(sorted(BACKENDS.keys())))
+    parser.add_option('-d', type='string', dest='memory', default=MEMORY,
+            help='translation memory, empty for none (%s)' % MEMORY)
+    parser.add_option('-j', type='int', dest='jobs', default=JOBS,
+            help='concurrent backend requests (%d)' % JOBS)
+    parser.add_option('-b', type='int', dest='batch_size', default=BATCH_SIZE,
+            help='strings per backend request (%d)' % BATCH_SIZE)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    # the catalogue is streamed twice: once to collect the strings, once to
+    # write them translated; standard input is spooled to be read again
+    if args[0] == "-":
+        f = tempfile.TemporaryFile()
+        shutil.copyfileobj(sys.stdin, f)
+        f.seek(0)
+    else:
+        f = open(args[0], 'rb')
+    texts = set()
+    count = 0
+    for entry in pofile.read_entries(f):
+        if wants_translation(entry):
+            strings = entry_texts(entry)
+            count += len(strings)
+            texts.update(strings)
+
+    try:
+        backend = BACKENDS[options.backend](options.from_lang,
+                                            options.to_lang)
+    except BackendError, e:
+        parser.error(str(e))
+    if options.memory:
+        memory = TranslationMemory(options.memory)
+    else:
+        memory = None
+    langpair = '%s|%s' % (options.from_lang, options.to_lang)
+    try:
+        translations, stats = translate_all(texts, backend, memory, langpair,
+                                            options.jobs, options.batch_size)
+    finally:
+        if memory is not None:
+            memory.close()
+
+    f.seek(0)
+    write_catalogue(sys.stdout, pofile.read_entries(f), translations, args[0])
+    f.close()
+    print >> sys.stderr, ('%d strings, %d unique, %d from memory, '
+            '%d batches sent, %d failed' % (count, stats['unique'],
+            stats['memory'], stats['batches'], stats['failed']))
+
+if __name__ == '__main__':
+    main()